@@ -0,0 +1,262 @@
+import json
+import os
+import random
+import re
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import feedparser
+
+from config import ARXIV_API_URL, HARVEST_MAX_RETRIES, HARVEST_RATE, HARVEST_WORKERS
+
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+# submittedDate bounds, as in "submittedDate:[202201010600+TO+202504010600]".
+DATE_FORMAT = "%Y%m%d%H%M"
+# A refresh window starts this long before the previous one ended, for papers
+# the API lists late; the overlap is dropped by the id dedupe.
+WINDOW_OVERLAP = timedelta(days=2)
+
+
+class TransientFeedError(Exception):
+    # arXiv occasionally answers with an empty page inside the result range.
+    pass
+
+
+class TokenBucket:
+    """
+    Allows ``rate`` acquisitions per second on average and at most ``capacity``
+    back to back, shared by every worker thread.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def arxiv_id(link):
+    return link.replace("http://arxiv.org/abs/", "").replace("https://arxiv.org/abs/", "")
+
+
+def base_id(paper_id):
+    # 2301.01234v2 and 2301.01234v1 are the same paper.
+    return re.sub(r"v\d+$", "", paper_id)
+
+
+def entry_to_record(entry):
+    try:
+        authors = ", ".join(author.name for author in entry.authors)
+    except AttributeError:
+        # Fall back to single author if authors list isn't available
+        authors = entry.author
+
+    return {
+        "author": authors,
+        "abstract": entry.summary,
+        "time": entry.updated,
+        "link": entry.link,
+        "id": arxiv_id(entry.link),
+        "title": entry.title,
+    }
+
+
+def _write_json_atomic(path, value):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(value, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+class Harvester:
+    """
+    Pages through arXiv API queries into a JSONL file. Pages are fetched and
+    parsed by a small worker pool under a shared rate limit, but written in
+    order; after each page a per-query cursor is saved next to the output, so
+    a rerun resumes where the last one stopped and, once a query is complete,
+    only fetches papers submitted since.
+    """
+
+    def __init__(self, output_path, base_url=ARXIV_API_URL, rate=HARVEST_RATE, workers=HARVEST_WORKERS,
+                 page_size=50, max_retries=HARVEST_MAX_RETRIES, backoff=2.0, timeout=30):
+        self.output_path = output_path
+        self.checkpoint_path = output_path + ".harvest.json"
+        self.base_url = base_url
+        self.bucket = TokenBucket(rate)
+        self.workers = max(1, workers)
+        self.page_size = page_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.seen = self._read_seen()
+        self.checkpoints = self._read_checkpoints()
+
+    def _read_seen(self):
+        seen = set()
+        if os.path.exists(self.output_path):
+            with open(self.output_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        seen.add(base_id(json.loads(line)["id"]))
+        return seen
+
+    def _read_checkpoints(self):
+        # Cursors are meaningless without the papers they point past.
+        if not os.path.exists(self.checkpoint_path) or not os.path.exists(self.output_path):
+            return {}
+        with open(self.checkpoint_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def _page_url(self, search_query, start, sort_by, sort_order):
+        query = f"search_query={search_query}&start={start}&max_results={self.page_size}"
+        if sort_by:
+            query += f"&sortBy={sort_by}&sortOrder={sort_order}"
+        return f"{self.base_url}?{query}"
+
+    def _retry_delay(self, attempt, error):
+        retry_after = getattr(error, "headers", None) and error.headers.get("Retry-After")
+        if retry_after and retry_after.isdigit():
+            return float(retry_after)
+        delay = self.backoff * 2 ** attempt
+        return delay + random.uniform(0, delay / 2)
+
+    def fetch_page(self, url, start):
+        # Returns (total results for the query, records on this page).
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire()
+            try:
+                with urllib.request.urlopen(url, timeout=self.timeout) as response:
+                    body = response.read()
+                feed = feedparser.parse(body)
+                total = int(feed.feed.get("opensearch_totalresults", 0))
+                if not feed.entries and start < total:
+                    raise TransientFeedError(f"empty page at start={start} of {total}")
+                return total, [entry_to_record(entry) for entry in feed.entries]
+            except urllib.error.HTTPError as e:
+                if e.code not in RETRYABLE_STATUS or attempt == self.max_retries:
+                    raise
+                error = e
+            except (urllib.error.URLError, TimeoutError, ConnectionError, TransientFeedError) as e:
+                if attempt == self.max_retries:
+                    raise
+                error = e
+            delay = self._retry_delay(attempt, error)
+            print(f"Retrying start={start} in {delay:.1f}s ({error})")
+            time.sleep(delay)
+
+    def _write_page(self, output, records):
+        written = 0
+        for record in records:
+            key = base_id(record["id"])
+            if key in self.seen:
+                continue
+            self.seen.add(key)
+            json.dump(record, output, ensure_ascii=False)
+            output.write("\n")
+            written += 1
+        output.flush()
+        os.fsync(output.fileno())
+        return written
+
+    def _save_cursor(self, key, next_start, total):
+        # Other fields of the cursor, such as a date window, are kept.
+        self.checkpoints[key] = {**self.checkpoints.get(key, {}), "next_start": next_start, "total": total}
+        _write_json_atomic(self.checkpoint_path, self.checkpoints)
+
+    def harvest(self, search_query, total_results=None, max_results=None, sort_by="submittedDate",
+                sort_order="ascending", key=None):
+        """
+        Appends the results of ``search_query`` that are not already in the
+        output file, and returns how many were written. ``total_results`` caps
+        the results taken from the query over all runs, ``max_results`` the
+        results fetched by this run. The cursor is saved under ``key``
+        (default: the query). Use a stable sort order when the query will be
+        refreshed later, so new papers land after the saved cursor.
+        """
+        key = key or search_query
+        start = self.checkpoints.get(key, {}).get("next_start", 0)
+        if total_results is not None and start >= total_results:
+            return 0
+
+        written = 0
+        with open(self.output_path, "a", encoding="utf-8") as output, \
+                ThreadPoolExecutor(max_workers=self.workers) as pool:
+            # The first page tells us how many results the query has now.
+            total, records = self.fetch_page(self._page_url(search_query, start, sort_by, sort_order), start)
+            limit = total if total_results is None else min(total, total_results)
+            if max_results is not None:
+                limit = min(limit, start + max_results)
+            if start >= limit:
+                return 0
+            written += self._write_page(output, records[:limit - start])
+            self._save_cursor(key, min(start + self.page_size, limit), total)
+
+            pages = iter(range(start + self.page_size, limit, self.page_size))
+            inflight = deque()
+            try:
+                for page_start in pages:
+                    url = self._page_url(search_query, page_start, sort_by, sort_order)
+                    inflight.append((page_start, pool.submit(self.fetch_page, url, page_start)))
+                    if len(inflight) < self.workers:
+                        continue
+                    written += self._complete(output, key, inflight.popleft(), limit)
+                while inflight:
+                    written += self._complete(output, key, inflight.popleft(), limit)
+            except BaseException:
+                for _, future in inflight:
+                    future.cancel()
+                print(f"Harvest of {search_query} stopped after {written} new papers; rerun to resume.")
+                raise
+
+        print(f"Harvested {written} new papers for {search_query}")
+        return written
+
+    def _complete(self, output, key, page, limit):
+        page_start, future = page
+        total, records = future.result()
+        written = self._write_page(output, records[:limit - page_start])
+        self._save_cursor(key, min(page_start + self.page_size, limit), total)
+        return written
+
+    def harvest_since(self, search_query, since, max_results=None, until=None):
+        """
+        Harvests ``search_query`` (such as "cat:cs.CL") one submittedDate
+        window at a time, so a refresh only asks arXiv for new submissions.
+        The first window runs from ``since`` to ``until`` (both YYYYMMDDHHMM;
+        ``until`` defaults to now, UTC). A window cut short by ``max_results``
+        or an error is resumed by the next run; once one is complete, the next
+        run starts a new window where it ended.
+        """
+        until = until or datetime.now(timezone.utc).strftime(DATE_FORMAT)
+        cursor = self.checkpoints.get(search_query)
+        if cursor is None or "window" not in cursor:
+            window = [since, until]
+        elif cursor["total"] is None or cursor["next_start"] < cursor["total"]:
+            window = cursor["window"]
+        else:
+            previous_end = datetime.strptime(cursor["window"][1], DATE_FORMAT)
+            window = [max(since, (previous_end - WINDOW_OVERLAP).strftime(DATE_FORMAT)), until]
+        if window != (cursor or {}).get("window"):
+            self.checkpoints[search_query] = {"window": window, "next_start": 0, "total": None}
+
+        windowed_query = f"{search_query}+AND+submittedDate:[{window[0]}+TO+{window[1]}]"
+        return self.harvest(windowed_query, max_results=max_results, key=search_query)
@@ -0,0 +1,91 @@
+import json
+import os
+import statistics
+import time
+
+import numpy as np
+
+from config import ONNX_MODEL_DIR, ONNX_THREADS
+from onnxEncoder import FP32_FILE, INT8_FILE, OnnxBGEM3EmbeddingFunction
+
+
+QUERY_PATH = "../evaluate/TestData/ground_truth_pool.jsonl"
+BATCH_SIZES = [1, 8]
+REPEATS = 20
+# Any query embedding below these similarities to the torch encoder fails the
+# parity check. Sparse weights of short queries move more under int8, so their
+# floor is looser; their average must still reach SPARSE_COSINE_MEAN_MIN.
+DENSE_COSINE_MIN = 0.98
+SPARSE_COSINE_MIN = 0.90
+SPARSE_COSINE_MEAN_MIN = 0.95
+
+
+def load_queries(path):
+    # Full abstracts plus their first sentence, for long and short queries.
+    with open(path, "r", encoding="utf-8") as f:
+        abstracts = [json.loads(line)["abstract"].strip() for line in f if line.strip()]
+    return abstracts + [abstract.split(". ")[0] for abstract in abstracts]
+
+
+def sparse_cosine(a, b):
+    dot = a.multiply(b).sum()
+    norm = np.sqrt(a.multiply(a).sum() * b.multiply(b).sum())
+    return float(dot / norm) if norm > 0 else 1.0
+
+
+def parity(reference, candidate, queries):
+    expected = reference(queries)
+    actual = candidate(queries)
+    dense = [float(np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b)))
+             for a, b in zip(expected["dense"], actual["dense"])]
+    sparse = [sparse_cosine(expected["sparse"][[i]], actual["sparse"][[i]]) for i in range(len(queries))]
+    return min(dense), statistics.mean(dense), min(sparse), statistics.mean(sparse)
+
+
+def latency_ms(ef, queries, batch_size):
+    samples = []
+    for repeat in range(REPEATS):
+        start_index = (repeat * batch_size) % len(queries)
+        batch = (queries * 2)[start_index:start_index + batch_size]
+        start = time.perf_counter()
+        ef(batch)
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return statistics.median(samples), samples[int(0.95 * (len(samples) - 1))]
+
+
+def main():
+    from pymilvus.model.hybrid import BGEM3EmbeddingFunction
+
+    queries = load_queries(QUERY_PATH)
+    encoders = {"torch": BGEM3EmbeddingFunction(device="cpu", use_fp16=False)}
+    for model_file in (FP32_FILE, INT8_FILE):
+        if os.path.exists(os.path.join(ONNX_MODEL_DIR, model_file)):
+            encoders[f"onnx {model_file}"] = OnnxBGEM3EmbeddingFunction(ONNX_MODEL_DIR, model_file, threads=ONNX_THREADS)
+    if len(encoders) == 1:
+        raise SystemExit(f"No exported model in {ONNX_MODEL_DIR}; run onnxEncoder.py first.")
+
+    print(f"Parity against torch on {len(queries)} queries")
+    print(f"{'encoder':<24} {'dense min':>10} {'dense mean':>11} {'sparse min':>11} {'sparse mean':>12}")
+    failed = []
+    for name, ef in list(encoders.items())[1:]:
+        dense_min, dense_mean, sparse_min, sparse_mean = parity(encoders["torch"], ef, queries)
+        print(f"{name:<24} {dense_min:>10.4f} {dense_mean:>11.4f} {sparse_min:>11.4f} {sparse_mean:>12.4f}")
+        if dense_min < DENSE_COSINE_MIN or sparse_min < SPARSE_COSINE_MIN or sparse_mean < SPARSE_COSINE_MEAN_MIN:
+            failed.append(name)
+
+    print(f"\n{'encoder':<24} {'batch':>6} {'p50 ms':>9} {'p95 ms':>9} {'speedup':>9}")
+    for batch_size in BATCH_SIZES:
+        baseline = None
+        for name, ef in encoders.items():
+            ef(queries[:batch_size])
+            p50, p95 = latency_ms(ef, queries, batch_size)
+            baseline = baseline or p50
+            print(f"{name:<24} {batch_size:>6} {p50:>9.1f} {p95:>9.1f} {baseline / p50:>8.1f}x")
+
+    if failed:
+        raise AssertionError(f"Below parity thresholds: {', '.join(failed)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+import json
+import statistics
+import time
+
+from transformers import AutoTokenizer
+
+from util import extract_highlight_spans
+
+
+DOCS_PATH = "../evaluate/TestData/negative_pool.jsonl"
+QUERY_PATH = "../evaluate/TestData/ground_truth_pool.jsonl"
+PAGE_SIZES = [10, 50, 100]
+REPEATS = 20
+
+
+class _TokenizerOnly:
+    # extract_highlight_spans only needs ef.model.tokenizer.
+    def __init__(self, tokenizer):
+        self.model = self
+        self.tokenizer = tokenizer
+
+
+def reference_extract_highlight_spans(ef, query, docs):
+    # The per-doc, per-token implementation the batched highlighter replaced.
+    tokenizer = ef.model.tokenizer
+
+    query_encoding = tokenizer.encode_plus(query, return_offsets_mapping=True, add_special_tokens=True)
+    query_tokens = tokenizer.convert_ids_to_tokens(query_encoding["input_ids"][1:-1])
+
+    results = []
+
+    for doc in docs:
+        encoding = tokenizer.encode_plus(doc, return_offsets_mapping=True, add_special_tokens=True)
+        doc_tokens = tokenizer.convert_ids_to_tokens(encoding["input_ids"][1:-1])
+        offsets = encoding["offset_mapping"][1:-1]
+
+        highlight_spans = []
+        for token, (start, end) in zip(doc_tokens, offsets):
+            if token in query_tokens:
+                highlight_spans.append((start, end))
+
+        merged_spans = []
+        for start, end in sorted(highlight_spans):
+            if merged_spans and start <= merged_spans[-1][1]:
+                merged_spans[-1] = (merged_spans[-1][0], max(merged_spans[-1][1], end))
+            else:
+                merged_spans.append((start, end))
+
+        results.append({
+            "text": doc,
+            "highlights": merged_spans
+        })
+
+    return results
+
+
+def load_abstracts(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line)["abstract"] for line in f if line.strip()]
+
+
+def time_ms(fn, *args):
+    samples = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        fn(*args)
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def main():
+    ef = _TokenizerOnly(AutoTokenizer.from_pretrained("BAAI/bge-m3"))
+    docs = load_abstracts(DOCS_PATH)
+    queries = load_abstracts(QUERY_PATH)
+
+    for query in queries:
+        page = docs[:max(PAGE_SIZES)]
+        if extract_highlight_spans(ef, query, page) != reference_extract_highlight_spans(ef, query, page):
+            raise AssertionError("Batched highlighter output differs from the reference implementation")
+    print(f"Output identical to the reference on {len(queries)} queries.\n")
+
+    print(f"{'hits':>6} {'reference ms':>14} {'batched ms':>12} {'speedup':>9}")
+    for size in PAGE_SIZES:
+        page = docs[:size]
+        reference = time_ms(reference_extract_highlight_spans, ef, queries[0], page)
+        batched = time_ms(extract_highlight_spans, ef, queries[0], page)
+        print(f"{size:>6} {reference:>14.2f} {batched:>12.2f} {reference / batched:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
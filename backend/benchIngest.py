@@ -0,0 +1,64 @@
+import shutil
+import sys
+import tempfile
+from itertools import islice
+
+from embeddingDriver import ProcessPoolEmbedder, available_cores, default_cpu_workers
+from shardStore import ShardStore, iter_jsonl
+
+
+# CPU ingest throughput for a growing number of pinned workers, on the
+# first ABSTRACTS papers of the corpus.
+DATA_PATH = "./data/data_ai_cl.jsonl"
+ABSTRACTS = 2048
+CHUNK_SIZE = 128
+
+
+def shards(records):
+    for start in range(0, len(records), CHUNK_SIZE):
+        chunk = records[start:start + CHUNK_SIZE]
+        yield (
+            [item.get("id", "").strip() for _, item in chunk],
+            [item.get("abstract", "") for _, item in chunk],
+            {"first_line": chunk[0][0], "next_line": chunk[-1][0] + 1},
+        )
+
+
+def worker_counts(limit):
+    counts = []
+    workers = 1
+    while workers < limit:
+        counts.append(workers)
+        workers *= 2
+    return counts + [limit]
+
+
+def main(data_path=DATA_PATH, max_workers=None):
+    records = list(islice(iter_jsonl(data_path), ABSTRACTS))
+    max_workers = max_workers or default_cpu_workers()
+    print(f"{len(records)} abstracts, {len(available_cores())} cores")
+    print(f"{'workers':>8} {'tokens/sec':>12} {'speedup':>9} {'per worker':>11}")
+
+    baseline = None
+    for workers in worker_counts(max_workers):
+        ef = ProcessPoolEmbedder(workers)
+        # One untimed shard per worker loads the model pages and warms the allocator.
+        warmup_dir = tempfile.mkdtemp()
+        ef.embed_to_store(ShardStore(warmup_dir), islice(shards(records), ef.workers))
+        shutil.rmtree(warmup_dir)
+        ef.reset_stats()
+
+        out_dir = tempfile.mkdtemp()
+        try:
+            ef.embed_to_store(ShardStore(out_dir), shards(records))
+        finally:
+            ef.close()
+            shutil.rmtree(out_dir)
+        rate = ef.tokens / ef.seconds
+        baseline = baseline or rate
+        print(f"{ef.workers:>8} {rate:>12.0f} {rate / baseline:>8.2f}x {rate / baseline / ef.workers:>10.0%}")
+
+
+if __name__ == "__main__":
+    # python benchIngest.py [data path] [max workers]
+    main(sys.argv[1] if len(sys.argv) > 1 else DATA_PATH, int(sys.argv[2]) if len(sys.argv) > 2 else None)
@@ -0,0 +1,120 @@
+import time
+import tracemalloc
+
+import numpy as np
+import scipy.sparse
+from pymilvus import FieldSchema, CollectionSchema, DataType
+from pymilvus.client.prepare import Prepare
+from pymilvus.orm.prepare import Prepare as OrmPrepare
+from pymilvus.orm.schema import check_insert_schema
+
+from milvusPayload import dense_rows, sparse_rows, sparse_rows_to_dicts
+
+
+# Shaped like BGE-M3 output: 1024-dim dense, ~100 non-zeros per abstract over the vocabulary.
+ROWS = 2000
+DENSE_DIM = 1024
+SPARSE_DIM = 250002
+SPARSE_NNZ = 100
+BATCH_SIZE = 500
+
+SCHEMA = CollectionSchema([
+    FieldSchema(name="id", dtype=DataType.VARCHAR, is_primary=True, max_length=64),
+    FieldSchema(name="dense_vector", dtype=DataType.FLOAT_VECTOR, dim=DENSE_DIM),
+    FieldSchema(name="sparse_vector", dtype=DataType.SPARSE_FLOAT_VECTOR),
+])
+
+
+def sparse_tensor_batch_to_list_of_dicts(tensor):
+    # The conversion milvusGPULoad.py used before milvusPayload.
+    tensor = tensor.tocoo()
+    results = [{} for _ in range(tensor.shape[0])]
+    for i, j, v in zip(tensor.row, tensor.col, tensor.data):
+        results[i][j] = float(v)
+    return results
+
+
+def previous_payload(dense, sparse, start, stop):
+    return (
+        [dense[idx].tolist() for idx in range(start, stop)],
+        sparse_tensor_batch_to_list_of_dicts(sparse[start:stop]),
+    )
+
+
+def dict_payload(dense, sparse, start, stop):
+    return dense_rows(dense, start, stop), sparse_rows_to_dicts(sparse, start, stop)
+
+
+def csr_payload(dense, sparse, start, stop):
+    return dense_rows(dense, start, stop), sparse_rows(sparse, start, stop)
+
+
+def build_request(ids, dense_batch, sparse_batch):
+    # What Collection.insert does client-side before the RPC, without a server.
+    data = [ids, dense_batch, sparse_batch]
+    check_insert_schema(SCHEMA, data)
+    entities = OrmPrepare.prepare_data(data, SCHEMA)
+    return Prepare.batch_insert_param("bench", entities, "", SCHEMA.to_dict()["fields"])
+
+
+def synthetic_embeddings(seed=0):
+    rng = np.random.default_rng(seed)
+    dense = rng.standard_normal((ROWS, DENSE_DIM), dtype=np.float32)
+    indices = np.sort(rng.choice(SPARSE_DIM, size=(ROWS, SPARSE_NNZ)), axis=1)
+    # Collapse duplicate term ids within a row the way BGE-M3 lexical weights are unique.
+    sparse = scipy.sparse.csr_matrix(
+        (rng.random(ROWS * SPARSE_NNZ), indices.ravel(), np.arange(0, ROWS * SPARSE_NNZ + 1, SPARSE_NNZ)),
+        shape=(ROWS, SPARSE_DIM),
+    )
+    sparse.sum_duplicates()
+    return dense, sparse
+
+
+def _convert_all(convert, dense, sparse, ids, with_request):
+    for start in range(0, ROWS, BATCH_SIZE):
+        stop = min(start + BATCH_SIZE, ROWS)
+        dense_batch, sparse_batch = convert(dense, sparse, start, stop)
+        if with_request:
+            build_request(ids[start:stop], dense_batch, sparse_batch)
+
+
+def run(convert, dense, sparse, with_request):
+    # Timed without tracemalloc, which slows allocation-heavy code several times over.
+    ids = [str(i) for i in range(ROWS)]
+    start_time = time.perf_counter()
+    _convert_all(convert, dense, sparse, ids, with_request)
+    elapsed = time.perf_counter() - start_time
+
+    tracemalloc.start()
+    _convert_all(convert, dense, sparse, ids, with_request)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak / (1024 * 1024)
+
+
+def main():
+    dense, sparse = synthetic_embeddings()
+
+    reference = previous_payload(dense, sparse, 0, BATCH_SIZE)
+    for convert in (dict_payload, csr_payload):
+        request = build_request([str(i) for i in range(BATCH_SIZE)], *convert(dense, sparse, 0, BATCH_SIZE))
+        expected = build_request([str(i) for i in range(BATCH_SIZE)], *reference)
+        if request.fields_data[1] != expected.fields_data[1] or (
+            list(request.fields_data[2].vectors.sparse_float_vector.contents)
+            != list(expected.fields_data[2].vectors.sparse_float_vector.contents)
+        ):
+            raise AssertionError(f"{convert.__name__} serializes differently from the previous payload")
+
+    print(f"{ROWS} rows, batches of {BATCH_SIZE}, dense dim {DENSE_DIM}, ~{SPARSE_NNZ} sparse non-zeros per row\n")
+    print(f"{'path':<18} {'convert s':>10} {'peak MB':>9} {'convert+request s':>18} {'peak MB':>9}")
+    for convert in (previous_payload, dict_payload, csr_payload):
+        convert_only = run(convert, dense, sparse, with_request=False)
+        with_request = run(convert, dense, sparse, with_request=True)
+        print(
+            f"{convert.__name__:<18} {convert_only[0]:>10.3f} {convert_only[1]:>9.1f} "
+            f"{with_request[0]:>18.3f} {with_request[1]:>9.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+import time
+from collections import deque
+from contextlib import contextmanager
+
+
+class PhaseTimer:
+    def __init__(self):
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name, rows=None):
+        # ``rows`` may be a callable, evaluated when the phase ends.
+        start = time.perf_counter()
+        yield
+        elapsed = time.perf_counter() - start
+        self.phases.append((name, elapsed, rows() if callable(rows) else rows))
+
+    def report(self):
+        print(f"{'phase':<16} {'seconds':>10} {'rows':>10} {'rows/sec':>12}")
+        for name, elapsed, rows in self.phases:
+            rate = f"{rows / elapsed:>12.1f}" if rows and elapsed > 0 else f"{'-':>12}"
+            print(f"{name:<16} {elapsed:>10.2f} {rows if rows is not None else '-':>10} {rate}")
+        print(f"{'total':<16} {sum(elapsed for _, elapsed, _ in self.phases):>10.2f}")
+
+
+class InsertPipeline:
+    """
+    Keeps up to ``max_inflight`` asynchronous insert RPCs outstanding, so the next
+    batch is serialized while earlier ones are still being written by Milvus.
+    ``on_done`` callbacks run in submission order once their RPC has completed.
+    """
+
+    def __init__(self, max_inflight=4):
+        self.max_inflight = max(1, max_inflight)
+        self.rows = 0
+        self._inflight = deque()
+
+    def submit(self, future, rows, on_done=None):
+        while len(self._inflight) >= self.max_inflight:
+            self._complete_oldest()
+        self._inflight.append((future, rows, on_done))
+
+    def after_pending(self, on_done):
+        # Runs on_done once everything submitted so far has completed.
+        if self._inflight:
+            future, rows, previous = self._inflight.pop()
+
+            def chained():
+                if previous is not None:
+                    previous()
+                on_done()
+
+            self._inflight.append((future, rows, chained))
+        else:
+            on_done()
+
+    def _complete_oldest(self):
+        future, rows, on_done = self._inflight.popleft()
+        future.result()
+        self.rows += rows
+        if on_done is not None:
+            on_done()
+
+    def drain(self):
+        while self._inflight:
+            self._complete_oldest()
+        return self.rows
+
+
+def build_indexes(collection):
+    # Done once after the bulk insert instead of after every batch.
+    collection.flush()
+
+    collection.create_index(
+        field_name="sparse_vector",
+        index_params={
+            "index_type": "SPARSE_INVERTED_INDEX",
+            "metric_type": "IP"
+        }
+    )
+
+    collection.create_index(
+        field_name="dense_vector",
+        index_params={
+            "index_type": "AUTOINDEX",
+            "metric_type": "COSINE"
+        }
+    )
+
+    collection.load()
@@ -0,0 +1,201 @@
+import json
+import os
+import sys
+
+import numpy as np
+import scipy.sparse
+
+
+# Layout of a compact store directory (raw arrays, opened with np.memmap so
+# every worker process shares the same pages):
+#   header.json            format version, row count, dims, dtypes, paper ids in row order
+#   dense.bin              [rows, dense_dim] L2-normalized vectors as float32, float16 or int8
+#   scales.bin             float32 [rows]; int8 only, row i is dense[i] * scales[i]
+#   sparse_*.bin           row-major CSR (indptr, indices, data), optionally pruned to the
+#                          sparse_top_n largest weights per row
+#   postings_*.bin         the same weights term-major, i.e. the inverted index
+FORMAT_VERSION = 1
+DENSE_DTYPES = ["float32", "float16", "int8"]
+HEADER = "header.json"
+# Sparse index arrays are int32, which scipy uses without copying.
+INDEX_DTYPE = np.int32
+
+
+def quantize_dense(dense, dense_dtype):
+    # Returns (values, per-row scales or None) for L2-normalized rows.
+    dense = np.asarray(dense, dtype=np.float32)
+    norms = np.linalg.norm(dense, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    dense = dense / norms
+    if dense_dtype != "int8":
+        return dense.astype(dense_dtype), None
+    scales = np.abs(dense).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    return np.rint(dense / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+
+
+def prune_sparse(sparse, top_n):
+    # Keeps the top_n largest weights of every row.
+    sparse = scipy.sparse.csr_matrix(sparse)
+    sparse.sum_duplicates()
+    if top_n is None:
+        return sparse
+    rows = np.repeat(np.arange(sparse.shape[0]), np.diff(sparse.indptr))
+    # Rank of each weight within its row, largest first.
+    order = np.lexsort((-sparse.data, rows))
+    rank = np.arange(len(order)) - sparse.indptr[rows[order]]
+    keep = np.sort(order[rank < top_n])
+    pruned = scipy.sparse.csr_matrix(
+        (sparse.data[keep], (rows[keep], sparse.indices[keep])), shape=sparse.shape
+    )
+    pruned.sort_indices()
+    return pruned
+
+
+def _write_array(path, values, dtype):
+    values = np.ascontiguousarray(values, dtype=dtype)
+    out = np.memmap(path, dtype=dtype, mode="w+", shape=values.shape) if values.size else None
+    if out is not None:
+        out[...] = values
+        out.flush()
+        del out
+    else:
+        open(path, "wb").close()
+
+
+def _write_csr(tmp_dir, prefix, matrix):
+    if matrix.nnz >= np.iinfo(INDEX_DTYPE).max:
+        raise ValueError(f"{prefix} has {matrix.nnz} non-zeros, more than int32 indices allow")
+    _write_array(os.path.join(tmp_dir, f"{prefix}_indptr.bin"), matrix.indptr, INDEX_DTYPE)
+    _write_array(os.path.join(tmp_dir, f"{prefix}_indices.bin"), matrix.indices, INDEX_DTYPE)
+    _write_array(os.path.join(tmp_dir, f"{prefix}_data.bin"), matrix.data, np.float32)
+
+
+def write_compact_store(out_dir, ids, dense, sparse, dense_dtype="float16", sparse_top_n=None, block=8192):
+    if dense_dtype not in DENSE_DTYPES:
+        raise ValueError(f"dense_dtype must be one of {DENSE_DTYPES}, got '{dense_dtype}'")
+    rows, dense_dim = dense.shape
+    if not (len(ids) == rows == sparse.shape[0]):
+        raise ValueError(f"{len(ids)} ids for {rows} dense / {sparse.shape[0]} sparse rows")
+
+    tmp_dir = out_dir + ".tmp"
+    os.makedirs(tmp_dir, exist_ok=True)
+
+    # Quantized in blocks so a memory-mapped dense.npy never has to fit in RAM.
+    dense_out = np.memmap(os.path.join(tmp_dir, "dense.bin"), dtype=dense_dtype, mode="w+", shape=(rows, dense_dim))
+    scales = np.ones(rows, dtype=np.float32)
+    for start in range(0, rows, block):
+        values, block_scales = quantize_dense(dense[start:start + block], dense_dtype)
+        dense_out[start:start + block] = values
+        if block_scales is not None:
+            scales[start:start + block] = block_scales
+    dense_out.flush()
+    del dense_out
+    files = ["dense.bin"]
+    if dense_dtype == "int8":
+        _write_array(os.path.join(tmp_dir, "scales.bin"), scales, np.float32)
+        files.append("scales.bin")
+
+    sparse = prune_sparse(sparse, sparse_top_n)
+    postings = sparse.T.tocsr()
+    postings.sort_indices()
+    _write_csr(tmp_dir, "sparse", sparse)
+    _write_csr(tmp_dir, "postings", postings)
+    files += [f"{prefix}_{part}.bin" for prefix in ("sparse", "postings") for part in ("indptr", "indices", "data")]
+
+    header = {
+        "version": FORMAT_VERSION,
+        "rows": rows,
+        "dense_dim": dense_dim,
+        "dense_dtype": dense_dtype,
+        "sparse_dim": sparse.shape[1],
+        "sparse_nnz": int(sparse.nnz),
+        "sparse_top_n": sparse_top_n,
+        "ids": [str(paper_id) for paper_id in ids],
+    }
+    with open(os.path.join(tmp_dir, HEADER), "w", encoding="utf-8") as f:
+        json.dump(header, f)
+
+    # The header goes last, so a reader never sees it before the arrays it describes.
+    os.makedirs(out_dir, exist_ok=True)
+    for name in files + [HEADER]:
+        os.replace(os.path.join(tmp_dir, name), os.path.join(out_dir, name))
+    os.rmdir(tmp_dir)
+
+
+class CompactStore:
+    """
+    Read-only, memory-mapped view of a store written by ``write_compact_store``.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, HEADER), "r", encoding="utf-8") as f:
+            self.header = json.load(f)
+        if self.header["version"] != FORMAT_VERSION:
+            raise ValueError(f"{path} has format version {self.header['version']}, expected {FORMAT_VERSION}")
+        self.ids = self.header["ids"]
+        self.rows = {paper_id: row for row, paper_id in enumerate(self.ids)}
+
+        rows = self.header["rows"]
+        self.dense = self._map("dense.bin", self.header["dense_dtype"], (rows, self.header["dense_dim"]))
+        self.scales = self._map("scales.bin", np.float32, (rows,)) if self.header["dense_dtype"] == "int8" else None
+        self.sparse = self._map_csr("sparse", (rows, self.header["sparse_dim"]))
+        self.postings = self._map_csr("postings", (self.header["sparse_dim"], rows))
+
+    @classmethod
+    def open(cls, path):
+        if os.path.exists(os.path.join(path, HEADER)):
+            return cls(path)
+        return None
+
+    def __len__(self):
+        return self.header["rows"]
+
+    def _map(self, name, dtype, shape):
+        if not np.prod(shape):
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(os.path.join(self.path, name), dtype=dtype, mode="r", shape=shape)
+
+    def _map_csr(self, prefix, shape):
+        nnz = self.header["sparse_nnz"]
+        indptr = self._map(f"{prefix}_indptr.bin", INDEX_DTYPE, (shape[0] + 1,))
+        indices = self._map(f"{prefix}_indices.bin", INDEX_DTYPE, (nnz,))
+        data = self._map(f"{prefix}_data.bin", np.float32, (nnz,))
+        return scipy.sparse.csr_matrix((data, indices, indptr), shape=shape, copy=False)
+
+    def dense_rows(self, start, stop):
+        # Dequantized float32 rows, e.g. to insert them into Milvus.
+        rows = self.dense[start:stop].astype(np.float32)
+        if self.scales is not None:
+            rows *= self.scales[start:stop, None]
+        return rows
+
+
+def compact_saved_embeddings(save_dir, data_paths, out_dir, dense_dtype="float16", sparse_top_n=None):
+    # Converts the dense.npy / sparse.npz pair written at ingest, whose rows
+    # follow the order of the JSONL files they were embedded from.
+    data_paths = [data_paths] if isinstance(data_paths, str) else list(data_paths)
+    ids = []
+    for path in data_paths:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    ids.append(json.loads(line).get("id", "").strip())
+    dense = np.load(os.path.join(save_dir, "dense.npy"), mmap_mode="r")
+    sparse = scipy.sparse.load_npz(os.path.join(save_dir, "sparse.npz"))
+    write_compact_store(out_dir, ids, dense, sparse, dense_dtype, sparse_top_n)
+
+
+if __name__ == "__main__":
+    # python compactStore.py [float16|int8|float32] [sparse top-n]
+    from config import CORPUS_VERSION_PATH, LOCAL_DATA_PATH, LOCAL_EMBEDDINGS_DIR
+    from resultCache import bump_corpus_version
+
+    dtype = sys.argv[1] if len(sys.argv) > 1 else "float16"
+    top_n = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    out = os.path.join(LOCAL_EMBEDDINGS_DIR, f"compact_{dtype}" + (f"_top{top_n}" if top_n else ""))
+    compact_saved_embeddings(LOCAL_EMBEDDINGS_DIR, LOCAL_DATA_PATH, out, dtype, top_n)
+    # A server already reading this store drops its cached /search responses.
+    bump_corpus_version(CORPUS_VERSION_PATH, store=out)
+    print(f"Wrote {out}")
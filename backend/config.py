@@ -0,0 +1,106 @@
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# ==== Query embedding ====
+# "torch" runs BGEM3EmbeddingFunction; "onnx" runs the graph exported by
+# onnxEncoder.py from ONNX_MODEL_DIR (model_int8.onnx: int8 weights, model.onnx: float32).
+QUERY_ENCODER = os.getenv("QUERY_ENCODER", "torch")
+ONNX_MODEL_DIR = os.getenv("ONNX_MODEL_DIR", "./models/bge-m3-onnx")
+ONNX_MODEL_FILE = os.getenv("ONNX_MODEL_FILE", "model_int8.onnx")
+# onnxruntime intra-op threads; 0 lets it use every core.
+ONNX_THREADS = int(os.getenv("ONNX_THREADS", "0"))
+
+# Concurrent /search and /compare queries are collected for up to
+# EMBED_MAX_WAIT_MS and encoded together, at most EMBED_BATCH_SIZE at a time.
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "16"))
+EMBED_MAX_WAIT_MS = float(os.getenv("EMBED_MAX_WAIT_MS", "5"))
+
+# In-memory LRU of query embeddings, plus an optional sqlite file that
+# keeps them across restarts (disabled when EMBED_CACHE_PATH is empty).
+EMBED_CACHE_MB = float(os.getenv("EMBED_CACHE_MB", "64"))
+EMBED_CACHE_PATH = os.getenv("EMBED_CACHE_PATH", "")
+EMBED_CACHE_DISK_MB = float(os.getenv("EMBED_CACHE_DISK_MB", "512"))
+EMBED_CACHE_NAMESPACE = os.getenv("EMBED_CACHE_NAMESPACE", "bge-m3")
+
+# ==== Request path ====
+# Threads for tokenization and highlighting in the async /search and /compare handlers.
+SEARCH_EXECUTOR_WORKERS = int(os.getenv("SEARCH_EXECUTOR_WORKERS", "4"))
+
+# Serialized /search responses, reused for the same normalized query and settings
+# until RESULT_CACHE_TTL seconds pass (0: no expiry) or an ingest bumps the
+# stamp at CORPUS_VERSION_PATH. RESULT_CACHE_PATH adds a sqlite file that
+# workers on the same host share. Disabled when RESULT_CACHE_MB is 0 and no path is set.
+RESULT_CACHE_MB = float(os.getenv("RESULT_CACHE_MB", "32"))
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", "3600"))
+RESULT_CACHE_PATH = os.getenv("RESULT_CACHE_PATH", "")
+RESULT_CACHE_DISK_MB = float(os.getenv("RESULT_CACHE_DISK_MB", "256"))
+CORPUS_VERSION_PATH = os.getenv("CORPUS_VERSION_PATH", "./saved_embeddings/corpus_version.json")
+
+# ==== Telemetry ====
+# p50/p95/p99 on /metrics and /stats/latency are taken over the latest
+# TELEMETRY_WINDOW samples of each stage.
+TELEMETRY_WINDOW = int(os.getenv("TELEMETRY_WINDOW", "2048"))
+# Write one JSON line per request (trace id, route, status, stage timings) to
+# the "researchy.trace" logger.
+TRACE_LOG = os.getenv("TRACE_LOG", "0") == "1"
+
+# ==== Logging ====
+# Log records are queued (at most LOG_QUEUE_SIZE, then dropped) and written by a
+# background thread. RESULT_LOG_SAMPLE_RATE of /search requests get their full
+# results dumped to stderr; QUERY_LOG_PATH, when set, receives every query with its
+# settings and ranked ids as JSONL, rotated at QUERY_LOG_MAX_MB.
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+RESULT_LOG_SAMPLE_RATE = float(os.getenv("RESULT_LOG_SAMPLE_RATE", "0"))
+QUERY_LOG_PATH = os.getenv("QUERY_LOG_PATH", "")
+QUERY_LOG_MAX_MB = float(os.getenv("QUERY_LOG_MAX_MB", "64"))
+QUERY_LOG_BACKUPS = int(os.getenv("QUERY_LOG_BACKUPS", "5"))
+
+# ==== Startup ====
+# When the encoder, collection and caches are built: "background" starts loading
+# them as the server comes up and reports readiness on /health/ready, "blocking"
+# finishes before the server accepts requests, "lazy" waits for the first request.
+RESOURCE_LOADING = os.getenv("RESOURCE_LOADING", "background")
+# Build the model and memory-mapped arrays at import, before a pre-forking
+# server (gunicorn --preload) forks its workers, so they share those pages.
+PRELOAD_RESOURCES = os.getenv("PRELOAD_RESOURCES", "0") == "1"
+# Run one query end to end after loading, before reporting ready.
+WARMUP_ON_LOAD = os.getenv("WARMUP_ON_LOAD", "1") == "1"
+
+# ==== Retrieval backend ====
+# "milvus" queries the remote collection; "local" serves the same hybrid search
+# in-process from the ingest JSONL and saved_embeddings/ (dense.npy, sparse.npz).
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "milvus")
+LOCAL_DATA_PATH = os.getenv("LOCAL_DATA_PATH", "./data/data_ai_cl.jsonl")
+LOCAL_EMBEDDINGS_DIR = os.getenv("LOCAL_EMBEDDINGS_DIR", "./saved_embeddings")
+LOCAL_DENSE_DTYPE = os.getenv("LOCAL_DENSE_DTYPE", "float32")
+# Local collections up to this many papers are searched on the event loop;
+# larger ones on the request executor, so a search never stalls other requests.
+LOCAL_INLINE_SEARCH_ROWS = int(os.getenv("LOCAL_INLINE_SEARCH_ROWS", "4096"))
+
+# ==== Fusion ====
+# Each search leg returns FUSION_CANDIDATE_FACTOR * top_k candidates before fusion.
+FUSION_CANDIDATE_FACTOR = int(os.getenv("FUSION_CANDIDATE_FACTOR", "4"))
+
+# Per-paper token ids and offsets written by milvusGPULoad.py, used to skip
+# tokenizing abstracts when highlighting.
+TOKEN_STORE_DIR = os.getenv("TOKEN_STORE_DIR", "./saved_embeddings/tokens")
+
+# ==== Corpus embedding ====
+# milvusGPULoad.py / constructTestSet.py sort abstracts by token length and
+# embed them in batches of at most CORPUS_EMBED_MAX_BATCH texts whose padded
+# size (texts * longest text) stays within CORPUS_EMBED_MAX_TOKENS.
+CORPUS_EMBED_MAX_TOKENS = int(os.getenv("CORPUS_EMBED_MAX_TOKENS", "16384"))
+CORPUS_EMBED_MAX_BATCH = int(os.getenv("CORPUS_EMBED_MAX_BATCH", "64"))
+CORPUS_EMBED_MAX_LENGTH = int(os.getenv("CORPUS_EMBED_MAX_LENGTH", "8192"))
+# Without a GPU, this many worker processes embed shards, each pinned to its own
+# cores; 0 uses one per four cores, as many as fit in free memory.
+CORPUS_EMBED_CPU_WORKERS = int(os.getenv("CORPUS_EMBED_CPU_WORKERS", "0"))
+
+# ==== Corpus harvesting ====
+# arXiv asks API clients for at most one request every three seconds.
+ARXIV_API_URL = os.getenv("ARXIV_API_URL", "http://export.arxiv.org/api/query")
+HARVEST_RATE = float(os.getenv("HARVEST_RATE", str(1 / 3)))
+HARVEST_WORKERS = int(os.getenv("HARVEST_WORKERS", "4"))
+HARVEST_MAX_RETRIES = int(os.getenv("HARVEST_MAX_RETRIES", "5"))
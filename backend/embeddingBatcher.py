@@ -0,0 +1,121 @@
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+
+import scipy.sparse
+
+
+QUEUE_DEPTH_BUCKETS = [0, 1, 2, 4, 8, 16, 32, 64, 128]
+
+
+def _bucket(value, buckets=QUEUE_DEPTH_BUCKETS):
+    for bound in buckets:
+        if value <= bound:
+            return str(bound)
+    return f"{buckets[-1]}+"
+
+
+class EmbeddingBatcher:
+    """
+    Collects queries submitted from concurrent request threads for a few
+    milliseconds and runs them through the embedding function as one batch.
+
+    Exposes the same ``__call__(texts)`` and ``.model`` interface as
+    ``BGEM3EmbeddingFunction`` so it can be passed wherever ``ef`` is.
+    """
+
+    def __init__(self, ef, max_batch_size=16, max_wait_ms=5.0):
+        self.ef = ef
+        self.model = ef.model
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._batch_sizes = Counter()
+        self._queue_depths = dict.fromkeys(
+            [str(bound) for bound in QUEUE_DEPTH_BUCKETS] + [f"{QUEUE_DEPTH_BUCKETS[-1]}+"], 0
+        )
+        self._batches = 0
+        self._queries = 0
+
+        self._thread = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, text):
+        future = Future()
+        self._queue.put((text, future))
+        return future
+
+    def __call__(self, texts):
+        futures = [self.submit(text) for text in texts]
+        rows = [future.result() for future in futures]
+        return {
+            "dense": [dense for dense, _ in rows],
+            "sparse": scipy.sparse.vstack([sparse for _, sparse in rows], format="csr"),
+        }
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "max_batch_size": self.max_batch_size,
+                "max_wait_ms": self.max_wait * 1000.0,
+                "queue_depth": self._queue.qsize(),
+                "batches": self._batches,
+                "queries": self._queries,
+                "batch_size_histogram": {str(k): v for k, v in sorted(self._batch_sizes.items())},
+                "queue_depth_histogram": dict(self._queue_depths),
+            }
+
+    def _collect(self, first):
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                # Re-queue the sentinel so the run loop stops after this batch.
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch = self._collect(first)
+            depth = self._queue.qsize()
+
+            # Requests whose callers already gave up are dropped before encoding.
+            batch = [(text, future) for text, future in batch if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            with self._lock:
+                self._batches += 1
+                self._queries += len(batch)
+                self._batch_sizes[len(batch)] += 1
+                self._queue_depths[_bucket(depth)] += 1
+
+            try:
+                output = self.ef([text for text, _ in batch])
+            except BaseException as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            dense = output["dense"]
+            sparse = output["sparse"]
+            for idx, (_, future) in enumerate(batch):
+                future.set_result((dense[idx], sparse[[idx]]))
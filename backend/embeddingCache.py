@@ -0,0 +1,269 @@
+import asyncio
+import hashlib
+import sqlite3
+import threading
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import scipy.sparse
+
+
+def normalize_query(text):
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def query_key(text, namespace=""):
+    return hashlib.sha256(f"{namespace}\0{normalize_query(text)}".encode("utf-8")).hexdigest()
+
+
+def _entry_nbytes(dense, sparse_row):
+    return dense.nbytes + sparse_row.data.nbytes + sparse_row.indices.nbytes + sparse_row.indptr.nbytes
+
+
+class _DiskTier:
+    def __init__(self, path, max_bytes):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " key TEXT PRIMARY KEY,"
+            " dense BLOB, dense_dtype TEXT,"
+            " sparse_indices BLOB, sparse_data BLOB, sparse_dtype TEXT, sparse_dim INTEGER,"
+            " nbytes INTEGER, accessed INTEGER)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_accessed ON embeddings (accessed)")
+        self._conn.commit()
+        self._clock = self._conn.execute("SELECT COALESCE(MAX(accessed), 0) FROM embeddings").fetchone()[0]
+        self._total = self._conn.execute("SELECT COALESCE(SUM(nbytes), 0) FROM embeddings").fetchone()[0]
+        # Recency of disk hits, written with the next put instead of a commit per read.
+        self._touched = {}
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT dense, dense_dtype, sparse_indices, sparse_data, sparse_dtype, sparse_dim"
+                " FROM embeddings WHERE key = ?",
+                (key,),
+            ).fetchone()
+            if row is None:
+                return None
+            self._clock += 1
+            self._touched[key] = self._clock
+
+        dense_blob, dense_dtype, indices_blob, data_blob, sparse_dtype, sparse_dim = row
+        dense = np.frombuffer(dense_blob, dtype=dense_dtype).copy()
+        indices = np.frombuffer(indices_blob, dtype=np.int32).copy()
+        data = np.frombuffer(data_blob, dtype=sparse_dtype).copy()
+        sparse_row = scipy.sparse.csr_array((data, indices, np.array([0, len(indices)])), shape=(1, sparse_dim))
+        return dense, sparse_row
+
+    def put(self, key, dense, sparse_row):
+        nbytes = _entry_nbytes(dense, sparse_row)
+        if nbytes > self.max_bytes:
+            return 0
+        with self._lock:
+            return self._put(key, dense, sparse_row, nbytes)
+
+    def _flush_touched(self):
+        if self._touched:
+            self._conn.executemany(
+                "UPDATE embeddings SET accessed = ? WHERE key = ?",
+                [(accessed, key) for key, accessed in self._touched.items()],
+            )
+            self._touched.clear()
+
+    def _put(self, key, dense, sparse_row, nbytes):
+        # Eviction below goes by recency, so hits since the last put count.
+        self._flush_touched()
+        self._clock += 1
+        old = self._conn.execute("SELECT nbytes FROM embeddings WHERE key = ?", (key,)).fetchone()
+        self._conn.execute(
+            "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                key,
+                dense.tobytes(), dense.dtype.str,
+                sparse_row.indices.astype(np.int32).tobytes(), sparse_row.data.tobytes(),
+                sparse_row.data.dtype.str, sparse_row.shape[1],
+                nbytes, self._clock,
+            ),
+        )
+        self._total += nbytes - (old[0] if old else 0)
+
+        evicted = 0
+        while self._total > self.max_bytes:
+            oldest = self._conn.execute(
+                "SELECT key, nbytes FROM embeddings ORDER BY accessed LIMIT 1"
+            ).fetchone()
+            self._conn.execute("DELETE FROM embeddings WHERE key = ?", (oldest[0],))
+            self._total -= oldest[1]
+            evicted += 1
+        self._conn.commit()
+        return evicted
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._flush_touched()
+            self._conn.commit()
+            self._conn.close()
+
+
+class EmbeddingCache:
+    """
+    Two-tier cache of query embeddings keyed by a hash of the normalized query text:
+    an in-memory LRU bounded by ``max_mb`` and an optional sqlite file that
+    survives restarts, bounded by ``disk_max_mb``. Writes to the file go through
+    a background thread; ``get_async`` reads it there too, so only the
+    in-memory lookup runs on the event loop.
+    """
+
+    def __init__(self, max_mb=64, path=None, disk_max_mb=512, namespace=""):
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.namespace = namespace
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._disk = _DiskTier(path, int(disk_max_mb * 1024 * 1024)) if path else None
+        self._disk_io = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embedding-cache") if path else None
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+
+    def get(self, text):
+        key = query_key(text, self.namespace)
+        entry = self._get_memory(key)
+        if entry is None and self._disk is not None:
+            entry = self._get_disk(key)
+        return self._count(entry)
+
+    async def get_async(self, text):
+        key = query_key(text, self.namespace)
+        entry = self._get_memory(key)
+        if entry is None and self._disk is not None:
+            entry = await asyncio.wrap_future(self._disk_io.submit(self._get_disk, key))
+        return self._count(entry)
+
+    def _get_memory(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            return entry
+
+    def _get_disk(self, key):
+        entry = self._disk.get(key)
+        if entry is not None:
+            with self._lock:
+                self.disk_hits += 1
+                self._put_memory(key, entry)
+        return entry
+
+    def _count(self, entry):
+        if entry is None:
+            with self._lock:
+                self.misses += 1
+        return entry
+
+    def put(self, text, dense, sparse_row):
+        key = query_key(text, self.namespace)
+        entry = (np.asarray(dense), sparse_row)
+        with self._lock:
+            self._put_memory(key, entry)
+        if self._disk is not None:
+            self._disk_io.submit(self._put_disk, key, entry)
+
+    def _put_disk(self, key, entry):
+        evicted = self._disk.put(key, *entry)
+        with self._lock:
+            self.disk_evictions += evicted
+
+    def _put_memory(self, key, entry):
+        nbytes = _entry_nbytes(*entry)
+        if nbytes > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= _entry_nbytes(*old)
+        self._entries[key] = entry
+        self._bytes += nbytes
+        while self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= _entry_nbytes(*evicted)
+            self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "size_mb": self._bytes / (1024 * 1024),
+                "max_mb": self.max_bytes / (1024 * 1024),
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+                "disk_entries": len(self._disk) if self._disk is not None else 0,
+                "disk_evictions": self.disk_evictions,
+            }
+
+    def close(self):
+        if self._disk is not None:
+            self._disk_io.shutdown(wait=True)
+            self._disk.close()
+
+
+class CachedEmbeddingFunction:
+    """
+    Wraps an embedding function (``BGEM3EmbeddingFunction`` or ``EmbeddingBatcher``)
+    so that only texts missing from the cache reach the model.
+    """
+
+    def __init__(self, ef, cache):
+        self.ef = ef
+        self.model = ef.model
+        self.cache = cache
+
+    async def embed_async(self, text):
+        """
+        Embeds a single query without blocking the event loop. Requires the wrapped
+        function to be an ``EmbeddingBatcher``; cancelling the await withdraws the
+        query from the batcher if its batch has not started yet.
+        """
+        text = normalize_query(text)
+        row = await self.cache.get_async(text)
+        if row is None:
+            row = await asyncio.wrap_future(self.ef.submit(text))
+            self.cache.put(text, *row)
+        return row
+
+    def __call__(self, texts):
+        texts = [normalize_query(text) for text in texts]
+        rows = [self.cache.get(text) for text in texts]
+
+        # Encode each distinct missing text once, even if it repeats within the call.
+        missing = list(dict.fromkeys(text for text, row in zip(texts, rows) if row is None))
+        if missing:
+            output = self.ef(missing)
+            encoded = {}
+            for pos, text in enumerate(missing):
+                encoded[text] = (output["dense"][pos], output["sparse"][[pos]])
+                self.cache.put(text, *encoded[text])
+            rows = [row if row is not None else encoded[text] for text, row in zip(texts, rows)]
+
+        return {
+            "dense": [dense for dense, _ in rows],
+            "sparse": scipy.sparse.vstack([sparse for _, sparse in rows], format="csr"),
+        }
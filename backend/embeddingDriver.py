@@ -0,0 +1,298 @@
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
+
+import numpy as np
+import scipy.sparse
+
+from config import (
+    CORPUS_EMBED_MAX_TOKENS, CORPUS_EMBED_MAX_BATCH, CORPUS_EMBED_MAX_LENGTH, CORPUS_EMBED_CPU_WORKERS,
+)
+
+
+MODEL_NAME = "BAAI/bge-m3"
+# Resident size of one CPU worker: float32 BGE-M3 plus activations of a full batch.
+WORKER_MEMORY_BYTES = 4 * 1024 ** 3
+
+
+def plan_batches(lengths, max_tokens, max_batch_size):
+    """
+    Groups text indices longest first, so each batch holds texts of similar
+    length and its padded size (rows * longest row) stays within max_tokens.
+    A text longer than max_tokens gets a batch of its own.
+    """
+    lengths = np.asarray(lengths)
+    batches = []
+    current = []
+    for idx in np.argsort(-lengths, kind="stable"):
+        # Descending order: the first text of a batch is its longest.
+        if current and ((len(current) + 1) * lengths[current[0]] > max_tokens or len(current) >= max_batch_size):
+            batches.append(current)
+            current = []
+        current.append(int(idx))
+    if current:
+        batches.append(current)
+    return batches
+
+
+class _TokenizerHolder:
+    # ``.model.tokenizer`` as on BGEM3EmbeddingFunction, for the token store.
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+
+
+class BucketedEmbedder:
+    """
+    Wraps an embedding function for bulk corpus encoding: ``__call__(texts)``
+    sorts the texts into length buckets, encodes them in token-budgeted
+    batches and returns ``{"dense", "sparse"}`` in the original order, as
+    ``ef(texts)`` would. Throughput is tracked across calls.
+    """
+
+    def __init__(self, ef, max_tokens=CORPUS_EMBED_MAX_TOKENS, max_batch_size=CORPUS_EMBED_MAX_BATCH,
+                 max_length=CORPUS_EMBED_MAX_LENGTH):
+        self.ef = ef
+        self.model = ef.model
+        self.dim = ef.dim
+        self.max_tokens = max_tokens
+        self.max_batch_size = max_batch_size
+        self.max_length = max_length
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.texts = 0
+        self.tokens = 0
+        self.padded_tokens = 0
+        self.unsorted_padded_tokens = 0
+        self.seconds = 0.0
+
+    def token_lengths(self, texts):
+        encoded = self.model.tokenizer(texts, truncation=True, max_length=self.max_length)
+        return np.asarray([len(ids) for ids in encoded["input_ids"]], dtype=np.int64)
+
+    def _run_batches(self, texts, batches):
+        for batch in batches:
+            yield batch, self.ef([texts[idx] for idx in batch])
+
+    def __call__(self, texts):
+        texts = list(texts)
+        if not texts:
+            return {"dense": [], "sparse": scipy.sparse.csr_matrix((0, self.dim["sparse"]), dtype=np.float32)}
+        start = time.perf_counter()
+        lengths = self.token_lengths(texts)
+        batches = plan_batches(lengths, self.max_tokens, self.max_batch_size)
+
+        dense = [None] * len(texts)
+        sparse_parts = []
+        positions = []
+        for batch, output in self._run_batches(texts, batches):
+            for idx, vector in zip(batch, output["dense"]):
+                dense[idx] = vector
+            sparse_parts.append(scipy.sparse.csr_matrix(output["sparse"]))
+            positions.extend(batch)
+        sparse = scipy.sparse.vstack(sparse_parts, format="csr")[np.argsort(positions, kind="stable")]
+
+        self.seconds += time.perf_counter() - start
+        self.texts += len(texts)
+        self.tokens += int(lengths.sum())
+        self.padded_tokens += sum(len(batch) * int(lengths[batch[0]]) for batch in batches)
+        self.unsorted_padded_tokens += sum(
+            len(chunk) * int(chunk.max()) for chunk in np.array_split(lengths, range(
+                self.max_batch_size, len(lengths), self.max_batch_size))
+        )
+        return {"dense": dense, "sparse": sparse}
+
+    def stats(self):
+        return {
+            "texts": self.texts,
+            "tokens": self.tokens,
+            "padded_tokens": self.padded_tokens,
+            "unsorted_padded_tokens": self.unsorted_padded_tokens,
+        }
+
+    def add_stats(self, stats):
+        for key, value in stats.items():
+            setattr(self, key, getattr(self, key) + value)
+
+    def embed_to_store(self, store, shards):
+        # ``shards`` yields (ids, texts, keyword arguments of store.append).
+        committed = 0
+        for ids, texts, append_args in shards:
+            output = self(texts)
+            store.append(ids, output["dense"], output["sparse"], **append_args)
+            committed += 1
+        return committed
+
+    def report(self):
+        rate = self.tokens / self.seconds if self.seconds else 0.0
+        efficiency = self.tokens / self.padded_tokens if self.padded_tokens else 1.0
+        unsorted = self.tokens / self.unsorted_padded_tokens if self.unsorted_padded_tokens else 1.0
+        return (
+            f"{self.texts} texts, {self.tokens} tokens in {self.seconds:.1f}s: {rate:.0f} tokens/sec; "
+            f"{efficiency:.0%} of batch tokens are real (file order at batch {self.max_batch_size}: {unsorted:.0%})"
+        )
+
+    def close(self):
+        pass
+
+
+_worker_ef = None
+_worker_embedder = None
+
+
+def available_cores():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def core_groups(workers, cores=None):
+    # Splits the cores into ``workers`` contiguous, disjoint groups.
+    cores = available_cores() if cores is None else list(cores)
+    return [[int(core) for core in group] for group in np.array_split(cores, min(workers, len(cores)))]
+
+
+def _init_worker(groups, default_threads, max_batch_size, batching):
+    global _worker_ef, _worker_embedder
+    import queue
+    import torch
+    from pymilvus.model.hybrid import BGEM3EmbeddingFunction
+
+    # Each worker takes one group; a replacement for a crashed worker finds
+    # the queue empty and runs unpinned.
+    try:
+        cores = groups.get(timeout=1)
+    except queue.Empty:
+        cores = None
+    if cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    threads = len(cores) if cores else default_threads
+    # Also caps the OpenMP / MKL pools, which otherwise start one thread per core.
+    torch.set_num_threads(threads)
+    _worker_ef = BGEM3EmbeddingFunction(device="cpu", use_fp16=False, batch_size=max_batch_size)
+    _worker_embedder = BucketedEmbedder(_worker_ef, **batching)
+
+
+def _worker_embed(texts):
+    output = _worker_ef(texts)
+    return {"dense": list(np.asarray(output["dense"], dtype=np.float32)), "sparse": output["sparse"]}
+
+
+def _worker_embed_shard(root, name, texts):
+    # Writes the shard itself, so only counters travel back to the parent.
+    from shardStore import write_shard_files
+
+    before = _worker_embedder.stats()
+    output = _worker_embedder(texts)
+    write_shard_files(root, name, output["dense"], output["sparse"])
+    return {key: value - before[key] for key, value in _worker_embedder.stats().items()}
+
+
+def _worker_dim():
+    return _worker_ef.dim
+
+
+class ProcessPoolEmbedder(BucketedEmbedder):
+    """
+    CPU fallback: one BGE-M3 instance per worker process, each pinned to its
+    own group of cores with torch threads to match. ``__call__`` spreads the
+    batches of one call over the workers; ``embed_to_store`` gives each
+    worker whole shards, which it embeds and writes itself.
+    """
+
+    def __init__(self, workers=None, model_name=MODEL_NAME, **batching):
+        from transformers import AutoTokenizer
+
+        groups = core_groups(workers or default_cpu_workers())
+        self.workers = len(groups)
+        max_batch_size = batching.get("max_batch_size", CORPUS_EMBED_MAX_BATCH)
+        # spawn: forking a process that has touched torch can deadlock its thread pools.
+        context = get_context("spawn")
+        group_queue = context.Queue()
+        for group in groups:
+            group_queue.put(group)
+        self.pool = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=context,
+            initializer=_init_worker,
+            initargs=(group_queue, min(len(group) for group in groups), max_batch_size, batching),
+        )
+        print(f"{self.workers} embedding workers on cores {groups}")
+
+        class _PoolEf:
+            model = _TokenizerHolder(AutoTokenizer.from_pretrained(model_name))
+            dim = self.pool.submit(_worker_dim).result()
+
+        super().__init__(_PoolEf(), **batching)
+
+    def _run_batches(self, texts, batches):
+        futures = {
+            self.pool.submit(_worker_embed, [texts[idx] for idx in batch]): batch for batch in batches
+        }
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+    def embed_to_store(self, store, shards):
+        # Shards are committed in submission order, which keeps the manifest
+        # in JSONL order; two per worker are queued so none sits idle.
+        start = time.perf_counter()
+        inflight = deque()
+        committed = 0
+
+        def commit_oldest():
+            future, staged, ids, append_args = inflight.popleft()
+            self.add_stats(future.result())
+            store.append_staged(staged, ids, **append_args)
+
+        try:
+            for ids, texts, append_args in shards:
+                staged = store.staged_name(append_args["first_line"])
+                future = self.pool.submit(_worker_embed_shard, store.root, staged, texts)
+                inflight.append((future, staged, ids, append_args))
+                if len(inflight) >= 2 * self.workers:
+                    commit_oldest()
+                    committed += 1
+            while inflight:
+                commit_oldest()
+                committed += 1
+        finally:
+            for future, _, _, _ in inflight:
+                future.cancel()
+            self.seconds += time.perf_counter() - start
+        return committed
+
+    def close(self):
+        self.pool.shutdown()
+
+
+def default_cpu_workers():
+    # Four cores per worker, as long as every worker's copy of the model fits in memory.
+    if CORPUS_EMBED_CPU_WORKERS:
+        return CORPUS_EMBED_CPU_WORKERS
+    workers = max(1, len(available_cores()) // 4)
+    try:
+        available = os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return workers
+    return max(1, min(workers, available // WORKER_MEMORY_BYTES))
+
+
+def corpus_embedder(device=None, **batching):
+    """
+    Returns the bulk embedder for this machine: bucketed batches on the GPU
+    when there is one, otherwise a pool of CPU worker processes.
+    """
+    import torch
+
+    device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+    print(f"Embedding on {device}")
+    if device == "cuda":
+        from pymilvus.model.hybrid import BGEM3EmbeddingFunction
+
+        max_batch_size = batching.get("max_batch_size", CORPUS_EMBED_MAX_BATCH)
+        # batch_size >= our batches, so each one is a single forward pass.
+        ef = BGEM3EmbeddingFunction(device=device, use_fp16=True, batch_size=max_batch_size)
+        return BucketedEmbedder(ef, **batching)
+    return ProcessPoolEmbedder(**batching)
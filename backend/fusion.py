@@ -0,0 +1,107 @@
+import numpy as np
+
+
+STRATEGIES = ("weighted", "rrf", "normalized")
+
+
+class ScoredHit:
+    def __init__(self, entity, distance):
+        self.entity = entity
+        self.distance = distance
+
+    @property
+    def id(self):
+        return self.entity.get("id")
+
+
+def top_k(scores, limit):
+    # Indices of the ``limit`` highest scores, highest first. Equal scores go
+    # in index order, also at the cutoff, so fuse breaks ties by id like
+    # sweepFusion.FusionPool.
+    limit = min(limit, len(scores))
+    if limit <= 0:
+        return np.empty(0, dtype=np.int64)
+    if limit < len(scores):
+        threshold = np.partition(scores, len(scores) - limit)[len(scores) - limit]
+        above = np.flatnonzero(scores > threshold)
+        tied = np.flatnonzero(scores == threshold)[:limit - len(above)]
+        idx = np.concatenate([above, tied])
+    else:
+        idx = np.arange(len(scores))
+    return idx[np.lexsort((idx, -scores[idx]))]
+
+
+def milvus_normalize(scores, metric_type):
+    # Same mapping Milvus applies before a WeightedRanker sums the legs.
+    if metric_type == "COSINE":
+        return (1.0 + scores) / 2.0
+    if metric_type == "IP":
+        return 0.5 + np.arctan(scores) / np.pi
+    return 1.0 - 2.0 * np.arctan(scores) / np.pi
+
+
+def minmax_normalize(scores):
+    if len(scores) == 0:
+        return scores
+    low = scores.min()
+    span = scores.max() - low
+    if span == 0:
+        return np.ones_like(scores)
+    return (scores - low) / span
+
+
+def fuse(ids_per_leg, scores_per_leg, weights, metric_types, strategy="weighted", rrf_k=60, limit=10):
+    """
+    Fuses ranked candidate lists, one per search leg, each sorted by descending score.
+
+    ``weighted`` sums weight * Milvus-normalized score, ``normalized`` sums
+    weight * min-max normalized score over each leg's candidates, and ``rrf`` sums
+    weight / (rrf_k + rank). Returns the top ``limit`` (ids, fused scores);
+    equal fused scores are ordered by id.
+    """
+    if strategy not in STRATEGIES:
+        raise ValueError(f"Unknown fusion strategy '{strategy}', expected one of {STRATEGIES}")
+
+    legs = [
+        (np.asarray(ids), np.asarray(scores, dtype=np.float64), weight, metric_type)
+        for ids, scores, weight, metric_type in zip(ids_per_leg, scores_per_leg, weights, metric_types)
+        if len(ids)
+    ]
+    if not legs:
+        return np.empty(0), np.empty(0, dtype=np.float64)
+
+    contributions = []
+    for _, scores, weight, metric_type in legs:
+        if strategy == "rrf":
+            contributions.append(weight / (rrf_k + np.arange(1, len(scores) + 1)))
+        elif strategy == "normalized":
+            contributions.append(weight * minmax_normalize(scores))
+        else:
+            contributions.append(weight * milvus_normalize(scores, metric_type))
+
+    all_ids = np.concatenate([ids for ids, _, _, _ in legs])
+    unique_ids, inverse = np.unique(all_ids, return_inverse=True)
+    fused = np.bincount(inverse, weights=np.concatenate(contributions), minlength=len(unique_ids))
+    order = top_k(fused, limit)
+    return unique_ids[order], fused[order]
+
+
+def fuse_hits(hits_per_leg, weights, metric_types, strategy="weighted", rrf_k=60, limit=10):
+    # Works on any hit exposing ``.entity.get(...)`` and ``.distance``
+    # (Milvus search results and local search results alike).
+    entities = {}
+    ids_per_leg = []
+    scores_per_leg = []
+    for hits in hits_per_leg:
+        ids = []
+        scores = []
+        for hit in hits:
+            hit_id = hit.entity.get("id", "")
+            entities.setdefault(hit_id, hit.entity)
+            ids.append(hit_id)
+            scores.append(hit.distance)
+        ids_per_leg.append(ids)
+        scores_per_leg.append(scores)
+
+    ids, scores = fuse(ids_per_leg, scores_per_leg, weights, metric_types, strategy, rrf_k, limit)
+    return [ScoredHit(entities[hit_id], float(score)) for hit_id, score in zip(ids.tolist(), scores.tolist())]
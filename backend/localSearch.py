@@ -0,0 +1,177 @@
+import json
+import os
+import tempfile
+
+import numpy as np
+import scipy.sparse
+
+from compactStore import CompactStore
+from fusion import ScoredHit, fuse, top_k
+
+
+DENSE_FIELD = "dense_vector"
+SPARSE_FIELD = "sparse_vector"
+
+
+class LocalCollection:
+    """
+    In-process stand-in for a Milvus ``Collection`` holding the hybrid_search schema.
+
+    Dense vectors are L2-normalized once and memory-mapped, so a cosine search is a
+    single matrix-vector product. Sparse vectors are kept as a term -> postings CSR
+    inverted index and scored with ``np.bincount`` over the query terms' postings.
+    ``search`` and ``hybrid_search`` accept the same arguments as ``Collection``.
+    Int8 dense rows carry a per-row ``dense_scale``.
+    """
+
+    def __init__(self, name, records, dense, sparse=None, dense_scale=None, postings=None):
+        self.name = name
+        self.records = records
+        self.dense = dense
+        self.dense_scale = dense_scale
+        if postings is None:
+            # Transposed CSR: row t holds the documents containing term t.
+            postings = scipy.sparse.csr_matrix(sparse).T.tocsr()
+            postings.sort_indices()
+        self.postings = postings
+
+    @classmethod
+    def from_files(cls, name, data_path, save_dir, dense_dtype="float32"):
+        # data_path may be a list of JSONL files, read in the order they were embedded.
+        # save_dir is either a dense.npy / sparse.npz directory or a compact store.
+        data_paths = [data_path] if isinstance(data_path, str) else list(data_path)
+        records = []
+        for path in data_paths:
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        records.append(json.loads(line))
+
+        store = CompactStore.open(save_dir)
+        if store is not None:
+            return cls.from_compact(name, records, store)
+
+        dense = _load_normalized_dense(save_dir, dense_dtype)
+        sparse = scipy.sparse.load_npz(os.path.join(save_dir, "sparse.npz"))
+
+        if not (len(records) == dense.shape[0] == sparse.shape[0]):
+            raise ValueError(
+                f"{data_path} has {len(records)} records but {save_dir} holds "
+                f"{dense.shape[0]} dense / {sparse.shape[0]} sparse vectors"
+            )
+        return cls(name, records, dense, sparse)
+
+    @classmethod
+    def from_compact(cls, name, records, store):
+        # The store's id mapping decides the row order, not the JSONL's.
+        by_id = {record.get("id", "").strip(): record for record in records}
+        missing = [paper_id for paper_id in store.ids if paper_id not in by_id]
+        if missing:
+            raise ValueError(f"{store.path} holds {len(missing)} ids with no record, e.g. {missing[0]}")
+        ordered = [by_id[paper_id] for paper_id in store.ids]
+        return cls(name, ordered, store.dense, dense_scale=store.scales, postings=store.postings)
+
+    def __len__(self):
+        return len(self.records)
+
+    def load(self):
+        pass
+
+    def dense_scores(self, query_dense_embedding):
+        query = np.asarray(query_dense_embedding, dtype=np.float32).ravel()
+        norm = np.linalg.norm(query)
+        if norm > 0:
+            query = query / norm
+        if self.dense.dtype == np.float32:
+            return self.dense @ query
+        # float16 and int8 have no BLAS kernel; upcast in blocks to keep the temporary small.
+        scores = np.empty(self.dense.shape[0], dtype=np.float32)
+        block = 8192
+        for start in range(0, self.dense.shape[0], block):
+            scores[start:start + block] = self.dense[start:start + block].astype(np.float32) @ query
+        if self.dense_scale is not None:
+            scores *= self.dense_scale
+        return scores
+
+    def sparse_scores(self, query_sparse_embedding):
+        query = scipy.sparse.csr_matrix(query_sparse_embedding)
+        terms = query.indices
+        weights = query.data
+
+        starts = self.postings.indptr[terms]
+        ends = self.postings.indptr[terms + 1]
+        lengths = ends - starts
+        total = int(lengths.sum())
+        if total == 0:
+            return np.zeros(len(self.records), dtype=np.float32)
+
+        # Positions of every posting of every query term, without a Python loop.
+        gather = np.arange(total) + np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+        docs = self.postings.indices[gather]
+        contrib = self.postings.data[gather] * np.repeat(weights, lengths)
+        return np.bincount(docs, weights=contrib, minlength=len(self.records)).astype(np.float32)
+
+    def scores(self, anns_field, query):
+        if anns_field == DENSE_FIELD:
+            return self.dense_scores(query)
+        if anns_field == SPARSE_FIELD:
+            return self.sparse_scores(query)
+        raise ValueError(f"Unknown vector field '{anns_field}'")
+
+    def _hits(self, idx, scores, output_fields):
+        hits = []
+        for i, score in zip(idx, scores):
+            record = self.records[i]
+            fields = {key: record.get(key, "") for key in (output_fields or ["id"])}
+            fields["id"] = record.get("id", "")
+            hits.append(ScoredHit(fields, float(score)))
+        return hits
+
+    def search(self, data, anns_field, param, limit, output_fields=None, **kwargs):
+        results = []
+        for query in data:
+            scores = self.scores(anns_field, query)
+            idx = top_k(scores, limit)
+            results.append(self._hits(idx, scores[idx], output_fields))
+        return results
+
+    def hybrid_search(self, reqs, rerank, limit, output_fields=None, **kwargs):
+        ranker = rerank.dict()
+        if ranker["strategy"] == "rrf":
+            strategy, weights, rrf_k = "rrf", [1.0] * len(reqs), ranker["params"]["k"]
+        else:
+            strategy, weights, rrf_k = "weighted", ranker["params"]["weights"], 60
+
+        ids_per_leg = []
+        scores_per_leg = []
+        for req in reqs:
+            scores = self.scores(req.anns_field, req.data[0])
+            idx = top_k(scores, req.limit)
+            ids_per_leg.append(idx)
+            scores_per_leg.append(scores[idx])
+
+        metric_types = [req.param.get("metric_type", "IP") for req in reqs]
+        idx, scores = fuse(ids_per_leg, scores_per_leg, weights, metric_types, strategy, rrf_k, limit)
+        return [self._hits(idx, scores, output_fields)]
+
+
+def _load_normalized_dense(save_dir, dense_dtype):
+    # Normalized copy written next to dense.npy on first use, then memory-mapped
+    # so every worker process shares the same pages.
+    path = os.path.join(save_dir, f"dense_normalized_{dense_dtype}.npy")
+    source = os.path.join(save_dir, "dense.npy")
+    if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(source):
+        dense = np.load(source).astype(np.float32)
+        norms = np.linalg.norm(dense, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        # A temp file of its own: workers starting together may all build the
+        # copy, and each publishes only a complete file.
+        fd, tmp_path = tempfile.mkstemp(dir=save_dir, prefix=f"dense_normalized_{dense_dtype}.", suffix=".tmp.npy")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, (dense / norms).astype(dense_dtype))
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+    return np.load(path, mmap_mode="r")
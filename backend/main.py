@@ -1,14 +1,47 @@
 import os
+import json
+import asyncio
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 from typing import List, Literal
 
-from milvusSearch import display_hybrid_results_as_json, ef, collection
+import requestLog
+from milvusSearch import (
+    display_hybrid_results_as_json_async, resources, retrieve_async, stream_highlights, unhighlighted_results,
+)
+from requestLog import log_cached_search, log_search
+from telemetry import current_trace, end_trace, metrics, stage, start_trace
 from util import extract_highlight_spans
+from config import FUSION_CANDIDATE_FACTOR, PRELOAD_RESOURCES, RESOURCE_LOADING
+
+if PRELOAD_RESOURCES:
+    resources.preload()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    requestLog.start()
+    app.state.loader = None
+    if RESOURCE_LOADING == "blocking":
+        await asyncio.to_thread(resources.start)
+        if resources.error:
+            raise RuntimeError("Failed to load search resources")
+    elif RESOURCE_LOADING == "background":
+        app.state.loader = asyncio.create_task(asyncio.to_thread(resources.start))
+    yield
+    if app.state.loader is not None:
+        # The load runs in a thread that cancelling the task would not stop;
+        # it is waited for, so close() never races resources still being created.
+        await app.state.loader
+    resources.close()
+    requestLog.stop()
+
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -18,9 +51,32 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.middleware("http")
+async def telemetry_middleware(request: Request, call_next):
+    # Stages timed while handling the request end up in its Server-Timing header.
+    trace, token = start_trace(request.headers.get("x-request-id"))
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        response.headers["Server-Timing"] = trace.server_timing()
+        response.headers["X-Request-ID"] = trace.trace_id
+        return response
+    finally:
+        route = request.scope.get("route")
+        # The route template, not the raw path, keeps label cardinality bounded.
+        trace.finish(route.path if route is not None else "unmatched", request.method, status)
+        end_trace(token)
+
+
 class SearchRequest(BaseModel):
     query: str
     top_k: int = 5
+    fusion: Literal["weighted", "rrf", "normalized"] = "weighted"
+    sparse_weight: float = 0.7
+    dense_weight: float = 1.0
+    rrf_k: int = 60
+    candidate_factor: int = FUSION_CANDIDATE_FACTOR
 
 class CompareRequest(BaseModel):
     query: str
@@ -46,44 +102,207 @@ class PaperResult(BaseModel):
 
 class SearchResponse(BaseModel):
     results: List[PaperResult]
-    
+
+
+def paper_result(r):
+    return {
+        "id": r["id"],
+        "title": r["title"],
+        "authors": r["author"].split(", "),
+        "year": "2023",
+        "abstract": r["abstract_text"],
+        "similarityScore": round(r["score"], 4),
+        "url": r["url"] or f"https://arxiv.org/abs/{r['id']}"
+    }
+
+
+def with_category(spans):
+    return [
+        {"start": s, "end": e, "category": "concept"} for s, e in spans
+    ]
+
+
+CLIENT_CLOSED_REQUEST = 499
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+async def cancel_on_disconnect(request: Request, coro, poll_interval=0.05):
+    # Starlette keeps running a handler after its client goes away; cancel the
+    # work ourselves so abandoned searches stop queueing for the model and Milvus.
+    task = asyncio.ensure_future(coro)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=poll_interval)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                raise ClientDisconnected()
+    finally:
+        task.cancel()
+
+
+@app.exception_handler(ClientDisconnected)
+async def client_disconnected_handler(request: Request, exc: ClientDisconnected):
+    return Response(status_code=CLIENT_CLOSED_REQUEST)
+
+
+@app.get("/health/live")
+def liveness_endpoint():
+    return {"status": "ok"}
+
+@app.get("/health/ready")
+def readiness_endpoint():
+    status = resources.status()
+    return JSONResponse(status, status_code=200 if status["ready"] else 503)
+
+@app.post("/warmup")
+async def warmup_endpoint():
+    await resources.ensure_loaded()
+    seconds = await asyncio.to_thread(resources.warmup)
+    return {"warmup_seconds": seconds, **resources.status()}
+
 @app.post("/search", response_model=SearchResponse)
-def search_endpoint(req: SearchRequest):
-    raw_results = display_hybrid_results_as_json(
-        ef=ef,
+async def search_endpoint(req: SearchRequest, request: Request):
+    # Responses are cached serialized: a hit skips the model, the search and
+    # response validation, and is returned as the stored bytes.
+    cache = resources.result_cache
+    if cache is not None:
+        with stage("cache"):
+            version = cache.current_version()
+            key = cache.key(req.model_dump())
+            cached = await cache.get(key, version)
+        if cached is not None:
+            count, body = cached
+            metrics.inc("search_hits_total", count)
+            current_trace().fields.update(hits=count, cache="hit")
+            log_cached_search(
+                req.query, body, top_k=req.top_k, fusion=req.fusion, sparse_weight=req.sparse_weight,
+                dense_weight=req.dense_weight, rrf_k=req.rrf_k, candidate_factor=req.candidate_factor,
+            )
+            return Response(body, media_type="application/json")
+
+    await resources.ensure_loaded()
+    raw_results = await cancel_on_disconnect(request, display_hybrid_results_as_json_async(
+        ef=resources.query_ef,
         query=req.query,
-        collection=collection,
-        sparse_weight=0.7,
-        dense_weight=1.0,
-        limit=req.top_k
+        collection=resources.collection,
+        sparse_weight=req.sparse_weight,
+        dense_weight=req.dense_weight,
+        limit=req.top_k,
+        strategy=req.fusion,
+        rrf_k=req.rrf_k,
+        candidate_factor=req.candidate_factor,
+    ))
+
+    with stage("response"):
+        results = [paper_result(r) for r in raw_results]
+        body = SearchResponse(results=results).model_dump_json().encode("utf-8")
+    if cache is not None:
+        cache.put(key, version, len(results), body)
+
+    metrics.inc("search_hits_total", len(results))
+    current_trace().fields["hits"] = len(results)
+    return Response(body, media_type="application/json")
+
+@app.post("/search/stream")
+async def search_stream_endpoint(req: SearchRequest, request: Request):
+    """
+    Streams a search as NDJSON. The first line is sent as soon as retrieval
+    returns: {"type": "results", "results": [PaperResult, ...]} in rank
+    order. Then, as each paper's highlighting finishes, one line
+    {"type": "highlights", "rank", "id", "highlights": [HighlightSpan, ...]}
+    in completion order, and finally {"type": "done"}.
+
+    The request's trace, Server-Timing header and request_seconds end when
+    the headers are sent, with the first line. Highlighting after that is
+    only in stage_seconds, and the whole stream in stream_seconds.
+    """
+    await resources.ensure_loaded()
+    ef = resources.query_ef
+    hits = await cancel_on_disconnect(request, retrieve_async(
+        ef,
+        req.query,
+        resources.collection,
+        sparse_weight=req.sparse_weight,
+        dense_weight=req.dense_weight,
+        limit=req.top_k,
+        strategy=req.fusion,
+        rrf_k=req.rrf_k,
+        candidate_factor=req.candidate_factor,
+    ))
+
+    raw_results = unhighlighted_results(hits)
+    log_search(
+        req.query, raw_results, top_k=req.top_k, fusion=req.fusion, sparse_weight=req.sparse_weight,
+        dense_weight=req.dense_weight, rrf_k=req.rrf_k, candidate_factor=req.candidate_factor,
     )
+    with stage("response"):
+        results = [paper_result(r) for r in raw_results]
+        first_line = json.dumps({"type": "results", "results": SearchResponse(results=results).model_dump()["results"]})
+    metrics.inc("search_hits_total", len(results))
+    trace = current_trace()
+    trace.fields.update(hits=len(results), stream=True)
+
+    async def lines():
+        try:
+            yield first_line + "\n"
+            # Starlette cancels this generator when the client disconnects, which
+            # cancels the papers still waiting for the executor.
+            async for rank, info in stream_highlights(ef, req.query, hits):
+                yield json.dumps({
+                    "type": "highlights",
+                    "rank": rank,
+                    "id": results[rank]["id"],
+                    "highlights": with_category(info["highlights"]),
+                }) + "\n"
+            yield json.dumps({"type": "done"}) + "\n"
+        finally:
+            metrics.observe("stream_seconds", trace.elapsed(), route="/search/stream")
 
-    results = []
-    for r in raw_results:
-        results.append({
-            "id": r["id"],
-            "title": r["title"],
-            "authors": r["author"].split(", "),
-            "year": "2023",
-            "abstract": r["abstract_text"],
-            "similarityScore": round(r["score"], 4),
-            "url": r["url"] or f"https://arxiv.org/abs/{r['id']}"
-        })
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+@app.get("/stats/embedding")
+def embedding_stats_endpoint():
+    return {
+        "batcher": resources.embedding_batcher.stats(),
+        "cache": resources.embedding_cache.stats(),
+    }
 
-    return {"results": results}
+@app.get("/stats/cache")
+def result_cache_stats_endpoint():
+    cache = resources.result_cache
+    return {"results": cache.stats() if cache is not None else None}
+
+@app.get("/stats/latency")
+def latency_stats_endpoint():
+    return {
+        "stages": metrics.latency("stage_seconds"),
+        "requests": metrics.latency("request_seconds"),
+    }
+
+@app.get("/metrics")
+def metrics_endpoint():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
 @app.post("/compare", response_model=CompareResponse)
-def compare_endpoint(req: CompareRequest):
+async def compare_endpoint(req: CompareRequest, request: Request):
     query = req.query
     paper = req.paper_text
 
-    query_spans = extract_highlight_spans(ef, query, [paper])[0]["highlights"]
-    paper_spans = extract_highlight_spans(ef, paper, [query])[0]["highlights"]
-
-    def with_category(spans):
-        return [
-            {"start": s, "end": e, "category": "concept"} for s, e in spans
-        ]
+    await resources.ensure_loaded()
+    ef = resources.ef
+    executor = resources.executor
+    loop = asyncio.get_running_loop()
+    with stage("highlight"):
+        query_spans, paper_spans = await cancel_on_disconnect(request, asyncio.gather(
+            loop.run_in_executor(executor, extract_highlight_spans, ef, query, [paper]),
+            loop.run_in_executor(executor, extract_highlight_spans, ef, paper, [query]),
+        ))
+    query_spans = query_spans[0]["highlights"]
+    paper_spans = paper_spans[0]["highlights"]
 
     return {
         "userHighlights": with_category(query_spans),
@@ -2,13 +2,21 @@
 
 import os
 os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
-import torch
+import sys
 import json
+from itertools import islice
 import numpy as np
 import scipy.sparse
 from tqdm import tqdm
 from pymilvus import connections, FieldSchema, CollectionSchema, DataType, Collection, utility
-from pymilvus.model.hybrid import BGEM3EmbeddingFunction
+
+from config import CORPUS_VERSION_PATH
+from embeddingDriver import corpus_embedder
+from bulkLoad import InsertPipeline, PhaseTimer, build_indexes
+from milvusPayload import dense_rows, sparse_rows
+from resultCache import bump_corpus_version
+from shardStore import ShardStore, iter_jsonl, read_lines, record_hash
+from tokenStore import TokenStore, append_token_store, build_token_store
 
 # ==== Zilliz Cloud config ====
 MILVUS_URI = ""
@@ -20,31 +28,18 @@ COLLECTION_NAME = "hybrid_search"
 
 
 SAVE_DIR = "./saved_embeddings"
+TOKEN_STORE_DIR = os.path.join(SAVE_DIR, "tokens")
+SHARD_DIR = os.path.join(SAVE_DIR, "shards")
 
+DATA_PATH = "./data/data_ai_cl.jsonl"
+# Abstracts embedded per shard; peak memory is bounded by this, not the corpus size.
+CHUNK_SIZE = 1024
+# Rows per insert RPC and how many RPCs may be outstanding at once.
+INSERT_BATCH_SIZE = 500
+MAX_INFLIGHT_INSERTS = 4
+# Ids per delete expression when removing papers that left the corpus.
+DELETE_BATCH_SIZE = 1000
 
-connections.connect(
-    uri=MILVUS_URI,
-    user=MILVUS_USER,
-    password=MILVUS_PASSWORD,
-    secure=True
-)
-
-device = "cuda" if (torch.cuda.is_available()) else "cpu"
-
-print(device)
-if device != "cuda":
-    exit()
-
-
-ef = BGEM3EmbeddingFunction(device=device, use_fp16=(device=="cuda"))
-dense_dim = ef.dim["dense"]
-
-def sparse_tensor_batch_to_list_of_dicts(tensor):
-    tensor = tensor.tocoo()
-    results = [{} for _ in range(tensor.shape[0])]
-    for i, j, v in zip(tensor.row, tensor.col, tensor.data):
-        results[i][j] = float(v)
-    return results
 
 def save_embeddings(dense_list, sparse_matrix, save_dir=SAVE_DIR):
     os.makedirs(save_dir, exist_ok=True)
@@ -68,7 +63,7 @@ def load_jsonl(path):
     return data
 
 
-def create_collection(name):
+def create_collection(name, dense_dim):
     if utility.has_collection(name):
         collection = Collection(name)
         print(f"Collection '{name}' already exists.")
@@ -89,7 +84,7 @@ def create_collection(name):
     return collection
 
 
-def insert_batch(collection, batch_data, dense_list, sparse_list, offset):
+def insert_batch(collection, batch_data, dense_list, sparse_list, offset, upsert=False, _async=False):
     ids = []
     titles = []
     authors = []
@@ -109,62 +104,267 @@ def insert_batch(collection, batch_data, dense_list, sparse_list, offset):
         times.append(item.get("time", "").strip())
         abstracts.append(item.get("abstract", ""))
 
-    dense_batch = [dense_list[offset+idx].tolist() for idx in range(len(batch_data))]
-    sparse_batch = sparse_tensor_batch_to_list_of_dicts(sparse_list[offset:offset+len(batch_data)])
+    dense_batch = dense_rows(dense_list, offset, offset + len(batch_data))
+    sparse_batch = sparse_rows(sparse_list, offset, offset + len(batch_data))
 
-    collection.insert([
+    # Upsert makes re-sending rows from a half-inserted shard idempotent.
+    write = collection.upsert if upsert else collection.insert
+    return write([
         ids, titles, authors, links, times, abstracts,
         dense_batch, sparse_batch
-    ])
-
-
-    collection.create_index(
-        field_name="sparse_vector",
-        index_params={
-            "index_type": "SPARSE_INVERTED_INDEX",
-            "metric_type": "IP"
-        }
+    ], _async=_async)
+
+
+def iter_chunks(records, chunk_size):
+    chunk = []
+    for line_no, item in records:
+        chunk.append((line_no, item))
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def import_legacy_embeddings(store, data_path, chunk_size=CHUNK_SIZE):
+    # Seeds an empty shard store from a monolithic dense.npy/sparse.npz that
+    # still matches the JSONL, instead of re-embedding everything.
+    if store.entries or not os.path.exists(os.path.join(SAVE_DIR, "dense.npy")):
+        return
+    dense = np.load(os.path.join(SAVE_DIR, "dense.npy"), mmap_mode="r")
+    sparse = scipy.sparse.load_npz(os.path.join(SAVE_DIR, "sparse.npz")).tocsr()
+    if sum(1 for _ in iter_jsonl(data_path)) != dense.shape[0]:
+        print("Saved embeddings do not match the data file; re-embedding.")
+        return
+
+    offset = 0
+    for chunk in iter_chunks(iter_jsonl(data_path), chunk_size):
+        rows = len(chunk)
+        store.append(
+            [item.get("id", "").strip() for _, item in chunk],
+            dense[offset:offset + rows], sparse[offset:offset + rows],
+            first_line=chunk[0][0], next_line=chunk[-1][0] + 1,
+            hashes=[record_hash(item) for _, item in chunk],
+        )
+        offset += rows
+
+
+def embed_shards(store, ef, data_path, chunk_size=CHUNK_SIZE):
+    # Without a GPU, ef is a worker pool that embeds several chunks at once
+    # and writes their shards from the workers.
+    shards = (
+        (
+            [item.get("id", "").strip() for _, item in chunk],
+            [item.get("abstract", "") for _, item in chunk],
+            {
+                "first_line": chunk[0][0],
+                "next_line": chunk[-1][0] + 1,
+                "hashes": [record_hash(item) for _, item in chunk],
+            },
+        )
+        for chunk in iter_chunks(iter_jsonl(data_path, store.next_line), chunk_size)
     )
-
-
-    collection.create_index(
-        field_name="dense_vector",
-        index_params={
-            "index_type": "AUTOINDEX",
-            "metric_type": "COSINE"
-        }
+    return ef.embed_to_store(store, tqdm(shards, desc="Embedding"))
+
+
+def corpus_ids(data_path):
+    return [item.get("id", "").strip() for _, item in iter_jsonl(data_path)]
+
+
+def diff_corpus(store, data_path):
+    """
+    Compares the JSONL against the live rows of the shard store. Returns the
+    (line, record, hash) of every new or changed paper, the ids no longer in
+    the file, the file's ids in order, and the line after its last record.
+    """
+    live = store.live_rows()
+    changed = []
+    order = []
+    end_line = 0
+    for line_no, item in iter_jsonl(data_path):
+        paper_id = item.get("id", "").strip()
+        content_hash = record_hash(item)
+        order.append(paper_id)
+        end_line = line_no + 1
+        known = live.get(paper_id)
+        # Rows from shards written before hashes were recorded are trusted as is.
+        if known is None or (known[2] is not None and known[2] != content_hash):
+            changed.append((line_no, item, content_hash))
+
+    present = set(order)
+    removed = [paper_id for paper_id in live if paper_id not in present]
+    return changed, removed, order, end_line
+
+
+def embed_delta(store, ef, changed, removed, end_line, chunk_size=CHUNK_SIZE):
+    # Appends the delta as shards whose rows point at individual JSONL lines.
+    # Removed ids ride on the first of them, so an interrupted run re-diffs cleanly.
+    chunks = [changed[start:start + chunk_size] for start in range(0, len(changed), chunk_size)]
+    if not chunks and removed:
+        store.append([], None, None, first_line=end_line, next_line=end_line, deleted=removed)
+        return 1
+
+    for index, chunk in enumerate(tqdm(chunks, desc="Embedding delta")):
+        embeds = ef([item.get("abstract", "") for _, item, _ in chunk])
+        store.append(
+            [item.get("id", "").strip() for _, item, _ in chunk],
+            embeds["dense"], embeds["sparse"],
+            first_line=chunk[0][0],
+            next_line=end_line if index == len(chunks) - 1 else store.next_line,
+            hashes=[content_hash for _, _, content_hash in chunk],
+            lines=[line_no for line_no, _, _ in chunk],
+            deleted=removed if index == 0 else None,
+        )
+    return len(chunks)
+
+
+def update_token_store(tokenizer, data_path, order, changed=None, removed=()):
+    """
+    Brings the token store in line with the JSONL and returns how many papers
+    were tokenized. After a delta (``changed`` not None) only its papers are
+    tokenized and removed ids are dropped. The store is rebuilt instead when it
+    is missing or would not hold exactly the file's ids, as after a delta run
+    interrupted before this step, or on a full run, when any abstract differs.
+    """
+    token_store = TokenStore.open(TOKEN_STORE_DIR)
+    if token_store is not None and changed is not None:
+        changed_ids = [item.get("id", "").strip() for _, item, _ in changed]
+        if (set(token_store.rows) - set(removed)) | set(changed_ids) == set(order):
+            del token_store
+            if changed or removed:
+                append_token_store(
+                    tokenizer, changed_ids, [item.get("abstract", "") for _, item, _ in changed],
+                    TOKEN_STORE_DIR, removed=removed,
+                )
+            return len(changed)
+
+    records = [item for _, item in iter_jsonl(data_path)]
+    paper_ids = [item.get("id", "").strip() for item in records]
+    abstracts = [item.get("abstract", "") for item in records]
+    del records
+    if token_store is not None and changed is None and token_store.matches(paper_ids, abstracts):
+        return 0
+    # Release the memory maps before their files are replaced.
+    del token_store
+    build_token_store(tokenizer, paper_ids, abstracts, TOKEN_STORE_DIR)
+    return len(paper_ids)
+
+
+def delete_ids(collection, ids, batch_size=DELETE_BATCH_SIZE):
+    for start in range(0, len(ids), batch_size):
+        collection.delete(expr=f"id in {json.dumps(ids[start:start + batch_size])}")
+
+
+def entry_records(data_path, entry):
+    # Records of a delta shard, which are scattered over the JSONL.
+    by_line = read_lines(data_path, entry["lines"])
+    items = [by_line.get(line_no) for line_no in entry["lines"]]
+    for paper_id, item in zip(entry["ids"], items):
+        if item is None or item.get("id", "").strip() != paper_id:
+            raise ValueError(f"{data_path} changed since {entry['name']} was embedded; rerun with --incremental")
+    return items
+
+
+def insert_shards(store, collection, data_path, batch_size=INSERT_BATCH_SIZE, max_inflight=MAX_INFLIGHT_INSERTS):
+    pending = store.pending_inserts()
+    if not pending:
+        return 0
+    records = None
+    position = None
+    pipeline = InsertPipeline(max_inflight)
+
+    for entry in tqdm(pending, desc="Inserting"):
+        if entry.get("deleted"):
+            # Earlier RPCs may still be writing ids this entry removes.
+            pipeline.drain()
+            delete_ids(collection, entry["deleted"])
+        if not entry["rows"]:
+            pipeline.after_pending(lambda entry=entry: store.mark_inserted(entry))
+            continue
+
+        if "lines" in entry:
+            items = entry_records(data_path, entry)
+        else:
+            # Consecutive full-ingest shards share one pass over the file.
+            if position != entry["first_line"]:
+                records = iter_jsonl(data_path, entry["first_line"])
+            items = [item for _, item in islice(records, entry["rows"])]
+            position = entry["next_line"]
+        dense_list, sparse_list = store.load_shard(entry)
+        # Delta rows may replace papers already in the collection.
+        upsert = "lines" in entry or store.was_partially_inserted(entry)
+        store.mark_inserting(entry)
+
+        for start in range(0, len(items), batch_size):
+            batch = items[start:start + batch_size]
+            future = insert_batch(
+                collection, batch, dense_list, sparse_list,
+                offset=start, upsert=upsert, _async=True,
+            )
+            pipeline.submit(future, len(batch))
+        # The shard counts as inserted only once all of its RPCs have completed.
+        pipeline.after_pending(lambda entry=entry: store.mark_inserted(entry))
+
+    return pipeline.drain()
+
+
+def main(data_path=DATA_PATH, chunk_size=CHUNK_SIZE, incremental=False):
+    connections.connect(
+        uri=MILVUS_URI,
+        user=MILVUS_USER,
+        password=MILVUS_PASSWORD,
+        secure=True
     )
-
-  
-    collection.load()
-
-
-def main():
-    data_path = "./data/data_ai_cl.jsonl"
-    data = load_jsonl(data_path)
-
-    if os.path.exists(os.path.join(SAVE_DIR, "dense.npy")) and os.path.exists(os.path.join(SAVE_DIR, "sparse.npz")):
-        dense_list, sparse_list = load_embeddings(SAVE_DIR)
+    # Built here rather than at import: the CPU fallback's spawned workers re-import this module.
+    ef = corpus_embedder()
+
+    timer = PhaseTimer()
+    store = ShardStore(SHARD_DIR)
+    import_legacy_embeddings(store, data_path, chunk_size)
+    if store.rows:
+        print(f"Resuming after {len(store.entries)} committed shards ({store.rows} rows).")
+
+    rows_before = store.rows
+    if incremental and store.entries:
+        # Embeds only papers that are new or whose content hash changed, and
+        # records the ids that disappeared from the JSONL.
+        with timer.phase("diff"):
+            changed, removed, order, end_line = diff_corpus(store, data_path)
+        print(f"{len(changed)} new or changed papers, {len(removed)} removed.")
+        with timer.phase("embed delta", rows=len(changed)):
+            added = embed_delta(store, ef, changed, removed, end_line, chunk_size)
     else:
-        texts = [item.get("abstract", "") for item in data]
-        embeds = ef(texts)
-        dense_list = embeds["dense"]
-        sparse_list = embeds["sparse"]
-        save_embeddings(dense_list, sparse_list, SAVE_DIR)
+        with timer.phase("embed", rows=lambda: store.rows - rows_before):
+            added = embed_shards(store, ef, data_path, chunk_size)
+        changed = removed = None
+        order = corpus_ids(data_path)
+    if ef.texts:
+        print(ef.report())
+    exported = bool(added) or store.needs_export(SAVE_DIR)
+    if exported:
+        with timer.phase("export", rows=len(order)):
+            store.export(SAVE_DIR, order)
+
+    tokenized = {}
+    with timer.phase("tokenize", rows=lambda: tokenized.get("rows")):
+        tokenized["rows"] = update_token_store(ef.model.tokenizer, data_path, order, changed, removed)
 
    
-    collection = create_collection(COLLECTION_NAME)
-
-    batch_size = 30
-    num_batches = (len(data) + batch_size - 1) // batch_size
-
-
-    for i in tqdm(range(num_batches)):
-        batch = data[i*batch_size : (i+1)*batch_size]
-        insert_batch(collection, batch, dense_list, sparse_list, offset=i*batch_size)
-
-    collection.load()
+    collection = create_collection(COLLECTION_NAME, ef.dim["dense"])
+    ef.close()
+    inserted = {}
+    corpus_changed = bool(store.pending_inserts())
+    with timer.phase("insert", rows=lambda: inserted.get("rows")):
+        inserted["rows"] = insert_shards(store, collection, data_path)
+
+    with timer.phase("index + load"):
+        build_indexes(collection)
+    if corpus_changed or exported:
+        # Servers, Milvus or local, drop their cached /search responses once they see the new stamp.
+        bump_corpus_version(CORPUS_VERSION_PATH, rows=len(order))
     print("All data inserted and collection loaded!")
+    timer.report()
 
 if __name__ == "__main__":
-    main()
+    # --incremental: embed and upsert only papers that changed since the last run.
+    main(incremental="--incremental" in sys.argv[1:])
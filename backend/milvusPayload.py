@@ -0,0 +1,23 @@
+import numpy as np
+import scipy.sparse
+
+
+def dense_rows(dense, start, stop):
+    # One C-level tolist() over a contiguous block instead of one per row.
+    return np.ascontiguousarray(dense[start:stop], dtype=np.float32).tolist()
+
+
+def sparse_rows(sparse, start, stop):
+    # pymilvus serializes a scipy CSR matrix directly, so a row slice shares the
+    # indices/data buffers and no per-row dicts are built.
+    return scipy.sparse.csr_array(sparse[start:stop])
+
+
+def sparse_rows_to_dicts(sparse, start, stop):
+    # For clients that need one {index: weight} dict per row: slice the flat
+    # indices/data by indptr instead of walking every non-zero of a COO matrix.
+    csr = scipy.sparse.csr_array(sparse[start:stop])
+    indices = csr.indices.tolist()
+    data = csr.data.tolist()
+    bounds = csr.indptr.tolist()
+    return [dict(zip(indices[lo:hi], data[lo:hi])) for lo, hi in zip(bounds[:-1], bounds[1:])]
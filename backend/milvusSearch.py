@@ -1,6 +1,32 @@
-from pymilvus import connections, Collection, AnnSearchRequest, RRFRanker, WeightedRanker
-from pymilvus.model.hybrid import BGEM3EmbeddingFunction
+import asyncio
+import gc
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 
+from pymilvus import connections, Collection, AsyncMilvusClient
+
+from config import (
+    QUERY_ENCODER, ONNX_MODEL_DIR, ONNX_MODEL_FILE, ONNX_THREADS,
+    EMBED_BATCH_SIZE, EMBED_MAX_WAIT_MS,
+    EMBED_CACHE_MB, EMBED_CACHE_PATH, EMBED_CACHE_DISK_MB, EMBED_CACHE_NAMESPACE,
+    SEARCH_EXECUTOR_WORKERS,
+    RESULT_CACHE_MB, RESULT_CACHE_TTL, RESULT_CACHE_PATH, RESULT_CACHE_DISK_MB, CORPUS_VERSION_PATH,
+    SEARCH_BACKEND, LOCAL_DATA_PATH, LOCAL_EMBEDDINGS_DIR, LOCAL_DENSE_DTYPE, LOCAL_INLINE_SEARCH_ROWS,
+    FUSION_CANDIDATE_FACTOR,
+    TOKEN_STORE_DIR,
+    WARMUP_ON_LOAD,
+)
+from embeddingBatcher import EmbeddingBatcher
+from embeddingCache import EmbeddingCache, CachedEmbeddingFunction
+from fusion import fuse_hits
+from localSearch import LocalCollection
+from requestLog import format_results, log_search
+from resultCache import CorpusVersion, ResultCache, SqliteResultStore
+from telemetry import metrics, stage
+from tokenStore import TokenStore
 from util import extract_highlight_spans
 
 MILVUS_URI = ""
@@ -9,44 +35,294 @@ MILVUS_USER = ""
 MILVUS_PASSWORD = ""
 
 
-connections.connect(
-    uri=MILVUS_URI,
-    user=MILVUS_USER,
-    password=MILVUS_PASSWORD,
-    secure=True
-)
+collection_name = "hybrid_search"
 
+WARMUP_QUERY = "Dense and sparse retrieval for finding related work on a research idea."
 
-collection_name = "hybrid_search"
-collection = Collection(collection_name)
-collection.load()
 
+def encoder_namespace():
+    # Embeddings from different encoders must not be served for each other.
+    if QUERY_ENCODER == "onnx":
+        return f"{EMBED_CACHE_NAMESPACE}-{ONNX_MODEL_FILE}"
+    return EMBED_CACHE_NAMESPACE
+
+
+def result_namespace():
+    # Rankings from another backend, collection or encoder are never served,
+    # even from a shared cache file that outlives a configuration change.
+    if SEARCH_BACKEND == "local":
+        store = ":".join([os.path.abspath(LOCAL_DATA_PATH), os.path.abspath(LOCAL_EMBEDDINGS_DIR), LOCAL_DENSE_DTYPE])
+        return f"local:{store}:{encoder_namespace()}"
+    return f"milvus:{collection_name}:{encoder_namespace()}"
+
+
+class Resources:
+    """
+    Serving state that used to be built at import time: the collection, the
+    BGE-M3 encoder with the batcher and cache around it, the token store and
+    the request executor. Each one is created on first access, or up front by
+    ``load``.
+
+    ``preload`` creates only what survives a fork (model weights, memory-mapped
+    arrays), so a pre-forking server such as ``gunicorn --preload`` shares them
+    copy-on-write between workers. Threads, sockets and the Milvus connection
+    are created by ``load`` in each worker.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._values = {}
+        self.timings = {}
+        self.loaded = False
+        self.warmed_up = False
+        self.error = None
+
+    def _get(self, name, factory):
+        if name not in self._values:
+            with self._lock:
+                if name not in self._values:
+                    start = time.perf_counter()
+                    self._values[name] = factory()
+                    self.timings[name] = round(time.perf_counter() - start, 4)
+        return self._values[name]
+
+    def use(self, name, value):
+        # Installs a prebuilt resource in place of the configured one, e.g. the
+        # benchmark's test collection.
+        with self._lock:
+            self._values[name] = value
+
+    @property
+    def collection(self):
+        return self._get("collection", _load_collection)
+
+    @property
+    def ef(self):
+        return self._get("ef", _load_encoder)
+
+    @property
+    def embedding_batcher(self):
+        # Shared by all request threads: concurrent queries are encoded together in one forward pass.
+        return self._get("embedding_batcher", lambda: EmbeddingBatcher(
+            self.ef, max_batch_size=EMBED_BATCH_SIZE, max_wait_ms=EMBED_MAX_WAIT_MS
+        ))
+
+    @property
+    def embedding_cache(self):
+        return self._get("embedding_cache", lambda: EmbeddingCache(
+            max_mb=EMBED_CACHE_MB,
+            path=EMBED_CACHE_PATH or None,
+            disk_max_mb=EMBED_CACHE_DISK_MB,
+            namespace=encoder_namespace(),
+        ))
+
+    @property
+    def query_ef(self):
+        # Repeated queries are answered from the cache, the rest go through the batcher.
+        return self._get("query_ef", lambda: CachedEmbeddingFunction(self.embedding_batcher, self.embedding_cache))
+
+    @property
+    def result_cache(self):
+        # None when disabled. Holds no model state, so /search can answer hits
+        # before the encoder has loaded.
+        def build():
+            if not (RESULT_CACHE_MB or RESULT_CACHE_PATH):
+                return None
+            shared = None
+            if RESULT_CACHE_PATH:
+                shared = SqliteResultStore(RESULT_CACHE_PATH, int(RESULT_CACHE_DISK_MB * 1024 * 1024))
+            return ResultCache(
+                CorpusVersion(CORPUS_VERSION_PATH), RESULT_CACHE_MB, RESULT_CACHE_TTL, shared, result_namespace()
+            )
+        return self._get("result_cache", build)
+
+    @property
+    def token_store(self):
+        # Per-paper tokens written at ingest; highlighting falls back to tokenizing
+        # the abstracts when it is missing.
+        return self._get("token_store", lambda: TokenStore.open(TOKEN_STORE_DIR))
+
+    @property
+    def executor(self):
+        # CPU-bound work (tokenization, highlighting) for the async request path.
+        return self._get("executor", lambda: ThreadPoolExecutor(
+            max_workers=SEARCH_EXECUTOR_WORKERS, thread_name_prefix="search-cpu"
+        ))
+
+    @property
+    def async_client(self):
+        # Created on first use so that its gRPC channel binds to the server's event loop.
+        return self._get("async_client", lambda: AsyncMilvusClient(
+            uri=MILVUS_URI,
+            user=MILVUS_USER,
+            password=MILVUS_PASSWORD,
+        ))
+
+    def preload(self):
+        self.ef
+        self.token_store
+        if SEARCH_BACKEND == "local":
+            self.collection
+        # Keep the collector from touching (and so copying) the preloaded objects in forked workers.
+        gc.freeze()
+
+    def load(self):
+        self.collection
+        self.query_ef
+        self.token_store
+        self.executor
+        self.loaded = True
+
+    async def ensure_loaded(self):
+        # Waits for a load in progress without blocking the event loop.
+        if not self.loaded:
+            await asyncio.to_thread(self.load)
+
+    def warmup(self):
+        # One query end to end, so the first real request does not pay for
+        # lazy kernel setup, page faults on the mapped arrays or the tokenizer.
+        start = time.perf_counter()
+        display_hybrid_results_as_json(self.query_ef, WARMUP_QUERY, self.collection, limit=5, verbose=False)
+        self.timings["warmup"] = round(time.perf_counter() - start, 4)
+        self.warmed_up = True
+        return self.timings["warmup"]
+
+    def start(self, warmup=WARMUP_ON_LOAD):
+        try:
+            self.load()
+            if warmup:
+                self.warmup()
+        except Exception:
+            self.error = traceback.format_exc()
+            print(self.error)
+
+    @property
+    def ready(self):
+        return self.loaded and self.error is None and (self.warmed_up or not WARMUP_ON_LOAD)
+
+    def status(self):
+        return {
+            "ready": self.ready,
+            "loaded": sorted(self._values),
+            "timings": self.timings,
+            "error": self.error,
+        }
+
+    def metric_samples(self):
+        # Counters of the embedding cache and batcher for /metrics, once they exist.
+        samples = []
+        cache = self._values.get("embedding_cache")
+        if cache is not None:
+            stats = cache.stats()
+            for tier, key in (("memory", "hits"), ("disk", "disk_hits"), ("miss", "misses")):
+                samples.append(("embedding_cache_lookups_total", "counter",
+                                "Query embedding cache lookups, by the tier that answered.", {"result": tier}, stats[key]))
+            samples.append(("embedding_cache_evictions_total", "counter",
+                            "Entries evicted from the in-memory embedding cache.", {}, stats["evictions"]))
+            samples.append(("embedding_cache_entries", "gauge",
+                            "Entries in the in-memory embedding cache.", {}, stats["entries"]))
+        result_cache = self._values.get("result_cache")
+        if result_cache is not None:
+            stats = result_cache.stats()
+            for tier, key in (("memory", "hits"), ("shared", "shared_hits"), ("miss", "misses")):
+                samples.append(("result_cache_lookups_total", "counter",
+                                "/search response cache lookups, by the tier that answered.", {"result": tier}, stats[key]))
+            samples.append(("result_cache_stale_total", "counter",
+                            "Cached responses dropped for an expired TTL or an old corpus version.", {}, stats["stale"]))
+            samples.append(("result_cache_entries", "gauge", "Responses in the in-memory result cache.", {},
+                            stats["entries"]))
+        batcher = self._values.get("embedding_batcher")
+        if batcher is not None:
+            stats = batcher.stats()
+            samples.append(("embedding_batches_total", "counter", "Forward passes run by the query batcher.", {},
+                            stats["batches"]))
+            samples.append(("embedding_queries_total", "counter", "Queries encoded by the query batcher.", {},
+                            stats["queries"]))
+            samples.append(("embedding_queue_depth", "gauge", "Queries waiting for the query batcher.", {},
+                            stats["queue_depth"]))
+        return samples
+
+    def close(self):
+        if "embedding_batcher" in self._values:
+            self._values["embedding_batcher"].close()
+        if "executor" in self._values:
+            self._values["executor"].shutdown(wait=False)
+        if self._values.get("result_cache") is not None:
+            self._values["result_cache"].close()
+
+
+def _load_collection():
+    if SEARCH_BACKEND == "local":
+        return LocalCollection.from_files(
+            collection_name, LOCAL_DATA_PATH, LOCAL_EMBEDDINGS_DIR, dense_dtype=LOCAL_DENSE_DTYPE
+        )
+
+    connections.connect(
+        uri=MILVUS_URI,
+        user=MILVUS_USER,
+        password=MILVUS_PASSWORD,
+        secure=True
+    )
+
+    collection = Collection(collection_name)
+    collection.load()
+    return collection
+
+
+def _load_encoder():
+    # Imported here: pulling in the model stack is a large part of startup time.
+    if QUERY_ENCODER == "onnx":
+        from onnxEncoder import OnnxBGEM3EmbeddingFunction
+
+        return OnnxBGEM3EmbeddingFunction(ONNX_MODEL_DIR, ONNX_MODEL_FILE, threads=ONNX_THREADS)
+
+    from pymilvus.model.hybrid import BGEM3EmbeddingFunction
+
+    # return BGEM3EmbeddingFunction(device="cuda", use_fp16=False)
+    return BGEM3EmbeddingFunction(device="cpu", use_fp16=False)
+
+
+resources = Resources()
+metrics.add_collector(resources.metric_samples)
+
+
+OUTPUT_FIELDS = ["id", "title", "author", "abstract"]
+DENSE_SEARCH_PARAMS = {"metric_type": "COSINE", "params": {}}
+SPARSE_SEARCH_PARAMS = {"metric_type": "IP", "params": {}}
 
-# ef = BGEM3EmbeddingFunction(device="cuda", use_fp16=False)
-ef = BGEM3EmbeddingFunction(device="cpu", use_fp16=False)
 
 def dense_search(col, query_dense_embedding, limit=10):
-    search_params = {"metric_type": "COSINE", "params": {}}
     res = col.search(
         [query_dense_embedding],
         anns_field="dense_vector",
         limit=limit,
-        output_fields=["id", "title", "author", "abstract"],
-        param=search_params,
+        output_fields=OUTPUT_FIELDS,
+        param=DENSE_SEARCH_PARAMS,
     )[0]
     return res
 
 def sparse_search(col, query_sparse_embedding, limit=10):
-    search_params = {"metric_type": "IP", "params": {}}
     res = col.search(
         [query_sparse_embedding],
         anns_field="sparse_vector",
         limit=limit,
-        output_fields=["id", "title", "author", "abstract"],
-        param=search_params,
+        output_fields=OUTPUT_FIELDS,
+        param=SPARSE_SEARCH_PARAMS,
     )[0]
     return res
 
+
+def _fuse(sparse_hits, dense_hits, sparse_weight, dense_weight, limit, strategy, rrf_k):
+    return fuse_hits(
+        [sparse_hits, dense_hits],
+        weights=[sparse_weight, dense_weight],
+        metric_types=[SPARSE_SEARCH_PARAMS["metric_type"], DENSE_SEARCH_PARAMS["metric_type"]],
+        strategy=strategy,
+        rrf_k=rrf_k,
+        limit=limit,
+    )
+
+
 def hybrid_search(
     col,
     query_dense_embedding,
@@ -54,42 +330,64 @@ def hybrid_search(
     sparse_weight=1.0,
     dense_weight=1.0,
     limit=10,
+    strategy="weighted",
+    rrf_k=60,
+    candidate_factor=FUSION_CANDIDATE_FACTOR,
 ):
-    dense_search_params = {"metric_type": "COSINE", "params": {}}
-    dense_req = AnnSearchRequest(
-        [query_dense_embedding], "dense_vector", dense_search_params, limit=limit
-    )
-
-    sparse_search_params = {"metric_type": "IP", "params": {}}
-    sparse_req = AnnSearchRequest(
-        [query_sparse_embedding], "sparse_vector", sparse_search_params, limit=limit
-    )
-
-    # rerank = RRFRanker(60)
-    rerank = WeightedRanker(0.5, 0.5)
-
-    res = col.hybrid_search(
-        [sparse_req, dense_req],
-        rerank=rerank,
-        limit=limit,
-        output_fields=["id", "title", "author", "abstract"],
-    )[0]
-    return res
-
-
-def display_hybrid_results_as_json(ef, query, collection, sparse_weight=0.7, dense_weight=1.0, limit=5):
-
-    output = ef([query])
-    dense_query = output["dense"][0]
-    sparse_query = output["sparse"][[0]]
+    # Each leg returns a deeper pool than the final limit so fusion can promote
+    # documents that only one leg ranks highly.
+    pool = limit * max(1, candidate_factor)
+    sparse_hits = sparse_search(col, query_sparse_embedding, pool)
+    dense_hits = dense_search(col, query_dense_embedding, pool)
+    return _fuse(sparse_hits, dense_hits, sparse_weight, dense_weight, limit, strategy, rrf_k)
 
 
+async def hybrid_search_async(
+    col,
+    query_dense_embedding,
+    query_sparse_embedding,
+    sparse_weight=1.0,
+    dense_weight=1.0,
+    limit=10,
+    strategy="weighted",
+    rrf_k=60,
+    candidate_factor=FUSION_CANDIDATE_FACTOR,
+):
+    if isinstance(col, LocalCollection):
+        args = (
+            col, query_dense_embedding, query_sparse_embedding,
+            sparse_weight, dense_weight, limit, strategy, rrf_k, candidate_factor,
+        )
+        # A small collection is searched faster than a hop to the executor takes;
+        # a large one would hold up every other request on the loop.
+        if len(col.records) <= LOCAL_INLINE_SEARCH_ROWS:
+            return hybrid_search(*args)
+        return await asyncio.get_running_loop().run_in_executor(resources.executor, hybrid_search, *args)
 
-    hits = hybrid_search(collection, dense_query, sparse_query, sparse_weight, dense_weight, limit)
+    pool = limit * max(1, candidate_factor)
+    client = resources.async_client
+    sparse_res, dense_res = await asyncio.gather(
+        client.search(
+            col.name,
+            [query_sparse_embedding],
+            limit=pool,
+            output_fields=OUTPUT_FIELDS,
+            search_params=SPARSE_SEARCH_PARAMS,
+            anns_field="sparse_vector",
+        ),
+        client.search(
+            col.name,
+            [query_dense_embedding],
+            limit=pool,
+            output_fields=OUTPUT_FIELDS,
+            search_params=DENSE_SEARCH_PARAMS,
+            anns_field="dense_vector",
+        ),
+    )
+    return _fuse(sparse_res[0], dense_res[0], sparse_weight, dense_weight, limit, strategy, rrf_k)
 
-    docs = [hit.entity.get("abstract", "") for hit in hits]
-    highlight_infos = extract_highlight_spans(ef, query, docs)
 
+def _build_results(hits, highlight_infos):
     results = []
     for hit, highlight_info in zip(hits, highlight_infos):
         result = {
@@ -102,25 +400,132 @@ def display_hybrid_results_as_json(ef, query, collection, sparse_weight=0.7, den
             "highlights": highlight_info["highlights"]
         }
         results.append(result)
+    return results
+
 
-    for r in results:
-        print("=" * 60)
-        print(f"ID: {r['id']}")
-        print(f"Title: {r['title']}")
-        print(f"URL: {r['url']}")
-        print(f"Author: {r['author']}")
-        print(f"Score: {r['score']:.4f}")
-        print(f"Abstract: {r['abstract_text']}")
-        print(f"Highlights (char indices): {r['highlights']}")
-        print("=" * 60)
-        print()
+def display_hybrid_results_as_json(ef, query, collection, sparse_weight=0.7, dense_weight=1.0, limit=5,
+                                   strategy="weighted", rrf_k=60, candidate_factor=FUSION_CANDIDATE_FACTOR,
+                                   verbose=True):
+
+    with stage("embed"):
+        output = ef([query])
+        dense_query = output["dense"][0]
+        sparse_query = output["sparse"][[0]]
+
+    with stage("retrieve"):
+        hits = hybrid_search(
+            collection, dense_query, sparse_query, sparse_weight, dense_weight, limit,
+            strategy, rrf_k, candidate_factor,
+        )
+
+    with stage("highlight"):
+        docs = [hit.entity.get("abstract", "") for hit in hits]
+        doc_ids = [hit.entity.get("id", "") for hit in hits]
+        highlight_infos = extract_highlight_spans(ef, query, docs, doc_ids, resources.token_store)
+
+    with stage("build"):
+        results = _build_results(hits, highlight_infos)
+    if verbose:
+        print(format_results(results))
 
     return results
 
 
+async def retrieve_async(ef, query, collection, sparse_weight=0.7, dense_weight=1.0, limit=5,
+                         strategy="weighted", rrf_k=60, candidate_factor=FUSION_CANDIDATE_FACTOR):
+    # The embed and retrieve stages of the async path: ranked hits, not yet highlighted.
+    with stage("embed"):
+        dense_query, sparse_query = await ef.embed_async(query)
+
+    with stage("retrieve"):
+        return await hybrid_search_async(
+            collection, dense_query, sparse_query, sparse_weight, dense_weight, limit,
+            strategy, rrf_k, candidate_factor,
+        )
+
+
+async def display_hybrid_results_as_json_async(ef, query, collection, sparse_weight=0.7, dense_weight=1.0, limit=5,
+                                               strategy="weighted", rrf_k=60,
+                                               candidate_factor=FUSION_CANDIDATE_FACTOR):
+    """
+    Same as ``display_hybrid_results_as_json`` but never blocks the event loop:
+    ``ef`` must be a ``CachedEmbeddingFunction``, Milvus is queried through
+    ``AsyncMilvusClient`` and highlighting runs on ``resources.executor``. Cancelling the
+    coroutine drops any stage that has not started yet. Each stage is timed
+    on the request's trace, including its wait for the batcher or executor.
+    """
+    loop = asyncio.get_running_loop()
+
+    hits = await retrieve_async(
+        ef, query, collection, sparse_weight, dense_weight, limit, strategy, rrf_k, candidate_factor,
+    )
+
+    with stage("highlight"):
+        docs = [hit.entity.get("abstract", "") for hit in hits]
+        doc_ids = [hit.entity.get("id", "") for hit in hits]
+        highlight_infos = await loop.run_in_executor(
+            resources.executor, extract_highlight_spans, ef, query, docs, doc_ids, resources.token_store
+        )
+
+    with stage("build"):
+        results = _build_results(hits, highlight_infos)
+    log_search(
+        query, results, top_k=limit, fusion=strategy, sparse_weight=sparse_weight, dense_weight=dense_weight,
+        rrf_k=rrf_k, candidate_factor=candidate_factor,
+    )
+
+    return results
+
+
+def unhighlighted_results(hits):
+    # The results of ``hits`` before highlighting: full abstracts, no spans.
+    return _build_results(hits, [{"text": hit.entity.get("abstract", ""), "highlights": []} for hit in hits])
+
+
+async def stream_highlights(ef, query, hits):
+    """
+    Yields (rank, highlight info) for each hit as soon as its spans are ready.
+    Papers are highlighted in rank order, in chunks of 1, 2, 4, ... papers run
+    as separate tasks on ``resources.executor``: the top result comes back
+    after a single paper's work, while the batched tokenization of larger
+    chunks keeps the total close to highlighting all hits at once. Closing
+    the generator cancels the chunks that have not started. Each chunk's
+    executor call is timed as a "highlight" stage; time spent suspended at a
+    ``yield``, waiting for the client to read, is not.
+    """
+    loop = asyncio.get_running_loop()
+
+    async def highlight(ranks):
+        chunk = [hits[rank] for rank in ranks]
+        with stage("highlight"):
+            infos = await loop.run_in_executor(
+                resources.executor, extract_highlight_spans, ef, query,
+                [hit.entity.get("abstract", "") for hit in chunk], [hit.entity.get("id", "") for hit in chunk],
+                resources.token_store,
+            )
+        return list(zip(ranks, infos))
+
+    chunks = []
+    start, size = 0, 1
+    while start < len(hits):
+        chunks.append(list(range(start, min(start + size, len(hits)))))
+        start += size
+        size *= 2
+
+    tasks = [asyncio.ensure_future(highlight(ranks)) for ranks in chunks]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            for rank_info in await next_done:
+                yield rank_info
+    finally:
+        for task in tasks:
+            task.cancel()
+
 
 if __name__ == "__main__":
     query = "I plan to develop a new information retrieval system that uses a graph structure to represent the semantic relationships between documents. This system will combine traditional vector space models with the latest graph neural network technology, aiming to improve the precision and recall of retrieval, especially for complex multi-hop queries."
 
     ### the query containing ID, URL, AUTHOR, SCORE .....
-    result = display_hybrid_results_as_json(ef, query, collection, sparse_weight=0.5, dense_weight=0.5, limit=10)
+    result = display_hybrid_results_as_json(
+        resources.ef, query, resources.collection, sparse_weight=0.5, dense_weight=0.5, limit=10
+    )
@@ -0,0 +1,158 @@
+import os
+import sys
+
+import numpy as np
+import scipy.sparse
+
+
+# Layout of an exported model directory:
+#   model.onnx (+ model.onnx.data)   float32 graph: (input_ids, attention_mask) -> (dense, sparse_weights)
+#   model_int8.onnx                  the same graph with dynamically quantized int8 weights
+#   tokenizer files                  the BGE-M3 tokenizer, saved with save_pretrained
+MODEL_NAME = "BAAI/bge-m3"
+FP32_FILE = "model.onnx"
+INT8_FILE = "model_int8.onnx"
+OPSET = 17
+
+
+def export_onnx(out_dir, model_name=MODEL_NAME, quantize=True):
+    """
+    Exports the BGE-M3 encoder with the dense (normalized CLS) and sparse
+    (ReLU of the sparse_linear head per token) outputs that
+    BGEM3EmbeddingFunction computes, then writes an int8 copy with
+    onnxruntime's dynamic quantization.
+    """
+    import torch
+    from huggingface_hub import hf_hub_download
+    from transformers import AutoModel, AutoTokenizer
+
+    class BGEM3Heads(torch.nn.Module):
+        def __init__(self, encoder, sparse_linear):
+            super().__init__()
+            self.encoder = encoder
+            self.sparse_linear = sparse_linear
+
+        def forward(self, input_ids, attention_mask):
+            hidden = self.encoder(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state
+            dense = torch.nn.functional.normalize(hidden[:, 0], dim=-1)
+            sparse = torch.relu(self.sparse_linear(hidden)).squeeze(-1)
+            return dense, sparse
+
+    os.makedirs(out_dir, exist_ok=True)
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    encoder = AutoModel.from_pretrained(model_name).eval()
+    sparse_linear = torch.nn.Linear(encoder.config.hidden_size, 1)
+    sparse_linear.load_state_dict(torch.load(_model_file(model_name, "sparse_linear.pt", hf_hub_download),
+                                             map_location="cpu"))
+    model = BGEM3Heads(encoder, sparse_linear).eval()
+
+    sample = tokenizer(["an example query", "a second, somewhat longer example query"],
+                       padding=True, return_tensors="pt")
+    fp32_path = os.path.join(out_dir, FP32_FILE)
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            (sample["input_ids"], sample["attention_mask"]),
+            fp32_path,
+            input_names=["input_ids", "attention_mask"],
+            output_names=["dense", "sparse_weights"],
+            dynamic_axes={
+                "input_ids": {0: "batch", 1: "sequence"},
+                "attention_mask": {0: "batch", 1: "sequence"},
+                "dense": {0: "batch"},
+                "sparse_weights": {0: "batch", 1: "sequence"},
+            },
+            opset_version=OPSET,
+            dynamo=False,
+        )
+    tokenizer.save_pretrained(out_dir)
+
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        quantize_dynamic(
+            fp32_path,
+            os.path.join(out_dir, INT8_FILE),
+            weight_type=QuantType.QInt8,
+            # The float32 BGE-M3 graph is over protobuf's 2GB limit.
+            use_external_data_format=os.path.exists(fp32_path + ".data"),
+        )
+
+
+def _model_file(model_name, filename, hf_hub_download):
+    if os.path.isdir(model_name):
+        return os.path.join(model_name, filename)
+    return hf_hub_download(model_name, filename)
+
+
+class _TokenizerHolder:
+    # highlighting reads ``ef.model.tokenizer``, as on BGEM3EmbeddingFunction.
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+
+
+class OnnxBGEM3EmbeddingFunction:
+    """
+    Drop-in for ``BGEM3EmbeddingFunction`` on CPU: ``__call__(texts)`` returns
+    ``{"dense": [np.ndarray], "sparse": csr_array}`` computed by an exported
+    graph in onnxruntime, and ``.model.tokenizer`` / ``.dim`` match.
+    """
+
+    def __init__(self, model_dir, model_file=INT8_FILE, max_length=8192, threads=0):
+        import onnxruntime
+        from transformers import AutoTokenizer
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(
+            os.path.join(model_dir, model_file), options, providers=["CPUExecutionProvider"]
+        )
+        tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.model = _TokenizerHolder(tokenizer)
+        self.max_length = max_length
+        self.vocab_size = len(tokenizer)
+        # BGE-M3 drops these from the lexical weights.
+        self.unused_tokens = np.asarray(sorted({
+            token_id for token_id in (
+                tokenizer.cls_token_id, tokenizer.eos_token_id, tokenizer.pad_token_id, tokenizer.unk_token_id
+            ) if token_id is not None
+        }))
+        dense_dim = self.session.get_outputs()[0].shape[-1]
+        self.dim = {"dense": dense_dim if isinstance(dense_dim, int) else 1024, "sparse": self.vocab_size}
+
+    def __call__(self, texts):
+        encoded = self.model.tokenizer(
+            list(texts), padding=True, truncation=True, max_length=self.max_length, return_tensors="np"
+        )
+        input_ids = encoded["input_ids"].astype(np.int64)
+        attention_mask = encoded["attention_mask"].astype(np.int64)
+        dense, weights = self.session.run(None, {"input_ids": input_ids, "attention_mask": attention_mask})
+        return {
+            "dense": list(dense.astype(np.float32)),
+            "sparse": self._lexical_weights(input_ids, attention_mask, weights),
+        }
+
+    def _lexical_weights(self, input_ids, attention_mask, weights):
+        # Per text, the max weight of every distinct token id, like
+        # BGEM3FlagModel._process_token_weights but over the whole batch at once.
+        keep = (attention_mask > 0) & (weights > 0) & ~np.isin(input_ids, self.unused_tokens)
+        rows, positions = np.nonzero(keep)
+        token_ids = input_ids[rows, positions]
+        values = weights[rows, positions].astype(np.float32)
+
+        order = np.lexsort((token_ids, rows))
+        rows, token_ids, values = rows[order], token_ids[order], values[order]
+        starts = np.flatnonzero(np.r_[True, (rows[1:] != rows[:-1]) | (token_ids[1:] != token_ids[:-1])]) \
+            if len(rows) else np.empty(0, dtype=np.int64)
+        maxima = np.maximum.reduceat(values, starts) if len(starts) else values
+        return scipy.sparse.csr_array(
+            (maxima, (rows[starts], token_ids[starts])), shape=(input_ids.shape[0], self.vocab_size)
+        )
+
+
+if __name__ == "__main__":
+    # python onnxEncoder.py <out_dir> [model name or local path]
+    export_onnx(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else MODEL_NAME)
+    print(f"Exported {sys.argv[1]}")
@@ -0,0 +1,164 @@
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import time
+
+from config import LOG_QUEUE_SIZE, RESULT_LOG_SAMPLE_RATE, QUERY_LOG_PATH, QUERY_LOG_MAX_MB, QUERY_LOG_BACKUPS
+from telemetry import current_trace, metrics
+
+
+# Request-path logging. Records go onto a bounded in-process queue and are
+# formatted and written by one listener thread, so a slow terminal or log
+# collector never holds up a request. When the queue is full, records are
+# dropped and counted rather than waited on.
+#   researchy.trace    one JSON line per request (telemetry.py, TRACE_LOG=1)
+#   researchy.results  full result dumps of a RESULT_LOG_SAMPLE_RATE sample of searches
+#   researchy.replay   query/result pairs as JSONL in QUERY_LOG_PATH, rotated by size
+logger = logging.getLogger("researchy")
+results_logger = logging.getLogger("researchy.results")
+replay_logger = logging.getLogger("researchy.replay")
+
+metrics.describe("log_records_dropped_total", "Log records dropped because the logging queue was full.")
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Formatting is left to the listener thread; the queue never leaves
+        # this process, so the record is passed on as is.
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.inc("log_records_dropped_total")
+
+
+class _JsonFormatter(logging.Formatter):
+    def format(self, record):
+        return json.dumps(record.msg, ensure_ascii=False, default=_json_default)
+
+
+def _json_default(value):
+    return value.to_json() if isinstance(value, _CachedResults) else float(value)
+
+
+class _CachedResults:
+    # Ids and scores of a cached /search body, parsed by the listener thread.
+    # The cached scores are the response's, rounded to four places.
+    def __init__(self, body):
+        self.body = body
+
+    def to_json(self):
+        return [{"id": r["id"], "score": r["similarityScore"]} for r in json.loads(self.body)["results"]]
+
+
+class _ResultDump:
+    # Rendered by the listener thread, when the record is written.
+    def __init__(self, trace_id, query, results):
+        self.trace_id = trace_id
+        self.query = query
+        self.results = results
+
+    def __str__(self):
+        return f"trace {self.trace_id} query {self.query!r}\n" + format_results(self.results)
+
+
+def format_results(results):
+    blocks = []
+    for r in results:
+        blocks.append("\n".join([
+            "=" * 60,
+            f"ID: {r['id']}",
+            f"Title: {r['title']}",
+            f"URL: {r['url']}",
+            f"Author: {r['author']}",
+            f"Score: {r['score']:.4f}",
+            f"Abstract: {r['abstract_text']}",
+            f"Highlights (char indices): {r['highlights']}",
+            "=" * 60,
+            "",
+        ]))
+    return "\n".join(blocks)
+
+
+_queue = queue.Queue(LOG_QUEUE_SIZE)
+_listener = None
+
+# Attached at import, so records logged before ``start`` wait in the queue.
+logger.addHandler(_DroppingQueueHandler(_queue))
+logger.setLevel(logging.INFO)
+logger.propagate = False
+metrics.add_collector(lambda: [("log_queue_depth", "gauge", "Log records waiting to be written.", {}, _queue.qsize())])
+
+
+def start():
+    # Started from the app's lifespan: a listener thread created before a
+    # pre-forking server forks would not exist in its workers.
+    global _listener
+    if _listener is not None:
+        return
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter("%(message)s"))
+    console.addFilter(lambda record: record.name != replay_logger.name)
+    handlers = [console]
+    if QUERY_LOG_PATH:
+        os.makedirs(os.path.dirname(os.path.abspath(QUERY_LOG_PATH)), exist_ok=True)
+        replay = logging.handlers.RotatingFileHandler(
+            QUERY_LOG_PATH, maxBytes=int(QUERY_LOG_MAX_MB * 1024 * 1024), backupCount=QUERY_LOG_BACKUPS,
+            encoding="utf-8",
+        )
+        replay.setFormatter(_JsonFormatter())
+        replay.addFilter(lambda record: record.name == replay_logger.name)
+        handlers.append(replay)
+    _listener = logging.handlers.QueueListener(_queue, *handlers)
+    _listener.start()
+
+
+def stop():
+    # Writes out whatever is still queued.
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+def log_search(query, results, **params):
+    """
+    Called once per /search with the request's fusion settings. Costs a
+    random draw and a queue put; nothing is formatted or written here.
+    """
+    if not (RESULT_LOG_SAMPLE_RATE or QUERY_LOG_PATH):
+        return
+    trace = current_trace()
+    trace_id = trace.trace_id if trace is not None else None
+    if RESULT_LOG_SAMPLE_RATE and random.random() < RESULT_LOG_SAMPLE_RATE:
+        results_logger.info("%s", _ResultDump(trace_id, query, results))
+    if QUERY_LOG_PATH:
+        replay_logger.info({
+            "time": round(time.time(), 3),
+            "trace_id": trace_id,
+            "query": query,
+            **params,
+            "results": [{"id": r["id"], "score": r["score"]} for r in results],
+        })
+
+
+def log_cached_search(query, body, **params):
+    # A /search answered from the result cache: only the replay record, so the
+    # query log still reflects every request. ``body`` is the cached response.
+    if not QUERY_LOG_PATH:
+        return
+    trace = current_trace()
+    replay_logger.info({
+        "time": round(time.time(), 3),
+        "trace_id": trace.trace_id if trace is not None else None,
+        "query": query,
+        **params,
+        "results": _CachedResults(body),
+    })
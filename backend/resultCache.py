@@ -0,0 +1,276 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from embeddingCache import normalize_query
+
+
+# Serialized /search responses keyed by the normalized query, every setting
+# that changes the ranking and a namespace naming the backend, collection and
+# query encoder. Each entry records the corpus version it was computed
+# against; every script that rewrites a servable store bumps that version,
+# and entries of any other version are treated as misses.
+KEY_FIELDS = ["top_k", "fusion", "sparse_weight", "dense_weight", "rrf_k", "candidate_factor"]
+
+
+def result_key(request, namespace=""):
+    # ``request``: the fields of a SearchRequest.
+    settings = [request[field] for field in KEY_FIELDS]
+    content = json.dumps([namespace, normalize_query(request["query"]), settings])
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def bump_corpus_version(path, **info):
+    # Written atomically, so a server never reads a partial stamp.
+    stamp = {"version": uuid.uuid4().hex, "updated": time.time(), **info}
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(stamp, f)
+    os.replace(tmp_path, path)
+    return stamp["version"]
+
+
+class CorpusVersion:
+    # Stats the stamp file on every call and re-reads it only when it changed,
+    # so every worker notices a bump without polling or signals.
+    def __init__(self, path):
+        self.path = path
+        self._mtime = None
+        self._value = "none"
+
+    def current(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime != self._mtime:
+            value = "none"
+            if mtime is not None:
+                try:
+                    with open(self.path, "r", encoding="utf-8") as f:
+                        value = json.load(f)["version"]
+                except (OSError, ValueError, KeyError):
+                    return self._value
+            self._mtime, self._value = mtime, value
+        return self._value
+
+
+class SqliteResultStore:
+    """
+    Shared tier on a local sqlite file (WAL mode), so uvicorn workers on one
+    host see each other's entries. Any object with the same get / put /
+    discard_other_versions / close methods, such as a client for a network
+    cache, can be passed to ResultCache instead.
+
+    Reads use their own connection, so a lookup never waits for a write in
+    progress. The total body size is kept in a one-row table by triggers,
+    which every worker's writes update, instead of being summed on each put.
+    """
+
+    def __init__(self, path, max_bytes):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._read_lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=5)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("BEGIN IMMEDIATE")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            " key TEXT PRIMARY KEY, version TEXT, expires REAL, count INTEGER, body BLOB, written REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS results_written ON results (written)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS usage (id INTEGER PRIMARY KEY CHECK (id = 0), bytes INTEGER, rows INTEGER)"
+        )
+        # Seeds the totals of a file written before the usage table existed.
+        self._conn.execute(
+            "INSERT OR IGNORE INTO usage SELECT 0, COALESCE(SUM(LENGTH(body)), 0), COUNT(*) FROM results"
+        )
+        self._conn.execute(
+            "CREATE TRIGGER IF NOT EXISTS results_added AFTER INSERT ON results BEGIN"
+            " UPDATE usage SET bytes = bytes + LENGTH(NEW.body), rows = rows + 1; END"
+        )
+        self._conn.execute(
+            "CREATE TRIGGER IF NOT EXISTS results_removed AFTER DELETE ON results BEGIN"
+            " UPDATE usage SET bytes = bytes - LENGTH(OLD.body), rows = rows - 1; END"
+        )
+        self._conn.commit()
+        self._reader = sqlite3.connect(path, check_same_thread=False, timeout=5)
+
+    def get(self, key):
+        # (version, expires, count, body) or None.
+        with self._read_lock:
+            return self._reader.execute(
+                "SELECT version, expires, count, body FROM results WHERE key = ?", (key,)
+            ).fetchone()
+
+    def put(self, key, version, expires, count, body):
+        # Oldest writes go first once the bodies exceed max_bytes; returns how many.
+        with self._lock:
+            # Delete, then insert: INSERT OR REPLACE would not fire the delete trigger.
+            self._conn.execute("DELETE FROM results WHERE key = ?", (key,))
+            self._conn.execute(
+                "INSERT INTO results VALUES (?, ?, ?, ?, ?, ?)",
+                (key, version, expires, count, body, time.time()),
+            )
+            total, rows = self._conn.execute("SELECT bytes, rows FROM usage").fetchone()
+            evicted = 0
+            while total > self.max_bytes and rows > 1:
+                oldest, nbytes = self._conn.execute(
+                    "SELECT key, LENGTH(body) FROM results ORDER BY written LIMIT 1"
+                ).fetchone()
+                self._conn.execute("DELETE FROM results WHERE key = ?", (oldest,))
+                total -= nbytes
+                rows -= 1
+                evicted += 1
+            self._conn.commit()
+            return evicted
+
+    def discard_other_versions(self, version):
+        with self._lock:
+            self._conn.execute("DELETE FROM results WHERE version != ?", (version,))
+            self._conn.commit()
+
+    def __len__(self):
+        with self._read_lock:
+            return self._reader.execute("SELECT rows FROM usage").fetchone()[0]
+
+    def close(self):
+        with self._lock, self._read_lock:
+            self._conn.close()
+            self._reader.close()
+
+
+class ResultCache:
+    """
+    In-memory LRU of serialized responses, bounded by ``max_mb`` of bodies,
+    with a ``ttl`` in seconds (0: entries only expire with the corpus
+    version) and an optional shared store behind it. The in-memory lookup
+    runs on the event loop; reads of the shared store run in a thread, and
+    writes to it go through a background thread.
+    """
+
+    def __init__(self, version, max_mb=32, ttl=3600, shared=None, namespace=""):
+        self.version = version
+        self.namespace = namespace
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.ttl = ttl
+        self.shared = shared
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._seen_version = None
+        self._lock = threading.Lock()
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="result-cache") if shared is not None else None
+
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+        self.shared_evictions = 0
+
+    def key(self, request):
+        return result_key(request, self.namespace)
+
+    def current_version(self):
+        version = self.version.current()
+        if version != self._seen_version:
+            # A new corpus: nothing cached so far can be served again.
+            with self._lock:
+                self._entries.clear()
+                self._bytes = 0
+            if self._writer is not None and self._seen_version is not None:
+                self._writer.submit(self.shared.discard_other_versions, version)
+            self._seen_version = version
+        return version
+
+    async def get(self, key, version):
+        # (result count, body) of a live entry, or None.
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if self._live(entry, version, now):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[2], entry[3]
+                self._pop(key)
+                self.stale += 1
+
+        if self.shared is not None:
+            entry = await asyncio.to_thread(self.shared.get, key)
+            if entry is not None and self._live(entry, version, now):
+                with self._lock:
+                    self.shared_hits += 1
+                    self._put_memory(key, tuple(entry))
+                return entry[2], entry[3]
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, version, count, body):
+        expires = time.time() + self.ttl if self.ttl else 0.0
+        entry = (version, expires, count, body)
+        with self._lock:
+            self._put_memory(key, entry)
+        if self._writer is not None:
+            self._writer.submit(self._put_shared, key, entry)
+
+    def _put_shared(self, key, entry):
+        evicted = self.shared.put(key, *entry)
+        with self._lock:
+            self.shared_evictions += evicted
+
+    @staticmethod
+    def _live(entry, version, now):
+        version_of, expires = entry[0], entry[1]
+        return version_of == version and (not expires or expires > now)
+
+    def _pop(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= len(entry[3])
+
+    def _put_memory(self, key, entry):
+        if len(entry[3]) > self.max_bytes:
+            return
+        if key in self._entries:
+            self._pop(key)
+        self._entries[key] = entry
+        self._bytes += len(entry[3])
+        while self._bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._pop(oldest)
+            self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.shared_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "size_mb": self._bytes / (1024 * 1024),
+                "max_mb": self.max_bytes / (1024 * 1024),
+                "ttl": self.ttl,
+                "corpus_version": self._seen_version,
+                "hits": self.hits,
+                "shared_hits": self.shared_hits,
+                "misses": self.misses,
+                "stale": self.stale,
+                "evictions": self.evictions,
+                "shared_evictions": self.shared_evictions,
+                "hit_rate": (self.hits + self.shared_hits) / lookups if lookups else 0.0,
+            }
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.shutdown(wait=True)
+            self.shared.close()
@@ -0,0 +1,270 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import scipy.sparse
+
+
+# Layout of a shard directory:
+#   shard_00000.dense.npy   float32 [rows, dim]
+#   shard_00000.sparse.npz  CSR [rows, vocab]
+#   staged_*.npy / .npz     a shard written by an ingest worker, renamed to shard_* once committed
+#   manifest.jsonl          one line per committed shard: ids, content hashes, row offset,
+#                           JSONL line range (or line numbers for a delta shard), deleted ids
+#   checkpoint.json         shards committed / submitted to Milvus / inserted so far; rewritten atomically
+MANIFEST = "manifest.jsonl"
+CHECKPOINT = "checkpoint.json"
+# Fields stored in Milvus; a change to any of them makes a paper "changed".
+RECORD_FIELDS = ["id", "title", "author", "link", "time", "abstract"]
+
+
+def iter_jsonl(path, start_line=0):
+    # Yields (line number, record) lazily, skipping blank lines and every line before start_line.
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f):
+            if line_no < start_line or not line.strip():
+                continue
+            yield line_no, json.loads(line)
+
+
+def read_lines(path, line_numbers):
+    # Parses only the requested lines; returns {line number: record}.
+    wanted = set(line_numbers)
+    records = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f):
+            if line_no in wanted:
+                records[line_no] = json.loads(line)
+                if len(records) == len(wanted):
+                    break
+    return records
+
+
+def record_hash(item):
+    content = json.dumps([item.get(key, "") for key in RECORD_FIELDS], ensure_ascii=False)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()[:16]
+
+
+def write_shard_files(root, name, dense, sparse):
+    np.save(os.path.join(root, f"{name}.dense.npy"), np.asarray(dense, dtype=np.float32))
+    scipy.sparse.save_npz(os.path.join(root, f"{name}.sparse.npz"), scipy.sparse.csr_matrix(sparse))
+
+
+def _write_json_atomic(path, value):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(value, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class ShardStore:
+    """
+    Append-only embedding shards with a manifest and a checkpoint, so an ingest
+    run holds one chunk of vectors in memory at a time and a restarted run
+    continues after the last committed shard.
+
+    A paper's live vectors are those of the last shard that lists its id; a
+    later shard's ``deleted`` ids drop papers from the live set. Incremental
+    ingests only ever append, so shards written earlier are never modified.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self.checkpoint = self._read_checkpoint()
+        self.entries = self._read_manifest()
+        self._discard_uncommitted()
+
+    def _read_checkpoint(self):
+        path = os.path.join(self.root, CHECKPOINT)
+        if not os.path.exists(path):
+            return {"committed_shards": 0, "next_line": 0, "rows": 0, "inserted_shards": 0, "submitted_shards": 0}
+        with open(path, "r", encoding="utf-8") as f:
+            checkpoint = json.load(f)
+        if "submitted_shards" not in checkpoint:
+            # Checkpoints that tracked a single in-flight shard by name.
+            inserting = checkpoint.pop("inserting_shard", None)
+            submitted = int(inserting.split("_")[1]) + 1 if inserting else 0
+            checkpoint["submitted_shards"] = max(submitted, checkpoint["inserted_shards"])
+        return checkpoint
+
+    def _read_manifest(self):
+        path = os.path.join(self.root, MANIFEST)
+        entries = []
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    # A crash mid-append can leave a torn last line.
+                    try:
+                        entries.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        break
+        return entries
+
+    def _discard_uncommitted(self):
+        # Anything past the checkpoint belongs to a shard that was being written
+        # when the previous run stopped.
+        committed = self.checkpoint["committed_shards"]
+        if len(self.entries) != committed:
+            self.entries = self.entries[:committed]
+            with open(os.path.join(self.root, MANIFEST), "w", encoding="utf-8") as f:
+                for entry in self.entries:
+                    f.write(json.dumps(entry) + "\n")
+
+        names = {entry["name"] for entry in self.entries}
+        for filename in os.listdir(self.root):
+            # staged_* files are shards a worker finished but this process never committed.
+            if filename.startswith(("shard_", "staged_")) and filename.split(".")[0] not in names:
+                os.remove(os.path.join(self.root, filename))
+
+    @property
+    def next_line(self):
+        return self.checkpoint["next_line"]
+
+    @property
+    def rows(self):
+        return self.checkpoint["rows"]
+
+    def _shard_path(self, name, kind):
+        return os.path.join(self.root, f"{name}.{kind}")
+
+    def append(self, ids, dense, sparse, first_line, next_line, hashes=None, lines=None, deleted=None):
+        # ``lines`` lists the JSONL line of every row when they are not the
+        # contiguous range [first_line, next_line), as in a delta shard.
+        name = f"shard_{len(self.entries):05d}"
+        if len(ids):
+            write_shard_files(self.root, name, dense, sparse)
+        return self._commit(name, ids, first_line, next_line, hashes, lines, deleted)
+
+    def staged_name(self, first_line):
+        # Files written under this name by another process are committed with append_staged.
+        return f"staged_{first_line:09d}"
+
+    def append_staged(self, staged, ids, first_line, next_line, hashes=None, lines=None, deleted=None):
+        name = f"shard_{len(self.entries):05d}"
+        if len(ids):
+            for kind in ("dense.npy", "sparse.npz"):
+                os.replace(self._shard_path(staged, kind), self._shard_path(name, kind))
+        return self._commit(name, ids, first_line, next_line, hashes, lines, deleted)
+
+    def _commit(self, name, ids, first_line, next_line, hashes, lines, deleted):
+        index = len(self.entries)
+        entry = {
+            "name": name,
+            "offset": self.rows,
+            "rows": len(ids),
+            "first_line": first_line,
+            "next_line": next_line,
+            "ids": list(ids),
+        }
+        if hashes is not None:
+            entry["hashes"] = list(hashes)
+        if lines is not None:
+            entry["lines"] = list(lines)
+        if deleted:
+            entry["deleted"] = list(deleted)
+        with open(os.path.join(self.root, MANIFEST), "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.entries.append(entry)
+
+        self.checkpoint.update(committed_shards=index + 1, next_line=next_line, rows=self.rows + len(ids))
+        _write_json_atomic(os.path.join(self.root, CHECKPOINT), self.checkpoint)
+        return entry
+
+    def load_shard(self, entry, mmap=True):
+        dense = np.load(self._shard_path(entry["name"], "dense.npy"), mmap_mode="r" if mmap else None)
+        sparse = scipy.sparse.load_npz(self._shard_path(entry["name"], "sparse.npz")).tocsr()
+        return dense, sparse
+
+    def pending_inserts(self):
+        return self.entries[self.checkpoint["inserted_shards"]:]
+
+    def was_partially_inserted(self, entry):
+        # True when a previous run submitted rows of this shard but did not see
+        # them all complete. Several shards can be in flight at once, so every
+        # pending shard below the high-water mark may already be in Milvus.
+        return self.entries.index(entry) < self.checkpoint["submitted_shards"]
+
+    def mark_inserting(self, entry):
+        # Persisted before the shard's first RPC is sent.
+        index = self.entries.index(entry)
+        if index >= self.checkpoint["submitted_shards"]:
+            self.checkpoint["submitted_shards"] = index + 1
+            _write_json_atomic(os.path.join(self.root, CHECKPOINT), self.checkpoint)
+
+    def mark_inserted(self, entry):
+        # Callbacks run in submission order, so everything before ``entry`` is in too.
+        self.checkpoint["inserted_shards"] = self.entries.index(entry) + 1
+        _write_json_atomic(os.path.join(self.root, CHECKPOINT), self.checkpoint)
+
+    def ids(self):
+        return list(self.live_rows())
+
+    def live_rows(self):
+        # id -> (entry index, row within the shard, content hash or None for
+        # shards written before hashes were recorded).
+        live = {}
+        for index, entry in enumerate(self.entries):
+            for paper_id in entry.get("deleted", []):
+                live.pop(paper_id, None)
+            hashes = entry.get("hashes") or [None] * entry["rows"]
+            for row, (paper_id, content_hash) in enumerate(zip(entry["ids"], hashes)):
+                live[paper_id] = (index, row, content_hash)
+        return live
+
+    def needs_export(self, save_dir):
+        return (
+            not os.path.exists(os.path.join(save_dir, "dense.npy"))
+            or self.checkpoint.get("exported_shards") != len(self.entries)
+        )
+
+    def export(self, save_dir, order=None):
+        # Consolidates the live rows into the dense.npy / sparse.npz pair read by
+        # the local backend, in ``order`` (paper ids, default: live order) so they
+        # line up with the JSONL. The dense matrix is written through a memmap
+        # one shard at a time.
+        live = self.live_rows()
+        order = list(live) if order is None else list(order)
+        if not order:
+            return
+        missing = [paper_id for paper_id in order if paper_id not in live]
+        if missing:
+            raise ValueError(f"{len(missing)} papers have no embeddings in {self.root}, e.g. {missing[0]}")
+
+        # Group output positions by the shard that holds them.
+        by_entry = {}
+        for position, paper_id in enumerate(order):
+            index, row, _ = live[paper_id]
+            targets, rows = by_entry.setdefault(index, ([], []))
+            targets.append(position)
+            rows.append(row)
+
+        dim = self.load_shard(self.entries[next(iter(by_entry))])[0].shape[1]
+        os.makedirs(save_dir, exist_ok=True)
+
+        dense_tmp = os.path.join(save_dir, "dense.npy.tmp")
+        dense_out = np.lib.format.open_memmap(dense_tmp, mode="w+", dtype=np.float32, shape=(len(order), dim))
+        sparse_parts = []
+        sparse_targets = []
+        for index in sorted(by_entry):
+            targets, rows = by_entry[index]
+            dense, sparse = self.load_shard(self.entries[index])
+            dense_out[targets] = dense[rows]
+            sparse_parts.append(sparse[rows])
+            sparse_targets.extend(targets)
+        dense_out.flush()
+        del dense_out
+        os.replace(dense_tmp, os.path.join(save_dir, "dense.npy"))
+
+        sparse = scipy.sparse.vstack(sparse_parts, format="csr")[np.argsort(sparse_targets, kind="stable")]
+        sparse_tmp = os.path.join(save_dir, "sparse.tmp.npz")
+        scipy.sparse.save_npz(sparse_tmp, sparse)
+        os.replace(sparse_tmp, os.path.join(save_dir, "sparse.npz"))
+
+        self.checkpoint["exported_shards"] = len(self.entries)
+        _write_json_atomic(os.path.join(self.root, CHECKPOINT), self.checkpoint)
@@ -0,0 +1,224 @@
+import contextvars
+import json
+import logging
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from contextlib import contextmanager
+
+import numpy as np
+
+from config import TELEMETRY_WINDOW, TRACE_LOG
+
+
+# Prometheus-style metrics for the request path. Stage latencies go into
+# cumulative-bucket histograms (scraped from /metrics) and into a window of
+# the latest TELEMETRY_WINDOW samples, from which p50/p95/p99 are read.
+PREFIX = "researchy"
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUANTILES = (0.5, 0.95, 0.99)
+
+# Written off-thread by the queue listener in requestLog.py.
+trace_logger = logging.getLogger("researchy.trace")
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS, window=TELEMETRY_WINDOW):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.recent = np.zeros(max(1, window))
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.recent[self.count % len(self.recent)] = value
+        self.sum += value
+        self.count += 1
+
+    def quantiles(self, quantiles=QUANTILES):
+        if not self.count:
+            return {q: 0.0 for q in quantiles}
+        values = np.quantile(self.recent[:min(self.count, len(self.recent))], quantiles)
+        return dict(zip(quantiles, values.tolist()))
+
+
+def _labels(labels, **extra):
+    pairs = {**dict(labels), **extra}
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in pairs.items()) + "}"
+
+
+class Metrics:
+    """
+    Histograms and counters keyed by name and labels, plus collectors:
+    callables run at scrape time that return (name, kind, help, labels, value)
+    samples for state owned elsewhere, such as the embedding cache counters.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+        self._help = {}
+        self._collectors = []
+
+    def describe(self, name, help_text):
+        self._help[name] = help_text
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def latency(self, name):
+        # {labels: {"count", "mean", "p50", "p95", "p99"}} over the recent window, for JSON stats.
+        with self._lock:
+            summary = {}
+            for (hist_name, labels), histogram in self._histograms.items():
+                if hist_name != name:
+                    continue
+                quantiles = histogram.quantiles()
+                summary[",".join(value for _, value in labels) or "all"] = {
+                    "count": histogram.count,
+                    "mean": histogram.sum / histogram.count if histogram.count else 0.0,
+                    **{f"p{round(q * 100)}": value for q, value in quantiles.items()},
+                }
+            return summary
+
+    def render(self):
+        # Prometheus text exposition format, version 0.0.4.
+        lines = []
+
+        def header(name, kind):
+            if name in self._help:
+                lines.append(f"# HELP {PREFIX}_{name} {self._help[name]}")
+            lines.append(f"# TYPE {PREFIX}_{name} {kind}")
+
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+            for name in sorted({name for (name, _), _ in histograms}):
+                header(name, "histogram")
+                family = [(labels, histogram) for (hist_name, labels), histogram in histograms if hist_name == name]
+                for labels, histogram in family:
+                    cumulative = 0
+                    for bound, count in zip(list(histogram.buckets) + ["+Inf"], histogram.counts):
+                        cumulative += count
+                        lines.append(f"{PREFIX}_{name}_bucket{_labels(labels, le=bound)} {cumulative}")
+                    lines.append(f"{PREFIX}_{name}_sum{_labels(labels)} {histogram.sum}")
+                    lines.append(f"{PREFIX}_{name}_count{_labels(labels)} {histogram.count}")
+                # Quantiles of the recent window are a separate gauge family: a
+                # histogram family cannot carry quantile samples.
+                lines.append(f"# TYPE {PREFIX}_{name}_recent gauge")
+                for labels, histogram in family:
+                    for q, value in histogram.quantiles().items():
+                        lines.append(f"{PREFIX}_{name}_recent{_labels(labels, quantile=q)} {value}")
+
+            for name in sorted({name for (name, _), _ in counters}):
+                header(name, "counter")
+                for (counter_name, labels), value in counters:
+                    if counter_name == name:
+                        lines.append(f"{PREFIX}_{name}{_labels(labels)} {value}")
+
+        seen = set()
+        for collector in self._collectors:
+            for name, kind, help_text, labels, value in collector():
+                if name not in seen:
+                    seen.add(name)
+                    lines.append(f"# HELP {PREFIX}_{name} {help_text}")
+                    lines.append(f"# TYPE {PREFIX}_{name} {kind}")
+                lines.append(f"{PREFIX}_{name}{_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+metrics.describe("stage_seconds", "Time spent in each stage of the search pipeline.")
+metrics.describe("request_seconds", "Time from receiving a request to returning its response.")
+metrics.describe("stream_seconds", "Time from receiving a streamed request to its last line, or the client leaving.")
+metrics.describe("requests_total", "Requests handled, by route and status code.")
+metrics.describe("search_hits_total", "Papers returned by /search.")
+
+
+class RequestTrace:
+    """
+    Per-request record: a trace id (the client's X-Request-ID when given) and
+    the seconds spent in each stage, for the Server-Timing header and the
+    structured trace log.
+    """
+
+    def __init__(self, trace_id=None):
+        self.trace_id = trace_id or uuid.uuid4().hex
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.fields = {}
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def server_timing(self):
+        entries = [f"{name};dur={seconds * 1000:.2f}" for name, seconds in self.stages.items()]
+        entries.append(f"total;dur={self.elapsed() * 1000:.2f}")
+        return ", ".join(entries)
+
+    def finish(self, route, method, status):
+        seconds = self.elapsed()
+        metrics.observe("request_seconds", seconds, route=route)
+        metrics.inc("requests_total", route=route, method=method, status=str(status))
+        if TRACE_LOG:
+            trace_logger.info(json.dumps({
+                "trace_id": self.trace_id,
+                "route": route,
+                "method": method,
+                "status": status,
+                "ms": round(seconds * 1000, 2),
+                "stages_ms": {name: round(value * 1000, 2) for name, value in self.stages.items()},
+                **self.fields,
+            }))
+
+
+# Tasks started by a handler copy the context, so stages timed inside them
+# land on the request's trace. Executor threads do not: time those around the await.
+_current_trace = contextvars.ContextVar("request_trace", default=None)
+
+
+def start_trace(trace_id=None):
+    trace = RequestTrace(trace_id)
+    return trace, _current_trace.set(trace)
+
+
+def end_trace(token):
+    _current_trace.reset(token)
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+@contextmanager
+def stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        metrics.observe("stage_seconds", seconds, stage=name)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add(name, seconds)
@@ -0,0 +1,134 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+
+# Layout of a token store directory (all arrays memory-mapped on open):
+#   ids.json      paper ids, row order
+#   indptr.npy    int64 [n + 1]; tokens of row i are tokens[indptr[i]:indptr[i + 1]]
+#   tokens.npy    int32 [total]; token ids without CLS/SEP
+#   offsets.npy   int32 [total, 2]; character (start, end) of each token
+#   hashes.npy    int64 [n]; text_hash of the tokenized text, to detect stale rows
+STORE_FILES = ["ids.json", "indptr.npy", "tokens.npy", "offsets.npy", "hashes.npy"]
+
+
+def text_hash(text):
+    digest = hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little", signed=True)
+
+
+def _tokenize(tokenizer, texts, batch_size):
+    indptr = [0]
+    token_chunks = []
+    offset_chunks = []
+    for start in range(0, len(texts), batch_size):
+        batch = texts[start:start + batch_size]
+        encodings = tokenizer(batch, return_offsets_mapping=True, add_special_tokens=True)
+        for ids, offsets in zip(encodings["input_ids"], encodings["offset_mapping"]):
+            token_chunks.append(np.asarray(ids[1:-1], dtype=np.int32))
+            offset_chunks.append(np.asarray(offsets[1:-1], dtype=np.int32).reshape(-1, 2))
+            indptr.append(indptr[-1] + len(ids[1:-1]))
+
+    return (
+        np.asarray(indptr, dtype=np.int64),
+        np.concatenate(token_chunks) if token_chunks else np.empty(0, np.int32),
+        np.concatenate(offset_chunks) if offset_chunks else np.empty((0, 2), np.int32),
+        np.asarray([text_hash(text) for text in texts], dtype=np.int64),
+    )
+
+
+def _write_store(out_dir, paper_ids, indptr, tokens, offsets, hashes):
+    os.makedirs(out_dir, exist_ok=True)
+    tmp_dir = out_dir + ".tmp"
+    os.makedirs(tmp_dir, exist_ok=True)
+
+    np.save(os.path.join(tmp_dir, "indptr.npy"), indptr)
+    np.save(os.path.join(tmp_dir, "tokens.npy"), tokens)
+    np.save(os.path.join(tmp_dir, "offsets.npy"), offsets)
+    np.save(os.path.join(tmp_dir, "hashes.npy"), hashes)
+    with open(os.path.join(tmp_dir, "ids.json"), "w", encoding="utf-8") as f:
+        json.dump(list(paper_ids), f)
+
+    for name in STORE_FILES:
+        os.replace(os.path.join(tmp_dir, name), os.path.join(out_dir, name))
+    os.rmdir(tmp_dir)
+
+
+def build_token_store(tokenizer, paper_ids, texts, out_dir, batch_size=256):
+    _write_store(out_dir, paper_ids, *_tokenize(tokenizer, texts, batch_size))
+
+
+def append_token_store(tokenizer, paper_ids, texts, out_dir, removed=(), batch_size=256):
+    # Tokenizes only the given papers. The store is rewritten anyway, so it is
+    # compacted on the way: earlier rows of re-appended ids and the rows of
+    # ``removed`` ids are dropped.
+    store = TokenStore.open(out_dir)
+    if store is None:
+        return build_token_store(tokenizer, paper_ids, texts, out_dir, batch_size)
+
+    dropped = set(paper_ids) | set(removed)
+    kept_ids = [paper_id for paper_id in store.rows if paper_id not in dropped]
+    kept = np.asarray([store.rows[paper_id] for paper_id in kept_ids], dtype=np.int64)
+    starts = store.indptr[kept]
+    lengths = store.indptr[kept + 1] - starts
+    kept_indptr = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    # Token positions of the kept rows in the old arrays, in their new order.
+    positions = np.arange(kept_indptr[-1]) + np.repeat(starts - kept_indptr[:-1], lengths)
+
+    indptr, tokens, offsets, hashes = _tokenize(tokenizer, texts, batch_size)
+    arrays = (
+        np.concatenate([kept_indptr, indptr[1:] + kept_indptr[-1]]),
+        np.concatenate([store.tokens[positions], tokens]),
+        np.concatenate([store.offsets[positions], offsets]),
+        np.concatenate([store.hashes[kept], hashes]),
+    )
+    # Release the memory maps before their files are replaced.
+    del store
+    _write_store(out_dir, kept_ids + list(paper_ids), *arrays)
+
+
+class TokenStore:
+    """
+    Read-only view of the per-paper token ids and character offsets written at
+    ingest time, so highlighting only has to tokenize the query.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "ids.json"), "r", encoding="utf-8") as f:
+            self.rows = {paper_id: row for row, paper_id in enumerate(json.load(f))}
+        self.indptr = np.load(os.path.join(path, "indptr.npy"), mmap_mode="r")
+        self.tokens = np.load(os.path.join(path, "tokens.npy"), mmap_mode="r")
+        self.offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+        self.hashes = np.load(os.path.join(path, "hashes.npy"), mmap_mode="r")
+
+    @classmethod
+    def open(cls, path):
+        if all(os.path.exists(os.path.join(path, name)) for name in STORE_FILES):
+            return cls(path)
+        return None
+
+    def __len__(self):
+        return len(self.rows)
+
+    def matches(self, paper_ids, texts):
+        # True when the store holds exactly these papers, tokenized from these texts.
+        if len(paper_ids) != len(self.rows):
+            return False
+        for paper_id, text in zip(paper_ids, texts):
+            row = self.rows.get(paper_id)
+            if row is None or self.hashes[row] != text_hash(text):
+                return False
+        return True
+
+    def get(self, paper_id, text=None):
+        # With ``text``, a row tokenized from a different text counts as missing.
+        row = self.rows.get(paper_id)
+        if row is None:
+            return None
+        if text is not None and self.hashes[row] != text_hash(text):
+            return None
+        start, end = self.indptr[row], self.indptr[row + 1]
+        return self.tokens[start:end], self.offsets[start:end]
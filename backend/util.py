@@ -1,33 +1,107 @@
 import json
+from itertools import chain
+
+import numpy as np
+
+def _query_token_ids(tokenizer, query):
+    query_encoding = tokenizer(query, add_special_tokens=True)
+    # Drop CLS/SEP; a sorted unique id array makes the membership test a single np.isin.
+    return np.unique(np.asarray(query_encoding["input_ids"][1:-1], dtype=np.int64))
+
+
+def _flatten_doc_tokens(tokenizer, docs, doc_indices=None):
+    # One batched call to the fast tokenizer for all docs, flattened into
+    # (doc index, token id, char start, char end) arrays without CLS/SEP.
+    if doc_indices is None:
+        doc_indices = np.arange(len(docs))
+    encodings = tokenizer(list(docs), return_offsets_mapping=True, add_special_tokens=True)
+    ids_per_doc = [ids[1:-1] for ids in encodings["input_ids"]]
+    offsets_per_doc = [offsets[1:-1] for offsets in encodings["offset_mapping"]]
+
+    lengths = np.fromiter((len(ids) for ids in ids_per_doc), dtype=np.int64, count=len(docs))
+    total = int(lengths.sum())
+    doc_idx = np.repeat(np.asarray(doc_indices, dtype=np.int64), lengths)
+    token_ids = np.fromiter(chain.from_iterable(ids_per_doc), dtype=np.int64, count=total)
+    offsets = np.fromiter(
+        chain.from_iterable(chain.from_iterable(offsets_per_doc)), dtype=np.int64, count=2 * total
+    ).reshape(total, 2)
+    return doc_idx, token_ids, offsets
+
+
+def _stored_doc_tokens(tokenizer, docs, doc_ids, token_store):
+    # Docs found in the token store skip tokenization; the rest (unknown ids,
+    # or text that no longer matches the stored row) are tokenized as usual.
+    doc_idx = []
+    token_ids = []
+    offsets = []
+    missing = []
+    for i, (doc_id, doc) in enumerate(zip(doc_ids, docs)):
+        stored = token_store.get(doc_id, doc)
+        if stored is None:
+            missing.append(i)
+            continue
+        doc_idx.append(np.full(len(stored[0]), i, dtype=np.int64))
+        token_ids.append(stored[0])
+        offsets.append(stored[1])
+
+    if missing:
+        missing_idx, missing_ids, missing_offsets = _flatten_doc_tokens(
+            tokenizer, [docs[i] for i in missing], missing
+        )
+        doc_idx.append(missing_idx)
+        token_ids.append(missing_ids)
+        offsets.append(missing_offsets)
+
+    return (
+        np.concatenate(doc_idx),
+        np.concatenate(token_ids).astype(np.int64, copy=False),
+        np.concatenate(offsets).astype(np.int64, copy=False),
+    )
+
+
+def _merge_spans(doc_idx, starts, ends, num_docs):
+    merged = [[] for _ in range(num_docs)]
+    if len(starts) == 0:
+        return merged
+
+    order = np.lexsort((ends, starts, doc_idx))
+    doc_idx, starts, ends = doc_idx[order], starts[order], ends[order]
+
+    # Running max of span ends, reset per doc by offsetting each doc into its own range.
+    stride = int(ends.max()) + 1
+    running_end = np.maximum.accumulate(doc_idx * stride + ends) - doc_idx * stride
+
+    # A span starts a new merged span unless it overlaps or touches the one before it.
+    opens = np.ones(len(starts), dtype=bool)
+    opens[1:] = (doc_idx[1:] != doc_idx[:-1]) | (starts[1:] > running_end[:-1])
+    first = np.flatnonzero(opens)
+    last = np.append(first[1:] - 1, len(starts) - 1)
+
+    for doc, start, end in zip(doc_idx[first].tolist(), starts[first].tolist(), running_end[last].tolist()):
+        merged[doc].append((start, end))
+    return merged
+
+
+def _highlight_spans(tokenizer, query, docs, doc_ids=None, token_store=None):
+    query_ids = _query_token_ids(tokenizer, query)
+    if token_store is not None and doc_ids is not None:
+        doc_idx, token_ids, offsets = _stored_doc_tokens(tokenizer, docs, doc_ids, token_store)
+    else:
+        doc_idx, token_ids, offsets = _flatten_doc_tokens(tokenizer, docs)
+
+    matched = np.isin(token_ids, query_ids, assume_unique=False)
+    return _merge_spans(doc_idx[matched], offsets[matched, 0], offsets[matched, 1], len(docs))
+
 
 def doc_text_formatting(ef, query, docs):
     tokenizer = ef.model.tokenizer
 
-    # Encode query tokens
-    query_encoding = tokenizer.encode_plus(query, return_offsets_mapping=True, add_special_tokens=True)
-    query_tokens = tokenizer.convert_ids_to_tokens(query_encoding["input_ids"][1:-1])  # remove CLS, SEP
+    if not docs:
+        return []
 
     formatted_texts = []
 
-    for doc in docs:
-        encoding = tokenizer.encode_plus(doc, return_offsets_mapping=True, add_special_tokens=True)
-        doc_tokens = tokenizer.convert_ids_to_tokens(encoding["input_ids"][1:-1])
-        offsets = encoding["offset_mapping"][1:-1]
-
-        # Collect matched spans
-        highlight_spans = []
-        for token, (start, end) in zip(doc_tokens, offsets):
-            if token in query_tokens:
-                highlight_spans.append((start, end))
-
-        # Merge overlaps
-        merged_spans = []
-        for start, end in sorted(highlight_spans):
-            if merged_spans and start <= merged_spans[-1][1]:
-                merged_spans[-1] = (merged_spans[-1][0], max(merged_spans[-1][1], end))
-            else:
-                merged_spans.append((start, end))
-
+    for doc, merged_spans in zip(docs, _highlight_spans(tokenizer, query, docs)):
         # Insert HTML tags
         formatted_doc = ""
         last_idx = 0
@@ -42,32 +116,15 @@ def doc_text_formatting(ef, query, docs):
 
 
 
-def extract_highlight_spans(ef, query, docs):
+def extract_highlight_spans(ef, query, docs, doc_ids=None, token_store=None):
     tokenizer = ef.model.tokenizer
 
-    query_encoding = tokenizer.encode_plus(query, return_offsets_mapping=True, add_special_tokens=True)
-    query_tokens = tokenizer.convert_ids_to_tokens(query_encoding["input_ids"][1:-1])
+    if not docs:
+        return []
 
     results = []
 
-    for doc in docs:
-        encoding = tokenizer.encode_plus(doc, return_offsets_mapping=True, add_special_tokens=True)
-        doc_tokens = tokenizer.convert_ids_to_tokens(encoding["input_ids"][1:-1])
-        offsets = encoding["offset_mapping"][1:-1]
-
-        highlight_spans = []
-        for token, (start, end) in zip(doc_tokens, offsets):
-            if token in query_tokens:
-                highlight_spans.append((start, end))
-
-        # Merge overlapping spans
-        merged_spans = []
-        for start, end in sorted(highlight_spans):
-            if merged_spans and start <= merged_spans[-1][1]:
-                merged_spans[-1] = (merged_spans[-1][0], max(merged_spans[-1][1], end))
-            else:
-                merged_spans.append((start, end))
-
+    for doc, merged_spans in zip(docs, _highlight_spans(tokenizer, query, docs, doc_ids, token_store)):
         results.append({
             "text": doc,
             "highlights": merged_spans
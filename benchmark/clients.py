@@ -0,0 +1,114 @@
+import asyncio
+import json
+import time
+from collections import namedtuple
+
+
+# ``post(path, body)`` returns a Reply. first_byte and end are
+# time.perf_counter() values, so latencies can be taken from any start time.
+Reply = namedtuple("Reply", ["status", "headers", "body", "first_byte", "end"])
+
+
+class InProcessClient:
+    """
+    Calls an ASGI app (the FastAPI app of backend/main.py) directly in this
+    event loop: the full middleware and handler stack runs, without sockets
+    or a server. ``async with`` runs the app's lifespan around the benchmark.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._lifespan = None
+
+    async def __aenter__(self):
+        self._lifespan = self.app.router.lifespan_context(self.app)
+        await self._lifespan.__aenter__()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._lifespan.__aexit__(*exc_info)
+
+    async def post(self, path, body):
+        payload = json.dumps(body).encode("utf-8")
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": "POST",
+            "scheme": "http",
+            "path": path,
+            "raw_path": path.encode("ascii"),
+            "root_path": "",
+            "query_string": b"",
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(payload)).encode())],
+            "client": ("127.0.0.1", 0),
+            "server": ("benchmark", 80),
+        }
+        request_sent = False
+        response_done = asyncio.Event()
+        status = None
+        headers = {}
+        chunks = []
+        first_byte = None
+
+        async def receive():
+            nonlocal request_sent
+            if not request_sent:
+                request_sent = True
+                return {"type": "http.request", "body": payload, "more_body": False}
+            # The client stays connected until the whole response is sent.
+            await response_done.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            nonlocal status, first_byte
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers.update((key.decode("latin-1").lower(), value.decode("latin-1"))
+                               for key, value in message.get("headers", []))
+            elif message["type"] == "http.response.body":
+                if first_byte is None:
+                    first_byte = time.perf_counter()
+                chunks.append(message.get("body", b""))
+                if not message.get("more_body", False):
+                    response_done.set()
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            response_done.set()
+        return Reply(status, headers, b"".join(chunks), first_byte, time.perf_counter())
+
+
+class HttpClient:
+    """
+    Sends requests to a running server over keep-alive connections, at most
+    ``connections`` at a time.
+    """
+
+    def __init__(self, base_url, connections=100, timeout=60):
+        self.base_url = base_url
+        self.connections = connections
+        self.timeout = timeout
+        self.session = None
+
+    async def __aenter__(self):
+        import aiohttp
+
+        self.session = aiohttp.ClientSession(
+            self.base_url,
+            connector=aiohttp.TCPConnector(limit=self.connections),
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+        )
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    async def post(self, path, body):
+        async with self.session.post(path, json=body) as response:
+            first = await response.content.readany()
+            first_byte = time.perf_counter()
+            rest = await response.read()
+            headers = {key.lower(): value for key, value in response.headers.items()}
+            return Reply(response.status, headers, first + rest, first_byte, time.perf_counter())
@@ -0,0 +1,247 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+from itertools import cycle, islice
+
+import numpy as np
+
+from clients import HttpClient, InProcessClient
+from workload import POOL_PATH, build_workload, logged_searches, pool_searches
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend")
+
+
+# Replays a workload against /search and /compare and reports throughput,
+# latency percentiles and the per-stage times of the Server-Timing header.
+# The target is the app itself, in this process, or a server URL.
+TEST_DATA_PATHS = ["../evaluate/TestData/negative_pool.jsonl", "../evaluate/TestData/ground_truth_augmented_fluent.jsonl"]
+TEST_EMBEDDINGS_DIR = "../evaluate/TestData/saved_embeddings"
+PERCENTILES = (50, 90, 95, 99)
+
+
+def parse_server_timing(header):
+    # "embed;dur=1.20, retrieve;dur=3.40, total;dur=5.10" -> {"embed": 1.2, ...} in ms.
+    stages = {}
+    for entry in header.split(","):
+        name, _, params = entry.strip().partition(";")
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "dur" and name:
+                stages[name] = float(value)
+    return stages
+
+
+async def timed(client, request, scheduled):
+    try:
+        reply = await client.post(request["endpoint"], request["body"])
+        status, end = reply.status, reply.end
+        first_byte = reply.first_byte or end
+        stages = parse_server_timing(reply.headers.get("server-timing", ""))
+    except Exception as exc:
+        status, end, stages = type(exc).__name__, time.perf_counter(), {}
+        first_byte = end
+    return {
+        "endpoint": request["endpoint"],
+        "status": status,
+        "start": scheduled,
+        "end": end,
+        "latency": end - scheduled,
+        "first_byte": first_byte - scheduled,
+        "stages": stages,
+    }
+
+
+async def closed_loop(client, requests, concurrency, duration=None):
+    # ``concurrency`` users, each sending its next request when the last one returns.
+    requests = iter(requests)
+    deadline = time.perf_counter() + duration if duration else None
+    records = []
+
+    async def user():
+        for request in requests:
+            start = time.perf_counter()
+            if deadline is not None and start >= deadline:
+                return
+            records.append(await timed(client, request, start))
+
+    await asyncio.gather(*[user() for _ in range(concurrency)])
+    return records
+
+
+async def open_loop(client, requests, rate, duration=None, seed=0):
+    # Poisson arrivals at ``rate`` per second, sent whether or not earlier
+    # requests have returned. Latency counts from the scheduled arrival, so
+    # a server that falls behind is not hidden by requests going out late.
+    rng = np.random.default_rng(seed)
+    start = time.perf_counter()
+    arrival = 0.0
+    tasks = []
+    for request in requests:
+        arrival += rng.exponential(1.0 / rate)
+        if duration and arrival > duration:
+            break
+        delay = start + arrival - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.ensure_future(timed(client, request, start + arrival)))
+    return list(await asyncio.gather(*tasks))
+
+
+def _latency_summary(values_ms):
+    values_ms = np.asarray(values_ms, dtype=np.float64)
+    if not len(values_ms):
+        return {}
+    summary = {f"p{p}": float(np.percentile(values_ms, p)) for p in PERCENTILES}
+    summary.update(mean=float(values_ms.mean()), max=float(values_ms.max()))
+    return summary
+
+
+def summarize(records):
+    """
+    {endpoint: {requests, errors, throughput, latency_ms, first_byte_ms,
+    stages_ms}} plus "all". Throughput is successful requests per second
+    of wall time from the first start to the last end.
+    """
+    report = {}
+    groups = {"all": records}
+    for record in records:
+        groups.setdefault(record["endpoint"], []).append(record)
+    for endpoint, group in groups.items():
+        ok = [record for record in group if record["status"] == 200]
+        wall = max(record["end"] for record in group) - min(record["start"] for record in group)
+        stage_names = sorted({name for record in ok for name in record["stages"]})
+        report[endpoint] = {
+            "requests": len(group),
+            "errors": len(group) - len(ok),
+            "throughput": len(ok) / wall if wall > 0 else 0.0,
+            "latency_ms": _latency_summary([record["latency"] * 1000 for record in ok]),
+            "first_byte_ms": _latency_summary([record["first_byte"] * 1000 for record in ok]),
+            "stages_ms": {
+                name: _latency_summary([record["stages"][name] for record in ok if name in record["stages"]])
+                for name in stage_names
+            },
+        }
+    return report
+
+
+def format_report(report, baseline=None):
+    lines = []
+    for endpoint, summary in report.items():
+        latency = summary["latency_ms"]
+        lines.append(f"{endpoint}: {summary['requests']} requests, {summary['errors']} errors, "
+                     f"{summary['throughput']:.1f} req/s")
+        if not latency:
+            continue
+        lines.append(f"  {'':<12}" + "".join(f"{name:>10}" for name in latency))
+        rows = [("latency", latency), ("first byte", summary["first_byte_ms"])]
+        rows += [(name, stage) for name, stage in summary["stages_ms"].items()]
+        for name, values in rows:
+            lines.append(f"  {name:<12}" + "".join(f"{values.get(key, 0.0):>10.1f}" for key in latency))
+
+        previous = (baseline or {}).get(endpoint)
+        if previous and previous.get("latency_ms"):
+            changes = [f"throughput {_change(summary['throughput'], previous['throughput'])}"]
+            changes += [f"{key} {_change(latency[key], previous['latency_ms'][key])}" for key in ("p50", "p95", "p99")]
+            lines.append("  vs baseline: " + ", ".join(changes))
+    return "\n".join(lines)
+
+
+def _change(value, previous):
+    return f"{(value - previous) / previous:+.1%}" if previous else "n/a"
+
+
+def load_app(collection):
+    # The app is imported from backend/, as uvicorn would run it, so its
+    # relative default paths resolve. "test" serves the evaluation collection
+    # built by constructTestSet.py; "serve" uses the LOCAL_* settings.
+    os.environ.setdefault("SEARCH_BACKEND", "local")
+    os.environ.setdefault("RESOURCE_LOADING", "blocking")
+    data_paths = [os.path.abspath(path) for path in TEST_DATA_PATHS]
+    embeddings_dir = os.path.abspath(TEST_EMBEDDINGS_DIR)
+    sys.path.append(BACKEND_DIR)
+    os.chdir(BACKEND_DIR)
+    import main
+    from localSearch import LocalCollection
+    from milvusSearch import collection_name, resources
+
+    if collection == "test":
+        resources.use("collection", LocalCollection.from_files(collection_name, data_paths, embeddings_dir))
+    return main.app
+
+
+async def run(args):
+    searches = logged_searches(args.queries, args.top_k) if args.queries != "pool" else pool_searches(
+        POOL_PATH, args.top_k or 10
+    )
+    workload = build_workload(searches, args.compare_fraction, args.seed)
+    if args.stream:
+        # First byte is then the ranked results, before any highlighting.
+        for request in workload:
+            if request["endpoint"] == "/search":
+                request["endpoint"] = "/search/stream"
+    if not workload:
+        raise SystemExit(f"No queries in {args.queries}")
+    # One pass over the workload by default; with --duration it repeats until time is up.
+    count = args.requests or (None if args.duration else len(workload))
+    requests = islice(cycle(workload), count)
+
+    if args.target == "inprocess":
+        client = InProcessClient(load_app(args.collection))
+    else:
+        client = HttpClient(args.target, connections=max(args.concurrency, 100))
+
+    async with client:
+        # Untimed warmup requests, so model and page-cache setup stays out of the numbers.
+        for request in islice(cycle(workload), args.warmup):
+            await client.post(request["endpoint"], request["body"])
+        if args.rate:
+            records = await open_loop(client, requests, args.rate, args.duration, args.seed)
+        else:
+            records = await closed_loop(client, requests, args.concurrency, args.duration)
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay queries against /search and /compare.")
+    parser.add_argument("--target", default="inprocess", help='"inprocess", or a server URL such as http://localhost:8000')
+    parser.add_argument("--collection", default="test", choices=["test", "serve"],
+                        help="in-process only: the evaluation collection, or the configured LOCAL_* one")
+    parser.add_argument("--queries", default="pool", help='"pool" for the test pool abstracts, or a query log path')
+    parser.add_argument("--concurrency", type=int, default=8, help="closed loop: requests in flight")
+    parser.add_argument("--rate", type=float, default=None, help="open loop: arrivals per second")
+    parser.add_argument("--requests", type=int, default=None, help="requests to send (default: one pass)")
+    parser.add_argument("--duration", type=float, default=None, help="seconds to run for")
+    parser.add_argument("--compare-fraction", type=float, default=0.0, help="share of requests sent to /compare")
+    parser.add_argument("--top-k", type=int, default=None)
+    parser.add_argument("--stream", action="store_true", help="send searches to /search/stream")
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="write the report as JSON")
+    parser.add_argument("--baseline", default=None, help="a previous --output report to compare against")
+    args = parser.parse_args()
+    # Relative paths are taken from where the script was started, before load_app changes directory.
+    for name in ("queries", "output", "baseline"):
+        value = getattr(args, name)
+        if value and value != "pool":
+            setattr(args, name, os.path.abspath(value))
+
+    records = asyncio.run(run(args))
+    report = summarize(records)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)["report"]
+    print(format_report(report, baseline))
+
+    if args.output:
+        settings = {key: value for key, value in vars(args).items() if key not in ("output", "baseline")}
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"settings": settings, "report": report}, f, indent=2)
+        print(f"Report written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+import json
+import random
+
+
+# Request bodies to replay, as {"endpoint": path, "body": JSON body}. Queries
+# come from the abstracts of the test pool, or from a query log written by
+# the server with QUERY_LOG_PATH set (its fusion settings are kept).
+POOL_PATH = "../evaluate/TestData/ground_truth_pool.jsonl"
+SEARCH_FIELDS = ["query", "top_k", "fusion", "sparse_weight", "dense_weight", "rrf_k", "candidate_factor"]
+
+
+def pool_searches(path=POOL_PATH, top_k=10):
+    searches = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            abstract = json.loads(line).get("abstract", "").strip()
+            if abstract:
+                searches.append({"query": abstract, "top_k": top_k})
+    return searches
+
+
+def logged_searches(path, top_k=None):
+    # top_k, when given, overrides the logged one.
+    searches = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            body = {field: record[field] for field in SEARCH_FIELDS if field in record}
+            if top_k is not None:
+                body["top_k"] = top_k
+            searches.append(body)
+    return searches
+
+
+def build_workload(searches, compare_fraction=0.0, seed=0):
+    """
+    Shuffles the searches and turns ``compare_fraction`` of them into
+    /compare requests, each pairing its query with another query's text.
+    """
+    rng = random.Random(seed)
+    searches = list(searches)
+    rng.shuffle(searches)
+    workload = []
+    for search in searches:
+        if rng.random() < compare_fraction:
+            other = rng.choice(searches)["query"]
+            workload.append({"endpoint": "/compare", "body": {"query": search["query"], "paper_text": other}})
+        else:
+            workload.append({"endpoint": "/search", "body": search})
+    return workload
@@ -2,15 +2,21 @@
 
 import os
 os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
-import torch
 import json
 import numpy as np
 import scipy.sparse
 from tqdm import tqdm
 from pymilvus import connections, FieldSchema, CollectionSchema, DataType, Collection, utility
-from pymilvus.model.hybrid import BGEM3EmbeddingFunction
 
-import os
+import sys
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend")
+sys.path.append(BACKEND_DIR)
+from config import CORPUS_VERSION_PATH, SEARCH_BACKEND
+from bulkLoad import InsertPipeline, PhaseTimer, build_indexes
+from milvusPayload import dense_rows, sparse_rows
+from embeddingDriver import corpus_embedder
+from resultCache import bump_corpus_version
 
 MILVUS_URI = ""
 MILVUS_PORT = ""
@@ -19,31 +25,16 @@ MILVUS_PASSWORD = ""
 
 COLLECTION_NAME = "TestDataSet"
 
+SAVE_DIR = "TestData/saved_embeddings"
 
+INSERT_BATCH_SIZE = 500
+MAX_INFLIGHT_INSERTS = 4
 
-connections.connect(
-    uri=MILVUS_URI,
-    user=MILVUS_USER,
-    password=MILVUS_PASSWORD,
-    secure=True
-)
-
-device = "cuda" if (torch.cuda.is_available()) else "cpu"
-
-print(device)
-if device != "cuda":
-    exit()
 
-
-ef = BGEM3EmbeddingFunction(device=device, use_fp16=(device=="cuda"))
-dense_dim = ef.dim["dense"]
-
-def sparse_tensor_batch_to_list_of_dicts(tensor):
-    tensor = tensor.tocoo()
-    results = [{} for _ in range(tensor.shape[0])]
-    for i, j, v in zip(tensor.row, tensor.col, tensor.data):
-        results[i][j] = float(v)
-    return results
+def save_embeddings(dense_list, sparse_matrix, save_dir=SAVE_DIR):
+    os.makedirs(save_dir, exist_ok=True)
+    np.save(os.path.join(save_dir, "dense.npy"), np.array(dense_list))
+    scipy.sparse.save_npz(os.path.join(save_dir, "sparse.npz"), sparse_matrix)
 
 
 
@@ -63,7 +54,7 @@ def load_jsonl_new():
     return data
 
 
-def create_collection(name):
+def create_collection(name, dense_dim):
     if utility.has_collection(name):
         collection = Collection(name)
         print(f"Collection '{name}' already exists.")
@@ -84,7 +75,7 @@ def create_collection(name):
     return collection
 
 
-def insert_batch(collection, batch_data, dense_list, sparse_list, offset):
+def insert_batch(collection, batch_data, dense_list, sparse_list, offset, _async=False):
     ids = []
     titles = []
     authors = []
@@ -104,59 +95,67 @@ def insert_batch(collection, batch_data, dense_list, sparse_list, offset):
         times.append(item.get("time", "").strip())
         abstracts.append(item.get("abstract", ""))
 
-    dense_batch = [dense_list[offset+idx].tolist() for idx in range(len(batch_data))]
-    sparse_batch = sparse_tensor_batch_to_list_of_dicts(sparse_list[offset:offset+len(batch_data)])
+    dense_batch = dense_rows(dense_list, offset, offset + len(batch_data))
+    sparse_batch = sparse_rows(sparse_list, offset, offset + len(batch_data))
 
-    collection.insert([
+    return collection.insert([
         ids, titles, authors, links, times, abstracts,
         dense_batch, sparse_batch
-    ])
-
-
-    collection.create_index(
-        field_name="sparse_vector",
-        index_params={
-            "index_type": "SPARSE_INVERTED_INDEX",
-            "metric_type": "IP"
-        }
-    )
-
-
-    collection.create_index(
-        field_name="dense_vector",
-        index_params={
-            "index_type": "AUTOINDEX",
-            "metric_type": "COSINE"
-        }
-    )
-
-  
-    collection.load()
+    ], _async=_async)
 
 
 def main():
+    # The local backend (SEARCH_BACKEND=local) only needs the saved embeddings.
+    if SEARCH_BACKEND != "local":
+        connections.connect(
+            uri=MILVUS_URI,
+            user=MILVUS_USER,
+            password=MILVUS_PASSWORD,
+            secure=True
+        )
+    # Built here rather than at import: the CPU fallback's spawned workers re-import this module.
+    ef = corpus_embedder()
+
+    timer = PhaseTimer()
 
     data = load_jsonl_new()
 
     
     texts = [item.get("abstract", "") for item in data]
-    embeds = ef(texts)
-    dense_list = embeds["dense"]
+    with timer.phase("embed", rows=len(texts)):
+        embeds = ef(texts)
+    print(ef.report())
+    ef.close()
+    # Stacked once so each insert batch is a contiguous row slice.
+    dense_list = np.asarray(embeds["dense"], dtype=np.float32)
     sparse_list = embeds["sparse"]
+    save_embeddings(dense_list, sparse_list, SAVE_DIR)
+    # A server answering from this set drops its cached /search responses.
+    # The stamp path is relative to backend/, where the server runs.
+    version_path = os.path.join(BACKEND_DIR, CORPUS_VERSION_PATH)
 
-   
-    collection = create_collection(COLLECTION_NAME)
-
-    batch_size = 30
-    num_batches = (len(data) + batch_size - 1) // batch_size
-
+    if SEARCH_BACKEND == "local":
+        bump_corpus_version(version_path, rows=len(data))
+        print(f"Embeddings saved to {SAVE_DIR} for the local backend.")
+        timer.report()
+        return
 
-    for i in tqdm(range(num_batches)):
-        batch = data[i*batch_size : (i+1)*batch_size]
-        insert_batch(collection, batch, dense_list, sparse_list, offset=i*batch_size)
-
-    collection.load()
+   
+    collection = create_collection(COLLECTION_NAME, ef.dim["dense"])
+
+    pipeline = InsertPipeline(MAX_INFLIGHT_INSERTS)
+    with timer.phase("insert", rows=len(data)):
+        for start in tqdm(range(0, len(data), INSERT_BATCH_SIZE)):
+            batch = data[start:start + INSERT_BATCH_SIZE]
+            future = insert_batch(collection, batch, dense_list, sparse_list, offset=start, _async=True)
+            pipeline.submit(future, len(batch))
+        pipeline.drain()
+
+    with timer.phase("index + load"):
+        build_indexes(collection)
+    bump_corpus_version(version_path, rows=len(data))
     print("All data inserted and collection loaded!")
+    timer.report()
 
 if __name__ == "__main__":
     main()
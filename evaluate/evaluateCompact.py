@@ -0,0 +1,105 @@
+import os
+os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
+import sys
+
+import numpy as np
+from pymilvus.model.hybrid import BGEM3EmbeddingFunction
+
+import helper
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+from compactStore import compact_saved_embeddings
+from fusion import fuse_hits
+from localSearch import LocalCollection
+
+
+# Compares retrieval quality of compact stores against the float32 embeddings
+# written by constructTestSet.py, on the same queries as evaluateResult.py.
+TEST_DATA_PATHS = ["TestData/negative_pool.jsonl", "TestData/ground_truth_augmented_fluent.jsonl"]
+SAVE_DIR = "TestData/saved_embeddings"
+
+# (dense dtype, sparse top-n) per compact store; None keeps every sparse weight.
+VARIANTS = [("float16", None), ("int8", None), ("int8", 64), ("int8", 32)]
+
+LIMIT = 10
+MAX_LEVEL = 4
+SPARSE_WEIGHT = 0.5
+DENSE_WEIGHT = 0.5
+
+
+def hybrid_search(col, query_dense_embedding, query_sparse_embedding, limit=LIMIT, candidate_factor=4):
+    pool = limit * candidate_factor
+    sparse_hits = col.search([query_sparse_embedding], "sparse_vector", {"metric_type": "IP"}, pool)[0]
+    dense_hits = col.search([query_dense_embedding], "dense_vector", {"metric_type": "COSINE"}, pool)[0]
+    return fuse_hits(
+        [sparse_hits, dense_hits],
+        weights=[SPARSE_WEIGHT, DENSE_WEIGHT],
+        metric_types=["IP", "COSINE"],
+        limit=limit,
+    )
+
+
+def build_tasks():
+    queries = helper.load_positive_queries("TestData/ground_truth_pool.jsonl")
+    gt_map = helper.build_ground_truth_map("TestData/ground_truth_augmented_fluent.jsonl")
+    tasks = []
+    for qid, text in queries.items():
+        ground_truth = [
+            gid for gid in gt_map.get(qid, [])
+            if "_level" in gid and int(gid.split("_level")[1]) <= MAX_LEVEL
+        ]
+        if ground_truth:
+            tasks.append((qid, text, ground_truth))
+    return tasks
+
+
+def store_size_mb(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path)) / (1024 * 1024)
+    return os.path.getsize(path) / (1024 * 1024)
+
+
+def evaluate(col, embeddings, tasks):
+    metrics = {"precision@K": [], "recall@K": [], "ndcg@K": [], "mrr": []}
+    retrieved = []
+    for (_, _, ground_truth), (dense_query, sparse_query) in zip(tasks, embeddings):
+        ids = [hit.entity.get("id", "") for hit in hybrid_search(col, dense_query, sparse_query)]
+        k = min(LIMIT, len(ground_truth))
+        metrics["precision@K"].append(helper.precision_at_k(ids, ground_truth, k))
+        metrics["recall@K"].append(helper.recall_at_k(ids, ground_truth, k))
+        metrics["ndcg@K"].append(helper.ndcg_at_k_order_sensitive(ids, ground_truth, k))
+        metrics["mrr"].append(helper.mrr(ids, ground_truth))
+        retrieved.append(ids)
+    return {name: float(np.mean(values)) for name, values in metrics.items()}, retrieved
+
+
+def main():
+    ef = BGEM3EmbeddingFunction(device="cpu", use_fp16=False)
+    tasks = build_tasks()
+    output = ef([text for _, text, _ in tasks])
+    embeddings = [(output["dense"][i], output["sparse"][[i]]) for i in range(len(tasks))]
+
+    baseline = LocalCollection.from_files("float32", TEST_DATA_PATHS, SAVE_DIR)
+    base_metrics, base_retrieved = evaluate(baseline, embeddings, tasks)
+    base_size = store_size_mb(os.path.join(SAVE_DIR, "dense.npy")) + store_size_mb(os.path.join(SAVE_DIR, "sparse.npz"))
+
+    names = list(base_metrics)
+    print(f"{len(tasks)} queries, top {LIMIT}; metric deltas are against float32")
+    print(f"{'store':<16} {'MB':>8} " + " ".join(f"{name:>12}" for name in names) + f" {'overlap@K':>10}")
+    print(f"{'float32':<16} {base_size:>8.1f} " + " ".join(f"{base_metrics[name]:>12.4f}" for name in names)
+          + f" {1.0:>10.4f}")
+
+    for dense_dtype, top_n in VARIANTS:
+        label = dense_dtype + (f"_top{top_n}" if top_n else "")
+        out_dir = os.path.join(SAVE_DIR, f"compact_{label}")
+        compact_saved_embeddings(SAVE_DIR, TEST_DATA_PATHS, out_dir, dense_dtype, top_n)
+        metrics, retrieved = evaluate(LocalCollection.from_files(label, TEST_DATA_PATHS, out_dir), embeddings, tasks)
+        # Share of the float32 top-K that the compact store also returns.
+        overlap = np.mean([len(set(a) & set(b)) / max(len(a), 1) for a, b in zip(base_retrieved, retrieved)])
+        print(f"{label:<16} {store_size_mb(out_dir):>8.1f} "
+              + " ".join(f"{metrics[name] - base_metrics[name]:>+12.4f}" for name in names)
+              + f" {overlap:>10.4f}")
+
+
+if __name__ == "__main__":
+    main()
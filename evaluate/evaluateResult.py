@@ -1,10 +1,19 @@
 import os
 os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
-from pymilvus import connections, Collection, AnnSearchRequest, RRFRanker, WeightedRanker
+import sys
+import time
+import torch
+from pymilvus import connections, Collection
 from pymilvus.model.hybrid import BGEM3EmbeddingFunction
 
 import json
 import helper
+import metrics
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+from config import SEARCH_BACKEND
+from localSearch import LocalCollection
+from fusion import fuse_hits
 
 
 
@@ -14,21 +23,37 @@ MILVUS_USER = ""
 MILVUS_PASSWORD = ""
 
 
-connections.connect(
-    uri=MILVUS_URI,
-    user=MILVUS_USER,
-    password=MILVUS_PASSWORD,
-    secure=True
-)
+collection_name = "TestDataSet"
 
+# Same order constructTestSet.py embeds them in.
+TEST_DATA_PATHS = ["TestData/negative_pool.jsonl", "TestData/ground_truth_augmented_fluent.jsonl"]
+SAVE_DIR = "TestData/saved_embeddings"
+REPORT_PATH = "TestData/evaluation_report.json"
+
+# Queries per search request, and how many requests run at once.
+SEARCH_BATCH_SIZE = 32
+SEARCH_WORKERS = 4
+
+SPARSE_WEIGHT = 0.5
+DENSE_WEIGHT = 0.5
+MAX_LEVEL = 4
+LIMIT = 10
+
+if SEARCH_BACKEND == "local":
+    collection = LocalCollection.from_files(collection_name, TEST_DATA_PATHS, SAVE_DIR)
+else:
+    connections.connect(
+        uri=MILVUS_URI,
+        user=MILVUS_USER,
+        password=MILVUS_PASSWORD,
+        secure=True
+    )
 
-collection_name = "TestDataSet"
-collection = Collection(collection_name)
-collection.load()
+    collection = Collection(collection_name)
+    collection.load()
 
 
-ef = BGEM3EmbeddingFunction(device="cuda", use_fp16=False)
-# ef = BGEM3EmbeddingFunction(device="cpu", use_fp16=False)
+ef = BGEM3EmbeddingFunction(device="cuda" if torch.cuda.is_available() else "cpu", use_fp16=False)
 
 def dense_search(col, query_dense_embedding, limit=10):
     search_params = {"metric_type": "COSINE", "params": {}}
@@ -59,27 +84,22 @@ def hybrid_search(
     sparse_weight=1.0,
     dense_weight=1.0,
     limit=10,
+    strategy="weighted",
+    rrf_k=60,
+    candidate_factor=4,
 ):
-    dense_search_params = {"metric_type": "COSINE", "params": {}}
-    dense_req = AnnSearchRequest(
-        [query_dense_embedding], "dense_vector", dense_search_params, limit=limit
-    )
-
-    sparse_search_params = {"metric_type": "IP", "params": {}}
-    sparse_req = AnnSearchRequest(
-        [query_sparse_embedding], "sparse_vector", sparse_search_params, limit=limit
-    )
-
-    # rerank = RRFRanker(60)
-    rerank = WeightedRanker(0.5, 0.5)
-
-    res = col.hybrid_search(
-        [sparse_req, dense_req],
-        rerank=rerank,
+    pool = limit * max(1, candidate_factor)
+    sparse_hits = sparse_search(col, query_sparse_embedding, pool)
+    dense_hits = dense_search(col, query_dense_embedding, pool)
+
+    return fuse_hits(
+        [sparse_hits, dense_hits],
+        weights=[sparse_weight, dense_weight],
+        metric_types=["IP", "COSINE"],
+        strategy=strategy,
+        rrf_k=rrf_k,
         limit=limit,
-        output_fields=["id", "title", "author", "abstract"],
-    )[0]
-    return res
+    )
 
 
 
@@ -123,10 +143,7 @@ def build_evaluation_tasks(positive_path, augmented_path):
 
 
 
-def evaluate_query(ef, query_id, query_text, ground_truth_ids,
-                   sparse_weight=0.7, dense_weight=1.0,
-                   max_level=5, limit=5):
-
+def filter_ground_truth(ground_truth_ids, max_level):
     filtered_gt = []
     for gid in ground_truth_ids:
         if "_level" in gid:
@@ -136,7 +153,14 @@ def evaluate_query(ef, query_id, query_text, ground_truth_ids,
                     filtered_gt.append(gid)
             except:
                 continue
+    return filtered_gt
 
+
+def evaluate_query(ef, query_id, query_text, ground_truth_ids,
+                   sparse_weight=0.7, dense_weight=1.0,
+                   max_level=5, limit=5):
+
+    filtered_gt = filter_ground_truth(ground_truth_ids, max_level)
     if not filtered_gt:
         return {
             "query_id": query_id,
@@ -175,41 +199,95 @@ def evaluate_query(ef, query_id, query_text, ground_truth_ids,
 
 
 
-if __name__ == "__main__":
-    # query = "A common feature of these semantics is that one can always maximize in some sense the set of acceptable arguments"
-
-    # ### the query containing ID, URL, AUTHOR, SCORE .....
-    # result = EvaluateOnce(ef, query, collection, sparse_weight=0.5, dense_weight=0.5, limit=5)
+def run_evaluation(ef, col, tasks, sparse_weight=SPARSE_WEIGHT, dense_weight=DENSE_WEIGHT,
+                   max_level=MAX_LEVEL, limit=LIMIT, strategy="weighted", rrf_k=60, candidate_factor=4):
+    """
+    Evaluates every task with one batched embedding call and batched,
+    concurrent searches per leg; the legs are fused locally as in
+    ``hybrid_search``. Returns the per-query results and a report with the
+    mean of each metric.
+    """
+    tasks = [dict(task, ground_truth_ids=filter_ground_truth(task["ground_truth_ids"], max_level))
+             for task in tasks]
+    skipped = [task["query_id"] for task in tasks if not task["ground_truth_ids"]]
+    tasks = [task for task in tasks if task["ground_truth_ids"]]
+
+    start = time.perf_counter()
+    output = ef([task["query_text"] for task in tasks])
+    embed_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    pool = limit * max(1, candidate_factor)
+    sparse_hits = helper.batched_search(col, [output["sparse"][[i]] for i in range(len(tasks))], "sparse_vector", "IP",
+                                        pool, SEARCH_BATCH_SIZE, SEARCH_WORKERS)
+    dense_hits = helper.batched_search(col, list(output["dense"]), "dense_vector", "COSINE",
+                                       pool, SEARCH_BATCH_SIZE, SEARCH_WORKERS)
+    search_seconds = time.perf_counter() - start
+
+    retrieved = []
+    for sparse, dense in zip(sparse_hits, dense_hits):
+        hits = fuse_hits(
+            [sparse, dense],
+            weights=[sparse_weight, dense_weight],
+            metric_types=["IP", "COSINE"],
+            strategy=strategy,
+            rrf_k=rrf_k,
+            limit=limit,
+        )
+        retrieved.append([hit.entity.get("id", "") for hit in hits])
 
+    qrels = [{gid: metrics.level_grade(gid) for gid in task["ground_truth_ids"]} for task in tasks]
+    cutoffs = ["K"] + [cutoff for cutoff in metrics.CUTOFFS if cutoff <= limit]
+    per_query = metrics.evaluate_run(retrieved, qrels, cutoffs, depth=limit)
+    results = []
+    for q, (task, retrieved_ids) in enumerate(zip(tasks, retrieved)):
+        row = {name: float(values[q]) for name, values in per_query.items()}
+        results.append({
+            "query_id": task["query_id"],
+            "precision@K": row["precision@K"],
+            "recall@K": row["recall@K"],
+            "ndcg@K": row["ndcg@K"],
+            "mrr": row["mrr"],
+            "top_K": min(limit, len(task["ground_truth_ids"])),
+            "retrieved_ids": retrieved_ids,
+            "ground_truth_ids": task["ground_truth_ids"],
+            "metrics": row,
+        })
+
+    means = metrics.aggregate(per_query)
+    report = {
+        "settings": {
+            "backend": SEARCH_BACKEND,
+            "collection": col.name,
+            "sparse_weight": sparse_weight,
+            "dense_weight": dense_weight,
+            "strategy": strategy,
+            "rrf_k": rrf_k,
+            "candidate_factor": candidate_factor,
+            "max_level": max_level,
+            "limit": limit,
+        },
+        "queries": len(results),
+        "skipped_queries": skipped,
+        "mean": {name: means[name] for name in ["precision@K", "recall@K", "ndcg@K", "mrr"]},
+        "cutoffs": cutoffs,
+        "table": means,
+        "seconds": {"embed": embed_seconds, "search": search_seconds},
+        "results": results,
+    }
+    return results, report
 
-    count = 0
-    choice = 3
 
+if __name__ == "__main__":
+    # python evaluateResult.py [report path]
+    report_path = sys.argv[1] if len(sys.argv) > 1 else REPORT_PATH
     tasks = build_evaluation_tasks("TestData/ground_truth_pool.jsonl", "TestData/ground_truth_augmented_fluent.jsonl")
-    
-    results = []
-    for task in tasks:
-        if count > choice:
-            break
-        else: count += 1
-
-        res = evaluate_query(
-            ef=ef,
-            query_id=task["query_id"],
-            query_text=task["query_text"],
-            ground_truth_ids=task["ground_truth_ids"],
-            sparse_weight=0.5,
-            dense_weight=0.5,
-            max_level=4,
-            limit=10
-        )
-        results.append(res)
+    results, report = run_evaluation(ef, collection, tasks)
 
-        print(f"\n[Query ID: {res['query_id']}]")
-        print(f"Top-K:      {res['top_K']}")
-        print(f"Precision@K: {res['precision@K']:.4f}")
-        print(f"Recall@K:    {res['recall@K']:.4f}")
-        print(f"NDCG@K:      {res['ndcg@K']:.4f}")
-        print(f"MRR:         {res['mrr']:.4f}")
-        print(f"Top IDs:     {res['retrieved_ids']}\n")
+    with open(report_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
 
+    print(f"{report['queries']} queries ({len(report['skipped_queries'])} without ground truth skipped), "
+          f"embed {report['seconds']['embed']:.1f}s, search {report['seconds']['search']:.1f}s")
+    print(metrics.format_table(report["table"], report["cutoffs"]))
+    print(f"Report written to {report_path}")
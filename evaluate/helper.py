@@ -1,5 +1,6 @@
 import math
 import json
+from concurrent.futures import ThreadPoolExecutor
 
 def precision_at_k(retrieved_ids, ground_truth_ids, k):
     retrieved_top_k = retrieved_ids[:k]
@@ -69,3 +70,20 @@ def build_ground_truth_map(path):
             base_id = record["id"].split("_level")[0]
             gt_map.setdefault(base_id, []).append(record["id"])
     return gt_map
+
+
+def batched_search(col, queries, anns_field, metric_type, limit, batch_size=32, workers=4, output_fields=("id",)):
+    # Searches batch_size queries per request, several requests at a time.
+    # Returns one hit list per query, in query order.
+    def search(batch):
+        return col.search(
+            batch,
+            anns_field=anns_field,
+            limit=limit,
+            output_fields=list(output_fields),
+            param={"metric_type": metric_type, "params": {}},
+        )
+
+    batches = [queries[start:start + batch_size] for start in range(0, len(queries), batch_size)]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return [hits for result in executor.map(search, batches) for hits in result]
@@ -0,0 +1,160 @@
+import numpy as np
+
+
+# Metrics of a whole run at once. A run is Q ranked id lists (``retrieved``)
+# and Q qrels, each a {document id: grade} dict of the query's relevant
+# documents. Every metric is computed for every cutoff as one [Q] array.
+#
+# A cutoff is a rank, or "K", which is min(depth, relevant documents) per
+# query: the top_K of evaluateResult.py and the k it passes to helper.
+METRICS = ("precision", "recall", "ndcg", "mrr", "map")
+CUTOFFS = (1, 3, 5, 10, 20, 50, 100)
+
+
+def level_grade(doc_id):
+    # Graded relevance of a "<paper>_level<n>" id: level 1 is the closest paraphrase.
+    level = parse_level(doc_id)
+    return 6 - level if level is not None and 1 <= level <= 5 else 0
+
+
+def parse_level(doc_id):
+    if "_level" not in doc_id:
+        return None
+    try:
+        return int(doc_id.split("_level")[1])
+    except ValueError:
+        return None
+
+
+def build_qrels(gt_map, max_level=None):
+    # {query id: {ground truth id: grade}} from helper.build_ground_truth_map
+    # output, keeping levels up to max_level. Levels are parsed once here.
+    qrels = {}
+    for qid, gids in gt_map.items():
+        grades = {}
+        for gid in gids:
+            level = parse_level(gid)
+            if level is None or (max_level is not None and level > max_level):
+                continue
+            grades[gid] = level_grade(gid)
+        qrels[qid] = grades
+    return qrels
+
+
+class Qrels:
+    """
+    The qrels of Q queries, indexed once: ``relevance(retrieved)`` looks up
+    a whole run, and the ideal gains behind nDCG are sorted up front, so
+    many runs over the same queries (a parameter sweep) share that work.
+    """
+
+    def __init__(self, qrels):
+        self.grades = list(qrels)
+        self.n_relevant = np.asarray([len(grades) for grades in self.grades], dtype=np.int64)
+        self.codes = {}
+        qrel_codes = np.asarray(
+            [self.codes.setdefault(doc_id, len(self.codes)) for grades in self.grades for doc_id in grades],
+            dtype=np.int64,
+        )
+        # (query, document) pairs as sorted integer keys.
+        keys = np.repeat(np.arange(len(self.grades)), self.n_relevant) * max(len(self.codes), 1) + qrel_codes
+        values = np.asarray([grade for grades in self.grades for grade in grades.values()], dtype=np.float64)
+        order = np.argsort(keys, kind="stable")
+        self.keys, self.values = keys[order], values[order]
+
+        width = int(self.n_relevant.max(initial=0))
+        self.ideal = np.zeros((len(self.grades), width))
+        for q, grades in enumerate(self.grades):
+            self.ideal[q, :len(grades)] = sorted(grades.values(), reverse=True)
+
+    def __len__(self):
+        return len(self.grades)
+
+    def relevance(self, retrieved, depth=None):
+        """
+        Returns (relevant, gains): [Q, depth] arrays telling whether each
+        retrieved id is in its query's qrels, and its grade. Lists shorter
+        than depth are padded with non-relevant ranks.
+        """
+        depth = depth or max((len(ids) for ids in retrieved), default=0)
+        codes = np.full((len(retrieved), depth), -1, dtype=np.int64)
+        for q, ranked in enumerate(retrieved):
+            ranked = list(ranked)[:depth]
+            codes[q, :len(ranked)] = [self.codes.get(doc_id, -1) for doc_id in ranked]
+        if not len(self.keys) or not depth:
+            return np.zeros(codes.shape, dtype=bool), np.zeros(codes.shape)
+
+        run_keys = np.arange(len(retrieved))[:, None] * len(self.codes) + codes
+        position = np.minimum(np.searchsorted(self.keys, run_keys), len(self.keys) - 1)
+        relevant = (codes >= 0) & (self.keys[position] == run_keys)
+        return relevant, np.where(relevant, self.values[position], 0.0)
+
+
+def _at(values, cut):
+    # values[q, cut[q] - 1], and 0 where cut[q] is 0.
+    if values.shape[1] == 0:
+        return np.zeros(values.shape[0])
+    index = np.clip(cut - 1, 0, values.shape[1] - 1)
+    return np.where(cut > 0, np.take_along_axis(values, index[:, None], axis=1)[:, 0], 0.0)
+
+
+def evaluate_run(retrieved, qrels, cutoffs=CUTOFFS, depth=None):
+    # qrels: a Qrels, or one {document id: grade} dict per query.
+    qrels = qrels if isinstance(qrels, Qrels) else Qrels(qrels)
+    relevant, gains = qrels.relevance(retrieved, depth)
+    return evaluate_relevance(relevant, gains, qrels, cutoffs)
+
+
+def evaluate_relevance(relevant, gains, qrels, cutoffs=CUTOFFS):
+    """
+    Returns {"<metric>@<cutoff>": [Q] array} for every metric and cutoff,
+    plus "mrr" over the whole depth. Queries without relevant documents
+    score 0 everywhere.
+    """
+    queries, depth = relevant.shape
+    n_relevant = qrels.n_relevant
+    ranks = np.arange(1, depth + 1)
+
+    hits = np.cumsum(relevant, axis=1)
+    dcg = np.cumsum(gains / np.log2(ranks + 1), axis=1)
+    precision_sum = np.cumsum(relevant * (hits / ranks), axis=1)
+    first_hit = relevant.argmax(axis=1) + 1 if depth else np.zeros(queries, dtype=np.int64)
+    first_hit = np.where(relevant.any(axis=1), first_hit, depth + 1)
+    width = qrels.ideal.shape[1]
+    ideal_dcg = np.cumsum(qrels.ideal / np.log2(np.arange(1, width + 1) + 1), axis=1)
+
+    results = {}
+    for cutoff in cutoffs:
+        k = np.minimum(depth, n_relevant) if cutoff == "K" else np.full(queries, int(cutoff))
+        seen = np.minimum(k, depth)
+        found = _at(hits, seen)
+        idcg = _at(ideal_dcg, np.minimum(k, width))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            results[f"precision@{cutoff}"] = np.where(k > 0, found / k, 0.0)
+            results[f"recall@{cutoff}"] = np.where(n_relevant > 0, found / n_relevant, 0.0)
+            results[f"ndcg@{cutoff}"] = np.where(idcg > 0, _at(dcg, seen) / idcg, 0.0)
+            results[f"map@{cutoff}"] = np.where(
+                np.minimum(k, n_relevant) > 0, _at(precision_sum, seen) / np.minimum(k, n_relevant), 0.0
+            )
+        results[f"mrr@{cutoff}"] = np.where(first_hit <= seen, 1.0 / first_hit, 0.0)
+    results["mrr"] = np.where(first_hit <= depth, 1.0 / first_hit, 0.0)
+    return results
+
+
+def aggregate(per_query):
+    return {name: float(values.mean()) if len(values) else 0.0 for name, values in per_query.items()}
+
+
+def per_query_rows(query_ids, per_query):
+    return [
+        dict(query_id=qid, **{name: float(values[q]) for name, values in per_query.items()})
+        for q, qid in enumerate(query_ids)
+    ]
+
+
+def format_table(means, cutoffs=CUTOFFS, metrics=METRICS):
+    # One row per metric, one column per cutoff.
+    lines = [f"{'':<10}" + "".join(f"{'@' + str(cutoff):>9}" for cutoff in cutoffs)]
+    for metric in metrics:
+        lines.append(f"{metric:<10}" + "".join(f"{means[f'{metric}@{cutoff}']:>9.4f}" for cutoff in cutoffs))
+    return "\n".join(lines)
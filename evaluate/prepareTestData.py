@@ -1,53 +1,20 @@
 import os
-import json
-import feedparser
-import urllib.request
-from datetime import datetime
-from time import sleep
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+from arxivHarvester import Harvester
 
 # Configuration
-base_url = "http://export.arxiv.org/api/query?"
 results_per_iteration = 50
-wait_time = 5  # seconds
 
 output_dir = "TestData"
 os.makedirs(output_dir, exist_ok=True)
 
-def fetch_arxiv_data(search_query, total_results, output_file, start_index=0):
-    with open(output_file, "w", encoding="utf-8") as output:
-        for i in range(start_index, total_results, results_per_iteration):
-            query = f"search_query={search_query}&start={i}&max_results={results_per_iteration}"
-            full_url = base_url + query
-
-            try:
-                with urllib.request.urlopen(full_url) as url:
-                    response = url.read()
-                feed = feedparser.parse(response)
-
-                for entry in feed.entries:
-                    try:
-                        authors = ", ".join(author.name for author in entry.authors)
-                    except AttributeError:
-                        authors = entry.author
-
-                    data = {
-                        "author": authors,
-                        "abstract": entry.summary,
-                        "time": entry.updated,
-                        "link": entry.link,
-                        "id": entry.link.replace("http://arxiv.org/abs/", ""),
-                        "title": entry.title,
-                    }
-
-                    json.dump(data, output, ensure_ascii=False)
-                    output.write("\n")
-
-                if i + results_per_iteration < total_results:
-                    print(f"Fetched {i + results_per_iteration} entries. Sleeping {wait_time} seconds...")
-                    sleep(wait_time)
-            except Exception as e:
-                print(f"Failed at index {i}: {e}")
-                break
+def fetch_arxiv_data(search_query, total_results, output_file):
+    # Relevance order keeps the same pools as the original fetch; an interrupted
+    # run resumes from the checkpoint next to output_file.
+    harvester = Harvester(output_file, page_size=results_per_iteration)
+    return harvester.harvest(search_query, total_results=total_results, sort_by=None)
 
 # Parameters for pools
 # Ground truth pool: recent cs.CL papers (2023–2024)
@@ -0,0 +1,244 @@
+import os
+os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
+import sys
+import json
+import time
+import torch
+import numpy as np
+from pymilvus import connections, Collection
+from pymilvus.model.hybrid import BGEM3EmbeddingFunction
+
+import helper
+import metrics
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+from config import SEARCH_BACKEND
+from fusion import milvus_normalize
+from localSearch import LocalCollection
+
+
+# Grid search over the fusion settings of hybrid_search. Deep sparse and dense
+# candidate lists are retrieved once per query and cached with their scores;
+# every configuration is then fused and scored locally, for all queries at once.
+MILVUS_URI = ""
+MILVUS_PORT = ""
+MILVUS_USER = ""
+MILVUS_PASSWORD = ""
+
+collection_name = "TestDataSet"
+TEST_DATA_PATHS = ["TestData/negative_pool.jsonl", "TestData/ground_truth_augmented_fluent.jsonl"]
+SAVE_DIR = "TestData/saved_embeddings"
+CACHE_PATH = "TestData/candidate_pool.npz"
+REPORT_PATH = "TestData/sweep_report.json"
+
+# Candidates cached per leg; must cover the largest limit * candidate_factor.
+CANDIDATE_DEPTH = 200
+
+STRATEGIES = ["weighted", "normalized", "rrf"]
+# dense_weight is 1 - sparse_weight: only their ratio changes a fused ranking.
+SPARSE_WEIGHTS = [round(float(weight), 2) for weight in np.linspace(0.0, 1.0, 11)]
+RRF_KS = [10, 30, 60, 100]
+LIMITS = [5, 10, 20]
+CANDIDATE_FACTORS = [2, 4, 8]
+MAX_LEVELS = [3, 4, 5]
+
+RANK_BY = "ndcg@K"
+TOP = 15
+
+
+def open_collection():
+    if SEARCH_BACKEND == "local":
+        return LocalCollection.from_files(collection_name, TEST_DATA_PATHS, SAVE_DIR)
+    connections.connect(uri=MILVUS_URI, user=MILVUS_USER, password=MILVUS_PASSWORD, secure=True)
+    collection = Collection(collection_name)
+    collection.load()
+    return collection
+
+
+def build_queries():
+    queries = helper.load_positive_queries("TestData/ground_truth_pool.jsonl")
+    gt_map = helper.build_ground_truth_map("TestData/ground_truth_augmented_fluent.jsonl")
+    query_ids = [qid for qid in queries if qid in gt_map]
+    return query_ids, [queries[qid] for qid in query_ids], gt_map
+
+
+def retrieve_candidates(query_ids, query_texts, depth=CANDIDATE_DEPTH):
+    ef = BGEM3EmbeddingFunction(device="cuda" if torch.cuda.is_available() else "cpu", use_fp16=False)
+    col = open_collection()
+    output = ef(query_texts)
+    sparse_hits = helper.batched_search(
+        col, [output["sparse"][[i]] for i in range(len(query_texts))], "sparse_vector", "IP", depth
+    )
+    dense_hits = helper.batched_search(col, list(output["dense"]), "dense_vector", "COSINE", depth)
+
+    pool = {"query_ids": np.asarray(query_ids)}
+    for leg, hits_per_query in (("sparse", sparse_hits), ("dense", dense_hits)):
+        ids = np.full((len(query_ids), depth), "", dtype=object)
+        scores = np.zeros((len(query_ids), depth), dtype=np.float32)
+        for q, hits in enumerate(hits_per_query):
+            ids[q, :len(hits)] = [hit.entity.get("id", "") for hit in hits]
+            scores[q, :len(hits)] = [hit.distance for hit in hits]
+        pool[f"{leg}_ids"] = ids.astype(str)
+        pool[f"{leg}_scores"] = scores
+    return pool
+
+
+def load_candidates(query_ids, query_texts, path=CACHE_PATH, depth=CANDIDATE_DEPTH, refresh=False):
+    # The cache is reused while it was built from the same backend, collection,
+    # queries and depth; rebuild it with --refresh after re-ingesting.
+    meta = {"backend": SEARCH_BACKEND, "collection": collection_name, "depth": depth, "query_ids": query_ids}
+    if not refresh and os.path.exists(path):
+        with np.load(path) as cached:
+            if json.loads(str(cached["meta"])) == meta:
+                print(f"Using cached candidates from {path}")
+                return {name: cached[name] for name in cached.files if name != "meta"}
+
+    start = time.perf_counter()
+    pool = retrieve_candidates(query_ids, query_texts, depth)
+    np.savez(path, meta=json.dumps(meta), **pool)
+    print(f"Retrieved {depth} candidates per leg for {len(query_ids)} queries in {time.perf_counter() - start:.1f}s")
+    return pool
+
+
+class FusionPool:
+    """
+    The candidates of both legs cut to ``pool_depth`` (limit * candidate_factor),
+    with each query's distinct candidates laid out as the columns of a
+    [Q, width] matrix. ``rank`` fuses every query at once and returns the
+    top ``limit`` columns per query.
+    """
+
+    def __init__(self, pool, pool_depth):
+        legs = [
+            (pool["sparse_ids"][:, :pool_depth], pool["sparse_scores"][:, :pool_depth].astype(np.float64), "IP"),
+            (pool["dense_ids"][:, :pool_depth], pool["dense_scores"][:, :pool_depth].astype(np.float64), "COSINE"),
+        ]
+        queries = legs[0][0].shape[0]
+        all_ids = np.concatenate([ids for ids, _, _ in legs], axis=1)
+        # Codes follow string order, so columns are sorted by id like fusion.fuse's np.unique.
+        vocabulary, codes = np.unique(all_ids, return_inverse=True)
+        codes = codes.reshape(all_ids.shape)
+        valid = all_ids != ""
+
+        keys = np.arange(queries)[:, None] * len(vocabulary) + codes
+        slots, slot_of = np.unique(keys[valid], return_inverse=True)
+        slot_query = slots // len(vocabulary)
+        row_start = np.searchsorted(slot_query, np.arange(queries))
+        column = np.arange(len(slots)) - row_start[slot_query]
+        self.width = int(column.max(initial=-1)) + 1
+        self.queries = queries
+
+        self.columns = np.zeros(all_ids.shape, dtype=np.int64)
+        self.columns[valid] = slot_query[slot_of] * self.width + column[slot_of]
+        self.ids = np.full((queries, self.width), "", dtype=object)
+        self.ids.ravel()[slot_query * self.width + column] = vocabulary[slots % len(vocabulary)]
+
+        self.valid = valid
+        self.depth = pool_depth
+        self.legs = []
+        for ids, scores, metric_type in legs:
+            present = ids != ""
+            low = np.where(present, scores, np.inf).min(axis=1, keepdims=True)
+            high = np.where(present, scores, -np.inf).max(axis=1, keepdims=True)
+            span = high - low
+            with np.errstate(invalid="ignore", divide="ignore"):
+                minmax = np.where(span > 0, (scores - low) / span, 1.0)
+            self.legs.append({
+                "weighted": milvus_normalize(scores, metric_type),
+                "normalized": minmax,
+                "rank": np.arange(1, ids.shape[1] + 1, dtype=np.float64),
+            })
+
+    def contributions(self, strategy, weights, rrf_k):
+        parts = []
+        for leg, weight in zip(self.legs, weights):
+            if strategy == "rrf":
+                parts.append(np.broadcast_to(weight / (rrf_k + leg["rank"]), leg["weighted"].shape))
+            else:
+                parts.append(weight * leg[strategy])
+        return np.concatenate(parts, axis=1)
+
+    def rank(self, strategy, weights, rrf_k, limit):
+        contributions = self.contributions(strategy, weights, rrf_k)
+        fused = np.bincount(
+            self.columns[self.valid], weights=contributions[self.valid], minlength=self.queries * self.width
+        ).reshape(self.queries, self.width)
+        occupied = self.ids != ""
+        fused[~occupied] = -np.inf
+        order = np.argsort(-fused, axis=1, kind="stable")[:, :limit]
+        return order, np.take_along_axis(occupied, order, axis=1)
+
+
+def grid():
+    for strategy in STRATEGIES:
+        for sparse_weight in SPARSE_WEIGHTS:
+            for rrf_k in (RRF_KS if strategy == "rrf" else [60]):
+                yield strategy, sparse_weight, round(1.0 - sparse_weight, 2), rrf_k
+
+
+def sweep(pool, gt_map):
+    """
+    Scores every configuration of the grid and returns them best first by
+    RANK_BY. Queries without ground truth up to max_level are left out of
+    that level's means, as in evaluateResult.py.
+    """
+    query_ids = [str(qid) for qid in pool["query_ids"]]
+    results = []
+    fusion_pools = {}
+    for max_level in MAX_LEVELS:
+        qrels_by_query = metrics.build_qrels({qid: gt_map.get(qid, []) for qid in query_ids}, max_level)
+        keep = np.asarray([bool(qrels_by_query[qid]) for qid in query_ids])
+        qrels = metrics.Qrels([qrels_by_query[qid] for qid, kept in zip(query_ids, keep) if kept])
+        for limit in LIMITS:
+            cutoffs = ["K"] + [cutoff for cutoff in metrics.CUTOFFS if cutoff <= limit]
+            for candidate_factor in CANDIDATE_FACTORS:
+                pool_depth = limit * candidate_factor
+                if pool_depth > pool["sparse_ids"].shape[1]:
+                    raise ValueError(f"limit {limit} x candidate_factor {candidate_factor} exceeds the cached depth")
+                if pool_depth not in fusion_pools:
+                    fusion_pools[pool_depth] = FusionPool(pool, pool_depth)
+                fusion_pool = fusion_pools[pool_depth]
+                # Relevance of every candidate column, looked up once per pool and level.
+                relevant, gains = qrels.relevance(list(fusion_pool.ids[keep]), fusion_pool.width)
+
+                for strategy, sparse_weight, dense_weight, rrf_k in grid():
+                    order, occupied = fusion_pool.rank(strategy, [sparse_weight, dense_weight], rrf_k, limit)
+                    order, occupied = order[keep], occupied[keep]
+                    ranked_relevant = np.take_along_axis(relevant, order, axis=1) & occupied
+                    ranked_gains = np.where(ranked_relevant, np.take_along_axis(gains, order, axis=1), 0.0)
+                    means = metrics.aggregate(metrics.evaluate_relevance(ranked_relevant, ranked_gains, qrels, cutoffs))
+                    results.append({
+                        "strategy": strategy,
+                        "sparse_weight": sparse_weight,
+                        "dense_weight": dense_weight,
+                        "rrf_k": rrf_k if strategy == "rrf" else None,
+                        "limit": limit,
+                        "candidate_factor": candidate_factor,
+                        "max_level": max_level,
+                        "queries": int(keep.sum()),
+                        "metrics": means,
+                    })
+    results.sort(key=lambda result: -result["metrics"][RANK_BY])
+    return results
+
+
+if __name__ == "__main__":
+    # python sweepFusion.py [--refresh]
+    query_ids, query_texts, gt_map = build_queries()
+    pool = load_candidates(query_ids, query_texts, refresh="--refresh" in sys.argv[1:])
+
+    start = time.perf_counter()
+    results = sweep(pool, gt_map)
+    print(f"{len(results)} configurations scored in {time.perf_counter() - start:.2f}s")
+
+    with open(REPORT_PATH, "w", encoding="utf-8") as f:
+        json.dump({"rank_by": RANK_BY, "results": results}, f, indent=2)
+
+    print(f"{'strategy':<11}{'sparse':>7}{'dense':>7}{'rrf_k':>7}{'limit':>7}{'factor':>7}{'level':>7}"
+          f"{'P@K':>8}{'R@K':>8}{'nDCG@K':>8}{'MRR':>8}")
+    for result in results[:TOP]:
+        means = result["metrics"]
+        print(f"{result['strategy']:<11}{result['sparse_weight']:>7.2f}{result['dense_weight']:>7.2f}"
+              f"{result['rrf_k'] or '-':>7}{result['limit']:>7}{result['candidate_factor']:>7}{result['max_level']:>7}"
+              f"{means['precision@K']:>8.4f}{means['recall@K']:>8.4f}{means['ndcg@K']:>8.4f}{means['mrr']:>8.4f}")
+    print(f"Full ranking written to {REPORT_PATH}")
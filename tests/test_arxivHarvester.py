@@ -0,0 +1,192 @@
+import json
+import os
+import re
+import sys
+import threading
+import urllib.error
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.sax.saxutils import escape
+
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+import arxivHarvester
+from arxivHarvester import Harvester
+
+
+# A stand-in for the arXiv API: serves Atom pages of ``papers`` for
+# search_query / start / max_results, filtering on a submittedDate window.
+# ``failures`` maps a page start to the (status, headers) answers to give
+# before serving it normally.
+class FixtureArxiv:
+    def __init__(self, papers):
+        self.papers = papers
+        self.failures = {}
+        self.requests = []
+        fixture = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                fixture.handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/api/query"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def handle(self, request):
+        query = request.path.split("?", 1)[1]
+        params = dict(param.split("=", 1) for param in query.split("&"))
+        start, page_size = int(params["start"]), int(params["max_results"])
+        self.requests.append((params["search_query"], start))
+
+        failures = self.failures.get(start)
+        if failures:
+            status, headers = failures.pop(0)
+            request.send_response(status)
+            for name, value in headers.items():
+                request.send_header(name, value)
+            request.end_headers()
+            return
+
+        papers = self.papers
+        window = re.search(r"submittedDate:\[(\d+)\+TO\+(\d+)\]", params["search_query"])
+        if window:
+            papers = [paper for paper in papers if window.group(1) <= paper["submitted"] <= window.group(2)]
+        body = self.feed(len(papers), papers[start:start + page_size]).encode("utf-8")
+        request.send_response(200)
+        request.send_header("Content-Type", "application/atom+xml")
+        request.send_header("Content-Length", str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+    @staticmethod
+    def feed(total, papers):
+        entries = "".join(
+            f"""<entry>
+<id>http://arxiv.org/abs/{paper['id']}</id>
+<updated>2024-01-01T00:00:00Z</updated>
+<title>{escape(paper['title'])}</title>
+<summary>Abstract of {escape(paper['title'])}</summary>
+<author><name>A. Author</name></author>
+<link href="http://arxiv.org/abs/{paper['id']}" rel="alternate" type="text/html"/>
+</entry>"""
+            for paper in papers
+        )
+        return f"""<?xml version="1.0" encoding="UTF-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom" xmlns:opensearch="http://a9.com/-/spec/opensearch/1.1/">
+<title>arXiv Query</title>
+<opensearch:totalResults>{total}</opensearch:totalResults>
+{entries}
+</feed>"""
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def make_papers(count, first=1, submitted="202301010000"):
+    return [
+        {"id": f"2301.{number:05d}v1", "title": f"Paper {number}", "submitted": submitted}
+        for number in range(first, first + count)
+    ]
+
+
+def read_ids(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line)["id"] for line in f if line.strip()]
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    # Records retry delays instead of waiting them out; the rate limiter
+    # sleeps through the same function.
+    recorded = []
+    monkeypatch.setattr(arxivHarvester.time, "sleep", recorded.append)
+    return recorded
+
+
+def harvester(output, fixture, **kwargs):
+    kwargs = {"rate": 1000, "workers": 2, "page_size": 3, "backoff": 0.01, **kwargs}
+    return Harvester(str(output), base_url=fixture.url, **kwargs)
+
+
+def test_pages_through_all_results_in_order(tmp_path):
+    output = tmp_path / "papers.jsonl"
+    papers = make_papers(8)
+    with FixtureArxiv(papers) as fixture:
+        written = harvester(output, fixture).harvest("cat:cs.CL")
+
+    assert written == 8
+    assert read_ids(output) == [paper["id"] for paper in papers]
+    assert sorted(start for _, start in fixture.requests) == [0, 3, 6]
+
+
+def test_honours_retry_after_and_backs_off(tmp_path, sleeps):
+    output = tmp_path / "papers.jsonl"
+    with FixtureArxiv(make_papers(6)) as fixture:
+        fixture.failures[3] = [(429, {"Retry-After": "7"}), (503, {})]
+        written = harvester(output, fixture).harvest("cat:cs.CL")
+
+    assert written == 6
+    assert 7.0 in sleeps
+    # The 503 had no Retry-After: exponential backoff with jitter, second attempt.
+    assert any(0.02 <= delay <= 0.03 for delay in sleeps)
+    assert [start for _, start in fixture.requests].count(3) == 3
+
+
+def test_resumes_from_the_saved_cursor(tmp_path):
+    output = tmp_path / "papers.jsonl"
+    papers = make_papers(8)
+    with FixtureArxiv(papers) as fixture:
+        fixture.failures[6] = [(400, {})]
+        with pytest.raises(urllib.error.HTTPError):
+            harvester(output, fixture, workers=1).harvest("cat:cs.CL")
+        with open(f"{output}.harvest.json", "r", encoding="utf-8") as f:
+            assert json.load(f)["cat:cs.CL"]["next_start"] == 6
+        assert len(read_ids(output)) == 6
+
+        fixture.requests.clear()
+        written = harvester(output, fixture, workers=1).harvest("cat:cs.CL")
+
+    assert written == 2
+    assert fixture.requests == [("cat:cs.CL", 6)]
+    assert read_ids(output) == [paper["id"] for paper in papers]
+
+
+def test_skips_new_versions_of_papers_already_harvested(tmp_path):
+    output = tmp_path / "papers.jsonl"
+    output.write_text(json.dumps({"id": "2301.00002v1"}) + "\n", encoding="utf-8")
+    papers = make_papers(4)
+    papers[1]["id"] = "2301.00002v2"
+    with FixtureArxiv(papers) as fixture:
+        written = harvester(output, fixture).harvest("cat:cs.CL")
+
+    assert written == 3
+    assert read_ids(output) == ["2301.00002v1", "2301.00001v1", "2301.00003v1", "2301.00004v1"]
+
+
+def test_refresh_caps_each_run_and_fetches_only_new_submissions(tmp_path):
+    output = tmp_path / "papers.jsonl"
+    papers = make_papers(5, submitted="202301010000")
+    with FixtureArxiv(papers) as fixture:
+        # The cap applies per run: the second run finishes the first window.
+        assert harvester(output, fixture).harvest_since("cat:cs.CL", "202201010000", 4, "202302010000") == 4
+        assert harvester(output, fixture).harvest_since("cat:cs.CL", "202201010000", 4, "202302010000") == 1
+
+        papers += make_papers(2, first=6, submitted="202303010000")
+        fixture.requests.clear()
+        written = harvester(output, fixture).harvest_since("cat:cs.CL", "202201010000", 4, "202304010000")
+
+    assert written == 2
+    assert len(read_ids(output)) == 7
+    # The new window starts shortly before the previous one ended, not at ``since``.
+    query, start = fixture.requests[0]
+    assert start == 0
+    assert "submittedDate:[202301300000+TO+202304010000]" in query
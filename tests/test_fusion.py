@@ -0,0 +1,86 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+from fusion import fuse, fuse_hits, milvus_normalize, top_k
+
+
+# Two legs as hybrid_search passes them: sparse (IP) first, dense (COSINE) second.
+SPARSE_IDS = ["a", "b"]
+DENSE_IDS = ["b", "c"]
+METRICS = ["IP", "COSINE"]
+
+
+def test_milvus_normalize():
+    scores = np.array([-1.0, 0.0, 1.0])
+    assert milvus_normalize(scores, "COSINE").tolist() == [0.0, 0.5, 1.0]
+    assert milvus_normalize(scores, "IP").tolist() == pytest.approx([0.25, 0.5, 0.75])
+
+
+def test_weighted_sums_milvus_normalized_scores():
+    ids, scores = fuse([SPARSE_IDS, DENSE_IDS], [[1.0, 0.0], [0.8, 0.2]], [0.5, 1.0], METRICS)
+
+    # a: 0.5 * (0.5 + atan(1) / pi); b: 0.5 * 0.5 + (1 + 0.8) / 2; c: (1 + 0.2) / 2
+    assert ids.tolist() == ["b", "c", "a"]
+    assert scores.tolist() == pytest.approx([1.15, 0.6, 0.375])
+
+
+def test_rrf_sums_weighted_reciprocal_ranks():
+    ids, scores = fuse(
+        [SPARSE_IDS, DENSE_IDS], [[9.0, 1.0], [0.8, 0.2]], [1.0, 2.0], METRICS, strategy="rrf", rrf_k=10
+    )
+
+    assert ids.tolist() == ["b", "c", "a"]
+    assert scores.tolist() == pytest.approx([1 / 12 + 2 / 11, 2 / 12, 1 / 11])
+
+
+def test_normalized_min_max_scales_each_leg():
+    ids, scores = fuse(
+        [["a", "b", "c"], DENSE_IDS], [[5.0, 3.0, 1.0], [0.8, 0.2]], [1.0, 0.5], METRICS, strategy="normalized"
+    )
+
+    # Sparse maps to 1, 0.5, 0; dense to 1, 0.
+    assert ids.tolist() == ["a", "b", "c"]
+    assert scores.tolist() == pytest.approx([1.0, 1.0, 0.0])
+
+
+def test_ties_are_broken_by_id_also_at_the_cutoff():
+    ids_per_leg = [["d", "b"], ["c", "a"]]
+    scores_per_leg = [[2.0, 1.0], [0.9, 0.1]]
+
+    ids, _ = fuse(ids_per_leg, scores_per_leg, [1.0, 1.0], METRICS, strategy="rrf", limit=3)
+    assert ids.tolist() == ["c", "d", "a"]
+    ids, _ = fuse(ids_per_leg, scores_per_leg, [1.0, 1.0], METRICS, strategy="rrf", limit=1)
+    assert ids.tolist() == ["c"]
+
+
+def test_top_k_orders_equal_scores_by_index():
+    rng = np.random.default_rng(0)
+    for _ in range(200):
+        scores = rng.integers(0, 4, rng.integers(1, 40)).astype(np.float64)
+        limit = int(rng.integers(0, 45))
+        expected = sorted(range(len(scores)), key=lambda i: (-scores[i], i))[:limit]
+        assert top_k(scores, limit).tolist() == expected
+
+
+class Hit:
+    def __init__(self, hit_id, distance):
+        self.entity = {"id": hit_id, "title": f"Paper {hit_id}"}
+        self.distance = distance
+
+
+def test_fuse_hits_keeps_entities():
+    hits = fuse_hits([[Hit("a", 1.0)], [Hit("a", 0.0), Hit("b", 1.0)]], [1.0, 1.0], METRICS, limit=2)
+
+    assert [hit.id for hit in hits] == ["a", "b"]
+    assert hits[0].entity["title"] == "Paper a"
+    assert hits[0].distance == pytest.approx(0.75 + 0.5)
+    assert hits[1].distance == pytest.approx(1.0)
+
+
+def test_unknown_strategy():
+    with pytest.raises(ValueError):
+        fuse([SPARSE_IDS], [[1.0, 0.0]], [1.0], ["IP"], strategy="max")
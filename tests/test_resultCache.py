@@ -0,0 +1,170 @@
+import asyncio
+import os
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+import resultCache
+from resultCache import ResultCache, SqliteResultStore
+
+
+# Stands in for CorpusVersion: the version is whatever the test sets.
+class FakeVersion:
+    def __init__(self, value="v1"):
+        self.value = value
+
+    def current(self):
+        return self.value
+
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(resultCache.time, "time", clock)
+    return clock
+
+
+def get(cache, key):
+    return asyncio.run(cache.get(key, cache.current_version()))
+
+
+def put(cache, key, body, count=1):
+    cache.put(key, cache.current_version(), count, body)
+
+
+def usage(path):
+    # The trigger-maintained totals next to the ones summed from the rows.
+    with sqlite3.connect(path) as conn:
+        kept = conn.execute("SELECT bytes, rows FROM usage").fetchone()
+        summed = conn.execute("SELECT COALESCE(SUM(LENGTH(body)), 0), COUNT(*) FROM results").fetchone()
+    return kept, summed
+
+
+def test_a_new_corpus_version_invalidates_entries():
+    version = FakeVersion("v1")
+    cache = ResultCache(version)
+    put(cache, "k", b"body")
+    assert get(cache, "k") == (1, b"body")
+
+    version.value = "v2"
+    assert get(cache, "k") is None
+    assert cache.stats()["entries"] == 0
+    assert cache.stats()["corpus_version"] == "v2"
+
+
+def test_entries_expire_after_the_ttl(clock):
+    cache = ResultCache(FakeVersion(), ttl=10)
+    put(cache, "k", b"body")
+
+    clock.now += 9
+    assert get(cache, "k") == (1, b"body")
+    clock.now += 2
+    assert get(cache, "k") is None
+    assert cache.stats()["stale"] == 1
+
+
+def test_a_zero_ttl_never_expires(clock):
+    cache = ResultCache(FakeVersion(), ttl=0)
+    put(cache, "k", b"body")
+
+    clock.now += 10 ** 9
+    assert get(cache, "k") == (1, b"body")
+
+
+def test_memory_is_bounded_by_body_bytes_least_recently_used_first():
+    cache = ResultCache(FakeVersion(), max_mb=250 / (1024 * 1024))
+    put(cache, "a", b"a" * 100)
+    put(cache, "b", b"b" * 100)
+    get(cache, "a")
+    put(cache, "c", b"c" * 100)
+
+    assert get(cache, "b") is None
+    assert get(cache, "a") is not None and get(cache, "c") is not None
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["size_mb"] * 1024 * 1024 == 200
+
+    # A body over the whole budget is not cached at all.
+    put(cache, "d", b"d" * 300)
+    assert get(cache, "d") is None
+    assert cache.stats()["entries"] == 2
+
+
+def test_store_keeps_usage_totals_in_step(tmp_path):
+    path = str(tmp_path / "results.sqlite")
+    store = SqliteResultStore(path, max_bytes=1000)
+    store.put("a", "v1", 0.0, 1, b"a" * 100)
+    store.put("b", "v2", 0.0, 1, b"b" * 200)
+    assert usage(path) == ((300, 2), (300, 2))
+
+    # Replacing a key deletes the old row first, so its bytes are not counted twice.
+    store.put("a", "v1", 0.0, 1, b"a" * 50)
+    assert usage(path) == ((250, 2), (250, 2))
+    assert store.get("a") == ("v1", 0.0, 1, b"a" * 50)
+
+    store.discard_other_versions("v1")
+    assert usage(path) == ((50, 1), (50, 1))
+    assert len(store) == 1
+    store.close()
+
+
+def test_store_evicts_the_oldest_writes_past_max_bytes(tmp_path, clock):
+    path = str(tmp_path / "results.sqlite")
+    store = SqliteResultStore(path, max_bytes=250)
+    for key in "abc":
+        clock.now += 1
+        assert store.put(key, "v1", 0.0, 1, key.encode() * 100) == (1 if key == "c" else 0)
+
+    assert store.get("a") is None
+    assert store.get("b") is not None and store.get("c") is not None
+    assert usage(path) == ((200, 2), (200, 2))
+
+    # The newest entry is kept even when it alone is over the budget.
+    clock.now += 1
+    assert store.put("d", "v1", 0.0, 1, b"d" * 400) == 2
+    assert usage(path) == ((400, 1), (400, 1))
+    store.close()
+
+
+def test_entries_are_shared_through_the_store(tmp_path, clock):
+    path = str(tmp_path / "results.sqlite")
+    version = FakeVersion("v1")
+    writer = ResultCache(version, ttl=10, shared=SqliteResultStore(path, max_bytes=1000), namespace="local")
+    put(writer, writer.key({"query": "Graph  Neural Networks", "top_k": 5, "fusion": "rrf",
+                            "sparse_weight": 0.7, "dense_weight": 1.0, "rrf_k": 60, "candidate_factor": 4}),
+        b"body", count=3)
+    writer.close()
+
+    # Another worker: same namespace, the same query up to whitespace.
+    reader = ResultCache(version, ttl=10, shared=SqliteResultStore(path, max_bytes=1000), namespace="local")
+    key = reader.key({"query": " Graph Neural Networks ", "top_k": 5, "fusion": "rrf",
+                      "sparse_weight": 0.7, "dense_weight": 1.0, "rrf_k": 60, "candidate_factor": 4})
+    assert get(reader, key) == (3, b"body")
+    assert reader.stats()["shared_hits"] == 1
+    assert get(reader, key) == (3, b"body")
+    assert reader.stats()["hits"] == 1
+
+    # Expired and other-version entries in the store are misses too.
+    clock.now += 11
+    assert get(reader, key) is None
+    version.value = "v2"
+    clock.now -= 11
+    assert get(reader, key) is None
+    reader.close()
+    assert usage(path) == ((0, 0), (0, 0))
+
+
+def test_keys_are_namespaced():
+    request = {"query": "q", "top_k": 5, "fusion": "weighted", "sparse_weight": 0.7,
+               "dense_weight": 1.0, "rrf_k": 60, "candidate_factor": 4}
+    assert ResultCache(FakeVersion(), namespace="milvus:a").key(request) != \
+        ResultCache(FakeVersion(), namespace="milvus:b").key(request)